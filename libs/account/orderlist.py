@@ -2,11 +2,209 @@
 #!/usr/bin/python3
 
 import asyncio
+import heapq
+import threading
 import time
-from copy import deepcopy
-from collections import deque
-from threading import Thread, Event, Lock
-import traceback
+from collections import deque, OrderedDict
+from operator import attrgetter
+from libs.utils.event_dispatcher import EventDispatcher
+from libs.utils.rolling_counter import RollingCounter
+
+# 注文1件分のレコード
+#   よく使うキーは __slots__ の属性に持ち、それ以外のキーだけ辞書に入れる
+#   dictと同じように ['key'] / get() / in / dict(**record) で参照できる
+class OrderRecord(object):
+    __slots__ = ('id', 'symbol', 'side', 'price', 'size', 'remain', 'ordered_time', 'accepted_time',
+                 'expire', 'invalidate', 'closeid', '_extra')
+    _FIELDS = __slots__[:-1]
+    _FIELD_SET = frozenset(_FIELDS)
+    _UNSET = object()        # 値が入っていない属性
+    _get_fields = attrgetter(*_FIELDS)
+
+    def __init__(self, **kwargs):
+        for key in self._FIELDS:
+            setattr(self, key, self._UNSET)
+        self._extra = None
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in self._FIELD_SET :
+            value = getattr(self, key)
+            if value is not self._UNSET :
+                return value
+        elif self._extra is not None and key in self._extra :
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._FIELD_SET :
+            setattr(self, key, value)
+        else:
+            if self._extra is None :
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        if key in self._FIELD_SET :
+            return getattr(self, key) is not self._UNSET
+        return self._extra is not None and key in self._extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        unset = self._UNSET
+        d = {k:v for k,v in zip(self._FIELDS, self._get_fields(self)) if v is not unset}
+        if self._extra :
+            d.update(self._extra)
+        return d
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self.to_dict())
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+# ストラテジーへ渡す読み出し専用の注文情報
+class FrozenOrder(dict):
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("order snapshot is read-only")
+    __setitem__ = __delitem__ = update = pop = popitem = clear = setdefault = _readonly
+
+    # copy.deepcopy() や pickle では通常の dict として複製
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+# 読み出し専用の注文リスト (version は作成元の更新回数  変更が無い間は同じスナップショットを使い回す)
+class OrderSnapshot(tuple):
+    def __new__(cls, items, version):
+        self = super().__new__(cls, items)
+        self.version = version
+        return self
+
+    # copy.deepcopy() や pickle では通常の list として複製
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+# 自分の注文IDの検索用インデックス (maxlen件を超えたら最も長く参照されていないIDから削除)
+class OrderIdIndex(object):
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self._ids = OrderedDict()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __contains__(self, id):
+        return id in self._ids
+
+    def append(self, id):
+        self._ids[id] = True
+        self._ids.move_to_end(id)
+        if len(self._ids) > self.maxlen :
+            self._ids.popitem(last=False)
+
+    # 登録済みかどうかを調べて、登録済みなら最新の参照として末尾へ移動
+    def touch(self, id):
+        if id not in self._ids :
+            return False
+        self._ids.move_to_end(id)
+        return True
+
+
+# 約定・キャンセル済みの注文履歴 (maxlen付きのdequeと同じく古いものから消える) とIDの検索用インデックス
+class OrderHistory(object):
+    def __init__(self, maxlen):
+        self._deque = deque(maxlen=maxlen)
+        self._count = {}      # id : deque内に含まれる件数 (部分約定では同じIDが複数入る)
+        self._appended = 0    # これまでに追加した件数
+        self._snapshot = None
+
+    def __len__(self):
+        return len(self._deque)
+
+    def __iter__(self):
+        return iter(self._deque)
+
+    def __contains__(self, id):
+        return id in self._count
+
+    def append(self, item):
+        if len(self._deque)==self._deque.maxlen :
+            old = self._deque[0]['id']
+            if self._count[old]==1 : del self._count[old]
+            else:                    self._count[old] -= 1
+        self._deque.append(item if isinstance(item, FrozenOrder) else FrozenOrder(item))
+        self._count[item['id']] = self._count.get(item['id'],0)+1
+        self._appended += 1
+
+    # 追加が無い間は同じスナップショットを返す
+    def snapshot(self):
+        if self._snapshot is None or self._snapshot.version!=self._appended :
+            self._snapshot = OrderSnapshot(self._deque, self._appended)
+        return self._snapshot
+
+# 注文ごとの期限 (expire / invalidate) の min-heap
+#   期限が変わったエントリや注文リストから無くなったエントリは削除せずに残しておき、取り出す時に読み飛ばす
+#   読み飛ばすエントリが増えすぎたら注文リストから作り直す
+class DeadlineHeap(object):
+    def __init__(self, key, order_dict):
+        self._key = key
+        self._order_dict = order_dict
+        self._heap = []          # (期限, id)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, id, deadline):
+        heapq.heappush(self._heap, (deadline, id))
+        if len(self._heap) > len(self._order_dict)*4+1024 :
+            self._rebuild()
+
+    def _rebuild(self):
+        self._heap = [(o[self._key], id) for id,o in list(self._order_dict.items()) if self._key in o]
+        heapq.heapify(self._heap)
+
+    def _valid(self, entry):
+        o = self._order_dict.get(entry[1])
+        return o is not None and o.get(self._key)==entry[0]
+
+    # 最も近い期限 (無ければ None)
+    def peek(self):
+        heap = self._heap
+        while heap and not self._valid(heap[0]) :
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    # 期限が now 以前になった (id, 期限) のリスト
+    def pop_due(self, now):
+        heap = self._heap
+        due = {}
+        while heap and heap[0][0]<=now :
+            entry = heapq.heappop(heap)
+            if self._valid(entry) :
+                due[entry[1]] = entry[0]
+        return list(due.items())
+
 
 # 注文リスト管理クラス
 class OrderList(object):
@@ -14,19 +212,25 @@ class OrderList(object):
     def __init__(self, logger):
         self._logger = logger
         self.order_dict = {}
-        self._my_id = deque(maxlen=5000)
-        self._executed_list = deque(maxlen=1000)
-        self._canceled_list = deque(maxlen=1000)
+        self._version = 0         # order_dict を変更するたびに進める (order_dict の変更は必ずこのクラスのメソッドで行うこと)
+        self._snapshot = None
+        self._my_id = OrderIdIndex(maxlen=5000)
+        self._executed_list = OrderHistory(maxlen=1000)
+        self._canceled_list = OrderHistory(maxlen=1000)
+        # expire / invalidate の変更は必ず _push_deadline を通すこと
+        self._expire = DeadlineHeap('expire', self.order_dict)
+        self._invalidate = DeadlineHeap('invalidate', self.order_dict)
+        self.expire_event = asyncio.Event()      # 今までより早い expire が登録されたらセット (自動キャンセルタスクを起こす)
+        # 発注中 (REST のレスポンス待ち) に届いた未登録IDの websocket イベントを登録まで保留する
+        self._event_lock = threading.RLock()
+        self._sending = 0
+        self._amending = {}       # 変更のレスポンス待ちのID : 変更中の数
+        self._pending = {}        # id : [(受信時刻, handler, args), ...]
+        self.pending_stats = {'buffered':0, 'replayed':0, 'dropped':0}
         self.reset_counter()
-        self._historical_counter={'ordered':deque([0],maxlen=86400), 'filled':deque([0],maxlen=86400),
-                                  'partially_filled':deque([0],maxlen=86400), 'canceled':deque([0],maxlen=86400),
-                                  'size':deque([0],maxlen=86400)}
-
-        self._event_list = []
-        self.event = Event() 
-        event_drive = Thread(target=self._event_drive, args=())
-        event_drive.daemon = True
-        event_drive.start()
+        self._historical_counter = RollingCounter(names=('ordered','filled','partially_filled','canceled','size'), maxlen=86400)
+
+        self.event = EventDispatcher(self._logger, self.__class__.__name__)
                 
         # 1秒ごとに実行
         self._logger.call_every1sec.append({'name':'order_counter_update', 'handler':self._exec_every_sec, 'interval':1, 'counter':0})
@@ -35,23 +239,12 @@ class OrderList(object):
         self._shift_historical_counter()  # historical_counterのシフト
         self._delete_invalidate_order()   # オーダーリストのゴミを掃除 
 
-    def _event_drive(self):
-        while self._logger.running:
-            self.event.wait()
-            self.event.clear()
-
-            for handler, args in self._event_list:
-                try:
-                   if self._logger.running :
-                        future = asyncio.run_coroutine_threadsafe(handler(*args), self._logger.event_loop)
-                        result = future.result()
-
-                except Exception as e:
-                    self._logger.error( e )
-                    self._logger.info(traceback.format_exc())
-
     def add_handler( self, handler, args=() ):
-        self._event_list.append( (handler, args) )
+        self.event.add_handler(handler, args)
+
+    @property
+    def event_stats(self):
+        return self.event.stats
 
     def __len__(self):
         return len(self.order_dict)
@@ -85,57 +278,187 @@ class OrderList(object):
 
     # historical_counterのシフト
     def _shift_historical_counter(self):
-        self._historical_counter['ordered'].append(0)
-        self._historical_counter['filled'].append(0)
-        self._historical_counter['partially_filled'].append(0)
-        self._historical_counter['canceled'].append(0)
-        self._historical_counter['size'].append(0)
+        self._historical_counter.shift()
 
     def historical_counter(self, sec):
-        return {'ordered': sum(list(self._historical_counter['ordered'])[-sec:]),
-                'filled': sum(list(self._historical_counter['filled'])[-sec:]),
-                'partially_filled': sum(list(self._historical_counter['partially_filled'])[-sec:]),
-                'canceled': sum(list(self._historical_counter['canceled'])[-sec:]),
-                'size': round(sum(list(self._historical_counter['size'])[-sec:]),8)}
+        result = self._historical_counter.window(sec)
+        result['size'] = round(result['size'],8)
+        return result
+
+    # ユーザー定義のカウンタ (historical_counter() の結果にも含まれる)
+    def add_historical_counter(self, name):
+        self._historical_counter.add_counter(name)
 
+    def count_historical(self, name, value=1):
+        if name not in self._historical_counter :
+            self._historical_counter.add_counter(name)
+        self._historical_counter.add(name, value)
+
+    # 注文リストの読み出し専用スナップショット (注文に変更が無い間は同じものを返す)
     @property
     def list(self):
-        return [dict({'id':o[0]},**o[1]) for o in self.order_dict.items()]
+        if self._snapshot is None or self._snapshot.version!=self._version :
+            self._snapshot = OrderSnapshot((FrozenOrder(o.to_dict()) for o in self.order_dict.values()), self._version)
+        return self._snapshot
 
     def is_myorder(self, id):
-        return id in list(self._my_id)
+        return self._my_id.touch(id)
+
+    # オーダーリストに無いIDが約定済み・キャンセル済みかどうかをログに残す
+    def _log_history(self, id, log):
+        if id in self._executed_list :
+            log( "="*50 + "ID:{} already in executed_list".format(id) )
+        if id in self._canceled_list :
+            log( "="*50 + "ID:{} already in canceled_list".format(id) )
+
+    def _push_deadline(self, id, key, deadline):
+        if key=='expire' :
+            head = self._expire.peek()
+            self._expire.push(id, deadline)
+            if head is None or deadline<head :
+                self._wakeup_cancel_task()
+        else:
+            self._invalidate.push(id, deadline)
+
+    # websocket のスレッドから (apply 経由の amend_order / mark_as_invalidate で) 呼ばれることもあるので
+    # イベントループ外からは call_soon_threadsafe でセットする (asyncio.Event はスレッドセーフではない)
+    def _wakeup_cancel_task(self):
+        try:
+            asyncio.get_running_loop()
+            self.expire_event.set()
+        except RuntimeError:
+            try:
+                self._logger.event_loop.call_soon_threadsafe(self.expire_event.set)
+            except (AttributeError, RuntimeError):
+                # イベントループ起動前・終了後
+                self.expire_event.set()
+
+    # 次の自動キャンセルの時刻 (無ければ None)
+    def next_expire(self):
+        return self._expire.peek()
+
+    # expire を過ぎた (id, expire) のリスト
+    def pop_expired(self, now):
+        return self._expire.pop_due(now)
+
+    # 自動キャンセルを出した後も expire が更新されていない (キャンセルに失敗した) オーダーを delay 秒後に再度自動キャンセルする
+    #   pop_expired でヒープから取り出されているので、再登録しないと二度と自動キャンセルされない
+    def retry_expired(self, expired, delay=0.3, maxretry=10):
+        now = time.time()
+        for id, expire in expired:
+            o = self.order_dict.get(id)
+            if o is None or o.get('expire')!=expire :
+                continue
+            retry = o.get('expire_retry',0)+1
+            if retry>maxretry :
+                self._logger.error( "ID:{} auto cancel failed {} times".format(id, maxretry) )
+                continue
+            o['expire_retry'] = retry
+            o['expire'] = now+delay
+            self._push_deadline(id, 'expire', now+delay)
+            self._version += 1
+            self._logger.info( "        Retry auto cancel : [{}] ({})".format(id, retry) )
 
     # オーダーリストのゴミを掃除 
     def _delete_invalidate_order(self):
-        invalidate = [id for id,value in self.order_dict.items() if value['invalidate']<time.time()]
+        invalidate = [id for id,deadline in self._invalidate.pop_due(time.time())]
+        if invalidate :
+            self._version += 1
         for id in invalidate:
             d = self.order_dict.pop(id)
             self._logger.info( "INVALIDATE : {}".format(d))
-            self._canceled_list.append(dict({'id':id},**d))
+            self._canceled_list.append(FrozenOrder(d.to_dict(), id=id))
 
     @property
     def executed_list(self):
-        return deepcopy(list(self._executed_list))
+        return self._executed_list.snapshot()
 
     @property
     def canceled_list(self):
-        return deepcopy(list(self._canceled_list))
+        return self._canceled_list.snapshot()
+
+    # 発注のRESTリクエスト中であることを示す (with self.my.order.sending(): の中で発注して new_order で登録する)
+    #   この間に届いた未登録IDのイベントは apply() で保留され、new_order で登録した直後に適用される
+    def sending(self):
+        return _SendingSection(self)
+
+    # 変更 (amend) のRESTリクエスト中であることを示す (with self.my.order.amending(id): の中で変更し、成功したら amend_order で反映する)
+    #   この間に届いたそのIDのイベントは保留し、抜けた時に受信順に適用する
+    #   変更前の数量への約定と変更後の数量への約定のどちらが先に届いても、変更の成否が決まった後の残数に対して処理される
+    def amending(self, id):
+        return _AmendingSection(self, id)
+
+    # Private Websocket の受信スレッドから注文ごとのイベントを処理する
+    #   発注中で、まだ登録されていないIDのイベントは保留する (自分の発注の応答より先に届いたイベントの可能性がある)
+    #   変更中のIDのイベントも変更のレスポンスまで保留する
+    #   それ以外 (登録済みのIDや発注中でない場合) はすぐに handler(*args) を呼ぶ
+    def apply(self, id, handler, *args):
+        with self._event_lock:
+            if (self._sending>0 and id not in self._my_id) or id in self._amending :
+                self._pending.setdefault(id, []).append((time.time(), handler, args))
+                self.pending_stats['buffered'] += 1
+                return
+            handler(*args)
+
+    def _end_sending(self):
+        with self._event_lock:
+            self._sending -= 1
+            # 発注が全て終わっても登録されなかったIDは他人の注文 (10秒以上前のものは発注中でも破棄)
+            limit = time.time()-10 if self._sending>0 else None
+            for id in [id for id,events in self._pending.items() if id not in self._amending and (limit is None or events[0][0]<limit)]:
+                self.pending_stats['dropped'] += len(self._pending.pop(id))
+
+    def _end_amending(self, id):
+        with self._event_lock:
+            self._amending[id] -= 1
+            if self._amending[id]==0 :
+                del self._amending[id]
+                self._replay_pending([id])
+
+    # 登録したIDの保留中のイベントを受信順に適用する
+    def _replay_pending(self, ids):
+        for id in ids:
+            events = self._pending.pop(id, None)
+            if events :
+                self._logger.debug( "ID:{} replay {} pending events".format(id, len(events)) )
+                self.pending_stats['replayed'] += len(events)
+                for t, handler, args in events:
+                    handler(*args)
 
     # 発注時にオーダーリストに登録する
     # new_order( id, size, side, price, closeid:optional )
     def new_order(self, **kwargs ):
-        if id in self.order_dict :
-            self._logger.error( '-'*50+"ID:{} is already in list".format(id) )
-
-        item = dict({'ordered_time':time.time(), 'remain': float(kwargs['size'])}, **kwargs)
+        with self._event_lock:
+            self._register(kwargs)
+            self._version += 1
+            self._replay_pending((kwargs['id'],))
+
+    # 一括発注の結果をまとめて登録する
+    # new_orders( [{id, size, side, price, closeid:optional}, ...] )
+    def new_orders(self, orders ):
+        with self._event_lock:
+            for o in orders:
+                self._register(o)
+            if orders :
+                self._version += 1
+            self._replay_pending([o['id'] for o in orders])
+
+    def _register(self, kwargs):
+        if kwargs['id'] in self.order_dict :
+            self._logger.error( '-'*50+"ID:{} is already in list".format(kwargs['id']) )
+
+        item = OrderRecord(ordered_time=time.time(), remain=float(kwargs['size']), **kwargs)
 
         self.order_dict[item['id']] = item
         self._my_id.append(item['id'])
+        for key in ('expire', 'invalidate'):
+            if key in item :
+                self._push_deadline(item['id'], key, item[key])
         self._logger.info( "ORDERED [{}] {} {} price({}) size({}) {}".format(item['id'],item['symbol'], item['side'],round(item['price'],8),round(item['size'],8),
                 "closeid({})".format(item['closeid']) if 'closeid' in item else "") )
         self._logger.debug( "{}".format(item) )
         self._counter['ordered'] += 1
-        self._historical_counter['ordered'][-1] += 1
+        self._historical_counter.add('ordered', 1)
 
     # Private Websocket受信時にオーダーリストを更新する
     def update_order(self, id, side, price, size):
@@ -146,19 +469,53 @@ class OrderList(object):
         if id not in self.order_dict :
             self._logger.error( "ID:{} is not in order list (update error)".format(id) )
 
-            if id in [d['id'] for d in list(self._executed_list)] :
-                self._logger.error( "="*50 + "ID:{} already in executed_list".format(id) )
-            if id in [d['id'] for d in list(self._canceled_list)] :
-                self._logger.error( "="*50 + "ID:{} already in canceled_list".format(id) )
+            self._log_history(id, self._logger.error)
             return False
 
-        if self.order_dict[id]['side']!=side or self.order_dict[id]['size']!=size :
-            self._logger.error( '-'*50+"ID:{} data is not correcct\n{}".format(id,self.order_dict[id]) )
-        self.order_dict[id]['price'] = float(price)
-        self.order_dict[id]['accepted_time'] = time.time()
-        self._logger.debug( "ACCEPTED ID:{}\n{}".format(id,self.order_dict[id]) )
+        o = self.order_dict[id]
+        if o.side!=side or o.size!=size :
+            self._logger.error( '-'*50+"ID:{} data is not correcct\n{}".format(id,o) )
+        o.price = float(price)
+        o.accepted_time = time.time()
+        self._version += 1
+        self._logger.debug( "ACCEPTED ID:{}\n{}".format(id,o) )
         return True
 
+    # オーダーの変更 (amend) が受け付けられた時に価格・数量を更新する
+    #   size は変更後の注文数量 (約定済みの分を含む)。未約定の残数は変更した分だけ増減する
+    def amend_order(self, id, price=None, size=None):
+        if not self.is_myorder(id) :
+            self._logger.debug( "ID:{} is not my order".format(id) )
+            return None
+
+        if id not in self.order_dict :
+            self._logger.error( "ID:{} is not in order list (amend error)".format(id) )
+
+            self._log_history(id, self._logger.error)
+            return None
+
+        o = self.order_dict[id]
+        if price is not None :
+            o.price = float(price)
+        if size is not None :
+            o.remain = round(o.remain+float(size)-o.size,8)
+            o.size = float(size)
+        o['amended_time'] = time.time()
+        self._version += 1
+        self._logger.info( "AMENDED [{}] {} {} price({}) size({}/{})".format(id, o.get('symbol'), o.side, round(o.price,8), round(o.remain,8), round(o.size,8)) )
+        return o
+
+    # 自動キャンセルまでの時間を今から auto_cancel_after 秒後に設定し直す (キャンセル・再発注をせずにオーダーを出し直したことにする場合)
+    def refresh_expire(self, id, auto_cancel_after):
+        o = self.order_dict.get(id)
+        if o is None :
+            return None
+        expire = time.time()+auto_cancel_after
+        o['expire'] = expire
+        self._push_deadline(id, 'expire', expire)
+        self._version += 1
+        return o
+
     # 何らかの原因でキャンセルイベントが不達の場合でも30秒後にオーダーリストから削除するように登録
     def mark_as_invalidate(self, id, timeout=30):
         if not self.is_myorder(id) :
@@ -168,18 +525,40 @@ class OrderList(object):
         if id not in self.order_dict :
             self._logger.debug( "ID:{} is not in order list (update error)".format(id) )
 
-            if id in [d['id'] for d in list(self._executed_list)] :
-                self._logger.debug( "="*50 + "ID:{} already in executed_list".format(id) )
-            if id in [d['id'] for d in list(self._canceled_list)] :
-                self._logger.debug( "="*50 + "ID:{} already in canceled_list".format(id) )
+            self._log_history(id, self._logger.debug)
             return None
 
         # timeout秒後にオーダーリストから削除（ゴミ対策）
-        self.order_dict[id]['invalidate']=min(self.order_dict[id].get('invalidate',9999999999),time.time()+timeout)
-        self.order_dict[id]['expire']=max(self.order_dict[id].get('expire',9999999999),time.time()+timeout)
+        self._extend_deadline(id, self.order_dict[id], time.time()+timeout)
+        self._version += 1
 
         return self.order_dict[id]
 
+    # deadline までに削除されるように invalidate を早め、それまでは自動キャンセルが再度かからないように expire を遅らせる
+    def _extend_deadline(self, id, o, deadline):
+        invalidate = min(o.get('invalidate',9999999999),deadline)
+        expire = max(o.get('expire',9999999999),deadline)
+        if o.get('invalidate')!=invalidate :
+            o['invalidate'] = invalidate
+            self._push_deadline(id, 'invalidate', invalidate)
+        if o.get('expire')!=expire :
+            o['expire'] = expire
+            self._push_deadline(id, 'expire', expire)
+
+    # 一括キャンセル時にまとめて mark_as_invalidate する
+    def mark_as_invalidate_all(self, ids, timeout=30):
+        now = time.time()
+        marked = []
+        for id in ids:
+            if not self.is_myorder(id) or id not in self.order_dict :
+                continue
+            o = self.order_dict[id]
+            self._extend_deadline(id, o, now+timeout)
+            marked.append(o)
+        if marked :
+            self._version += 1
+        return marked
+
     # 約定を受信した際に部分約定の処理や全約定後のオーダーリストを削除する処理
     def executed(self, id, side, price, size, remain=-1):
         """
@@ -197,43 +576,38 @@ class OrderList(object):
         if not id in self.order_dict :
             self._logger.error( "ID:{} is not in order list (execution error)".format(id) )
 
-            if id in [d['id'] for d in list(self._executed_list)] :
-                self._logger.error( "="*50 + "ID:{} already in executed_list".format(id) )
-                return None
-
-            if id in [d['id'] for d in list(self._canceled_list)] :
-                self._logger.error( "="*50 + "ID:{} already in canceled_list".format(id) )
-
+            self._log_history(id, self._logger.error)
             return None
 
-        if self.order_dict[id]['side']!=side :
-            self._logger.error( '='*50+"Side({}) is not correct :\n{}".format(side, self.order_dict[id]) )
+        d = self.order_dict[id]
+        if d.side!=side :
+            self._logger.error( '='*50+"Side({}) is not correct :\n{}".format(side, d) )
             return None
-        if self.order_dict[id]['remain']<size :
-            self._logger.error( '='*50+"Size({}) is not correct (too much):\n{}".format(size, self.order_dict[id]) )
+        if d.remain<size :
+            self._logger.error( '='*50+"Size({}) is not correct (too much):\n{}".format(size, d) )
             return None
-        if remain!=-1 and round(self.order_dict[id]['remain']-size-remain, 8)!=0 :
-            self._logger.error( '='*50+"Remain({})-Size({}) is not match:\n{}".format(remain, size, self.order_dict[id]) )
+        if remain!=-1 and round(d.remain-size-remain, 8)!=0 :
+            self._logger.error( '='*50+"Remain({})-Size({}) is not match:\n{}".format(remain, size, d) )
             return None
 
-        self.order_dict[id]['remain'] = round(self.order_dict[id]['remain']-size,8)
-        if self.order_dict[id]['remain']==0 :
-            d = self.order_dict.pop(id)
-            d['price']=price
-            self._logger.info( "EXECUTE ALL [{}]  {} {} price({}) size({}/{})".format(id, d.get('symbol'), side,price,size,d['size']) )
+        d.remain = round(d.remain-size,8)
+        self._version += 1
+        if d.remain==0 :
+            self.order_dict.pop(id)
+            d.price = price
+            self._logger.info( "EXECUTE ALL [{}]  {} {} price({}) size({}/{})".format(id, d.get('symbol'), side,price,size,d.size) )
             self._logger.debug( "EXECUTE ALL : {}".format(d) )
             self._counter['filled'] += 1
-            self._historical_counter['filled'][-1] += 1
+            self._historical_counter.add('filled', 1)
 #            self._executed_list.append(dict({'id':id, 'exec_time':time.time()},**d))
-            self._executed_list.append(dict(d, **{'id':id, 'exec_time':time.time(), 'price':price, 'size':size}))
+            self._executed_list.append(FrozenOrder(d.to_dict(), id=id, exec_time=time.time(), price=price, size=size))
         else:
-            d = self.order_dict[id]
-            self._logger.info( "EXECUTE [{}]  {} {} price({}) size({}/{})".format(id, d.get('symbol'), side,price,size,d['size']) )
+            self._logger.info( "EXECUTE [{}]  {} {} price({}) size({}/{})".format(id, d.get('symbol'), side,price,size,d.size) )
             self._logger.debug( "EXECUTE : {}".format(d) )
-            self._executed_list.append(dict(self.order_dict[id], **{'id':id, 'exec_time':time.time(), 'price':price, 'size':size}))
+            self._executed_list.append(FrozenOrder(d.to_dict(), id=id, exec_time=time.time(), price=price, size=size))
 
         self._counter['size'] += size
-        self._historical_counter['size'][-1] += size
+        self._historical_counter.add('size', size)
         self.event.set()
 
         return d
@@ -252,22 +626,239 @@ class OrderList(object):
         if not id in self.order_dict :
             self._logger.debug( "ID:{} is not in order list".format(id) )
 
-            if id in [d['id'] for d in list(self._executed_list)] :
-                self._logger.debug( "="*50 + "ID:{} already in executed_list".format(id) )
-            if id in [d['id'] for d in list(self._canceled_list)] :
-                self._logger.debug( "="*50 + "ID:{} already in canceled_list".format(id) )
+            self._log_history(id, self._logger.debug)
             return None
 
         d = self.order_dict.pop(id)
-        self._canceled_list.append(dict({'id':id},**d))
+        self._version += 1
+        self._canceled_list.append(FrozenOrder(d.to_dict(), id=id))
 
-        if d['size']!=d['remain'] :
+        if d.size!=d.remain :
             self._counter['partially_filled'] += 1
-            self._historical_counter['partially_filled'][-1] += 1
+            self._historical_counter.add('partially_filled', 1)
         else:
             self._counter['canceled'] += 1
-            self._historical_counter['canceled'][-1] += 1
+            self._historical_counter.add('canceled', 1)
         self._logger.info( "CANCELED (Canceld or Expired) ID:{}".format(id) )
         self._logger.debug( "canceld order : {}".format(d) )
 
         return d
+
+
+class _SendingSection(object):
+    __slots__ = ('_order_list',)
+
+    def __init__(self, order_list):
+        self._order_list = order_list
+
+    def __enter__(self):
+        with self._order_list._event_lock:
+            self._order_list._sending += 1
+        return self._order_list
+
+    def __exit__(self, ex_type, ex_value, trace):
+        self._order_list._end_sending()
+
+
+class _AmendingSection(object):
+    __slots__ = ('_order_list', '_id')
+
+    def __init__(self, order_list, id):
+        self._order_list = order_list
+        self._id = id
+
+    def __enter__(self):
+        with self._order_list._event_lock:
+            self._order_list._amending[self._id] = self._order_list._amending.get(self._id,0)+1
+        return self._order_list
+
+    def __exit__(self, ex_type, ex_value, trace):
+        self._order_list._end_amending(self._id)
+
+
+# テストコード
+if __name__ == "__main__":
+    import random
+
+    class Logger(object):
+        def __init__(self):
+            self.call_every1sec = []
+            self.running = True
+            self.event_loop = asyncio.new_event_loop()
+        def info(self, *args) : pass
+        def debug(self, *args) : pass
+        def error(self, *args) : pass
+
+    # 1時間に10000件発注 (それぞれ2～4回の部分約定、3割はキャンセル) + 他人の注文や遅れて届くイベント
+    def scenario(order_list, num_orders=10000):
+        random.seed(1)
+        events = 0
+        for i in range(num_orders):
+            id = f'order{i}'
+            order_list.new_order(id=id, symbol='FX_BTC_JPY', side='BUY', price=5000000.0, size=0.04)
+            order_list.update_order(id, 'BUY', 5000000.0, 0.04)
+            events += 1
+            fills = random.randint(2,4) if random.random()>0.3 else 1
+            for f in range(fills-1):
+                order_list.executed(id, 'BUY', 5000000.0, 0.01)
+                events += 1
+            if fills>1 and random.random()>0.5 :
+                order_list.executed(id, 'BUY', 5000000.0, round(0.04-0.01*(fills-1),8))
+            else:
+                order_list.remove_order(id)
+            events += 1
+
+            # 他人の注文・キャンセル済み注文への遅延イベント
+            order_list.update_order(f'other{i}', 'SELL', 5000000.0, 0.01)
+            order_list.remove_order(f'order{random.randint(0,i)}')
+            order_list.mark_as_invalidate(f'order{random.randint(0,i)}')
+            events += 3
+        return events
+
+    order_list = OrderList(Logger())
+    start = time.perf_counter()
+    events = scenario(order_list)
+    elapsed = time.perf_counter()-start
+    print( "{} events : {:.3f}sec ({:.2f}us/event)  orders:{} executed:{} canceled:{}".format(
+           events, elapsed, elapsed/events*1000000, len(order_list), len(order_list._executed_list), len(order_list._canceled_list)) )
+
+    # インデックスと中身の整合性チェック (dequeと同じ件数・同じIDを保持していること)
+    for history in (order_list._executed_list, order_list._canceled_list):
+        ids = [d['id'] for d in history]
+        assert len(ids)==1000 and set(ids)==set(history._count)
+        assert all(history._count[id]==ids.count(id) for id in set(ids))
+    assert len(order_list._my_id)==5000 and 'order9999' in order_list._my_id and 'order4999' not in order_list._my_id
+
+    # 従来の検索方法との比較
+    my_id = deque(order_list._my_id, maxlen=5000)
+    executed = deque(order_list._executed_list, maxlen=1000)
+    start = time.perf_counter()
+    for i in range(10000):
+        f'order{i}' in list(my_id)
+        f'order{i}' in [d['id'] for d in list(executed)]
+    list_time = time.perf_counter()-start
+    start = time.perf_counter()
+    for i in range(10000):
+        order_list.is_myorder(f'order{i}')
+        f'order{i}' in order_list._executed_list
+    index_time = time.perf_counter()-start
+    print( "lookup : list {:.2f}us  index {:.2f}us".format(list_time/10000*1000000, index_time/10000*1000000) )
+
+    # ストラテジーからの参照 (20件の注文があり、1回のイベントで ordered_list と executed_history を4回ずつ参照)
+    order_list = OrderList(Logger())
+    for i in range(20):
+        order_list.new_order(id=f'order{i}', symbol='FX_BTC_JPY', side='BUY' if i%2 else 'SELL', price=5000000.0+i, size=0.01,
+                             expire=time.time()+60, invalidate=time.time()+2592000)
+    for i in range(1000):
+        order_list._executed_list.append({'id':f'exec{i}', 'side':'BUY', 'price':5000000.0, 'size':0.01, 'exec_time':time.time()})
+    plain_orders = {id:o.to_dict() for id,o in order_list.order_dict.items()}
+    plain_executed = deque((dict(e) for e in order_list._executed_list), maxlen=1000)
+
+    from copy import deepcopy
+    start = time.perf_counter()
+    for i in range(100):
+        for j in range(4):
+            [dict({'id':o[0]},**o[1]) for o in plain_orders.items()]
+            deepcopy(list(plain_executed))
+    copy_time = (time.perf_counter()-start)/100
+    start = time.perf_counter()
+    for i in range(100):
+        order_list.update_order(f'order{i%20}', 'BUY' if i%2 else 'SELL', 5000000.0, 0.01)
+        for j in range(4):
+            order_list.list
+            order_list.executed_list
+    snapshot_time = (time.perf_counter()-start)/100
+    assert [dict(o) for o in order_list.list]==[dict({'id':o[0]},**o[1].to_dict()) for o in order_list.order_dict.items()]
+    print( "strategy reads per event : copy {:.1f}us  snapshot {:.1f}us (including one order update)".format(copy_time*1000000, snapshot_time*1000000) )
+
+    # 一括発注・一括キャンセルの結果の登録 (スナップショットの作り直しは1回だけ)
+    order_list = OrderList(Logger())
+    version = order_list._version
+    order_list.new_orders([{'id':f'batch{i}', 'symbol':'FX_BTC_JPY', 'side':'BUY', 'price':5000000.0-i, 'size':0.01,
+                            'expire':time.time()+60, 'invalidate':time.time()+2592000} for i in range(10)])
+    assert order_list._version==version+1 and len(order_list.list)==10
+    marked = order_list.mark_as_invalidate_all([f'batch{i}' for i in range(12)])
+    assert order_list._version==version+2 and len(marked)==10 and all(o['invalidate']<time.time()+31 for o in order_list.list)
+
+    # 発注中に届いたイベント (登録済みの注文はすぐに処理、発注中の注文は登録後に受信順で処理、他人の注文は破棄)
+    order_list = OrderList(Logger())
+    order_list.new_order(id='old', symbol='FX_BTC_JPY', side='SELL', price=5000100.0, size=0.02)
+    with order_list.sending():
+        order_list.apply('new', order_list.update_order, 'new', 'BUY', 5000000.0, 0.03)
+        order_list.apply('old', order_list.executed, 'old', 'SELL', 5000100.0, 0.01)
+        order_list.apply('new', order_list.executed, 'new', 'BUY', 5000000.0, 0.01)
+        order_list.apply('other', order_list.update_order, 'other', 'SELL', 5000000.0, 0.01)
+        assert order_list.order_dict['old'].remain==0.01 and 'new' not in order_list.order_dict
+        order_list.new_order(id='new', symbol='FX_BTC_JPY', side='BUY', price=5000000.0, size=0.03)
+        assert order_list.order_dict['new'].remain==0.02 and 'accepted_time' in order_list.order_dict['new']
+    assert order_list._pending=={} and order_list.pending_stats=={'buffered':3, 'replayed':2, 'dropped':1}
+
+    # 部分約定後の変更 (size は約定済みを含む数量なので、残数は変更した分だけ増減する)
+    order_list.amend_order('new', price=5000050.0, size=0.05)
+    o = order_list.order_dict['new']
+    assert (o.price, o.size, o.remain)==(5000050.0, 0.05, 0.04) and order_list.list[-1]['price']==5000050.0
+    assert order_list.update_order('new', 'BUY', 5000050.0, 0.05) and order_list.amend_order('other', price=1)==None
+
+    # 変更のレスポンス待ちの間に届いた約定 (変更後の数量への約定は変更成功後に、変更前の数量への約定は失敗時にそのまま適用される)
+    order_list.new_order(id='amend', symbol='FX_BTC_JPY', side='BUY', price=5000000.0, size=1.0)
+    with order_list.amending('amend'):
+        order_list.apply('amend', order_list.executed, 'amend', 'BUY', 5000000.0, 1.5)
+        assert order_list.order_dict['amend'].remain==1.0
+        order_list.amend_order('amend', size=2.0)
+    o = order_list.order_dict['amend']
+    assert (o.size, o.remain)==(2.0, 0.5)
+    with order_list.amending('amend'), order_list.sending():
+        order_list.apply('amend', order_list.executed, 'amend', 'BUY', 5000000.0, 0.5)
+    assert 'amend' not in order_list.order_dict and order_list._pending=={}
+
+    # 変更の失敗 (size 1→2 の変更中に変更前のオーダーが全て約定した)
+    order_list.new_order(id='reject', symbol='FX_BTC_JPY', side='BUY', price=5000000.0, size=1.0, expire=time.time()+5)
+    with order_list.amending('reject'):
+        order_list.apply('reject', order_list.executed, 'reject', 'BUY', 5000000.0, 1.0)
+    assert 'reject' not in order_list.order_dict
+
+    order_list.new_order(id='refresh', symbol='FX_BTC_JPY', side='BUY', price=5000000.0, size=1.0, expire=time.time()+5)
+    assert order_list.refresh_expire('refresh', 60)['expire']>time.time()+59 and order_list.refresh_expire('other', 60)==None
+
+    # 期限の min-heap と従来の全件スキャンの比較 (1000件の注文、期限の変更や約定による削除を含む)
+    random.seed(2)
+    order_list = OrderList(Logger())
+    now = time.time()
+    for i in range(1000):
+        order_list.new_order(id=f'heap{i}', symbol='FX_BTC_JPY', side='BUY', price=5000000.0, size=0.01,
+                             expire=now+random.uniform(-5,60), invalidate=now+random.uniform(-5,600))
+    for i in range(0, 1000, 7):
+        order_list.mark_as_invalidate(f'heap{i}')
+    for i in range(0, 1000, 11):
+        order_list.remove_order(f'heap{i}')
+    scan = sorted(id for id,o in order_list.order_dict.items() if o['expire']<=now+10)
+    expired = order_list.pop_expired(now+10)
+    assert sorted(id for id,expire in expired)==scan
+    assert order_list.next_expire()==min(o['expire'] for o in order_list.order_dict.values() if o['expire']>now+10)
+
+    # キャンセルに失敗して mark_as_invalidate されなかったオーダーだけ再度自動キャンセルされる
+    order_list.mark_as_invalidate(scan[0])
+    order_list.retry_expired(expired)
+    assert order_list.next_expire()<time.time()+0.3
+    retry = sorted(id for id,expire in order_list.pop_expired(time.time()+0.3))
+    assert retry==scan[1:]
+
+    # websocket のスレッドから早い expire が登録された場合はイベントループ上でセットされる
+    order_list.expire_event.clear()
+    thread = threading.Thread(target=order_list.new_order, kwargs={'id':'thread', 'symbol':'FX_BTC_JPY', 'side':'BUY', 'price':5000000.0, 'size':0.01, 'expire':now-100})
+    thread.start()
+    thread.join()
+    assert not order_list.expire_event.is_set()
+    order_list._logger.event_loop.run_until_complete(asyncio.sleep(0))
+    assert order_list.expire_event.is_set()
+
+    start = time.perf_counter()
+    for i in range(1000):
+        [o for o in order_list.order_dict.items() if o[1]['expire']<now]
+    scan_time = (time.perf_counter()-start)/1000
+    start = time.perf_counter()
+    for i in range(1000):
+        order_list.next_expire()
+        order_list.pop_expired(now)
+    heap_time = (time.perf_counter()-start)/1000
+    print( "expire check ({} orders) : scan {:.1f}us  heap {:.1f}us".format(len(order_list), scan_time*1000000, heap_time*1000000) )
@@ -11,6 +11,9 @@ class OpenPositionFIFO(object):
     def __init__(self, logger, update_profitfile, order_rate, order_currency):
         self._logger = logger
         self._position = deque()
+        self._lots = {}         # id : 建玉 (_position 内の dict と同じオブジェクト)
+        self._total_size = 0    # 建玉の合計サイズ
+        self._total_value = 0   # 建玉の price×size の合計
         self._update_profitfile = update_profitfile
         self.realized = 0   # 確定済み損益
         self.commission = 0 # コミッション(makerコミッション-takerコミッション, SFDなど)
@@ -18,6 +21,7 @@ class OpenPositionFIFO(object):
         self.base_position = 0
 
         self.file = JsonFile(self._logger)
+        self.file.set_snapshot(self._snapshot)   # 1時間ごとに現在の建玉だけのファイルに圧縮
 
     def renew_posfile(self, filename):
         self._logger.info( '-'*100 )
@@ -39,12 +43,32 @@ class OpenPositionFIFO(object):
         for d in position_dict.values():
             self._logger.info( d )
             self._position.append(d)
+        self._rebuild_totals()
 
-        self.file.renew_file( [{'position':p} for p in list(self._position)] )
+        self.file.renew_file( self._snapshot() )
 
         self._logger.info( " pos_size = {} / average_price = {}".format(self.size, self.average_price)) 
         self._logger.info( '-'*100 )
 
+    # 建玉リストから合計値とIDのインデックスを作り直す
+    def _rebuild_totals(self):
+        self._lots = {p['id']:p for p in self._position}
+        self._total_size, self._total_value = self._recalculate()
+
+    def _recalculate(self):
+        return sum(p['size'] for p in self._position), sum(p['price']*p['size'] for p in self._position)
+
+    # 建玉の変化分を合計値に反映 (建玉が無くなったら誤差が残らないように0に戻す)
+    def _apply(self, price_before, size_before, price_after, size_after):
+        if len(self._position)==0 :
+            self._total_size = self._total_value = 0
+        else:
+            self._total_size += size_after-size_before
+            self._total_value += price_after*size_after-price_before*size_before
+
+    def _snapshot(self):
+        return [{'position':p} for p in list(self._position)]
+
     def _update_posfile(self, dict):
         self.file.add_data({'timestamp':time.time(), 'position':dict})
 
@@ -56,17 +80,18 @@ class OpenPositionFIFO(object):
         while remain>0 :
             if self.side in ['NONE',side] :
                 # 同方向ポジションの買い増しまたは新規エントリー
-                id_list = [d['id'] for d in list(self._position)] 
-                if id in id_list :
+                p = self._lots.get(id)
+                if p is not None :
                     # すでに同じIDのポジションがあればそこへ追加
-                    idx = id_list.index(id)
-                    p = self._position[idx]
+                    before = (p['price'], p['size'])
                     p['price'] = round((p['price']*p['size']+price*remain)/(p['size']+remain), 8)
                     p['size'] = round(p['size']+remain, 8)
-                    self._position[idx] = p
+                    self._apply(*before, p['price'], p['size'])
                 else:
                     p = {'id':id,'side': side, 'price': float(price), 'size': float(remain)}
                     self._position.append(p)
+                    self._lots[id] = p
+                    self._apply(0, 0, p['price'], p['size'])
                 self._update_posfile(p)
                 remain = 0
             else:
@@ -77,19 +102,26 @@ class OpenPositionFIFO(object):
                     self.realized += profit
 
                     remain = round(remain-p['size'], 8)
+                    if self._lots.get(p['id']) is p :
+                        del self._lots[p['id']]
+                    self._apply(p['price'], p['size'], p['price'], 0)
                     p['size']=0
                     self._update_posfile(p)
                 else:
                     profit = (p['price']-price)*remain*(1 if side=='BUY' else -1)
                     self.realized += profit
 
+                    before = p['size']
                     p['size'] = round(p['size']-remain, 8)
                     self._update_posfile(p)
                     self._position.appendleft(p)
+                    self._apply(p['price'], before, p['price'], p['size'])
                     remain = 0
 
         if org_side != self.side and len(self._position)!=0 :
-            self.renew_posfile(self.file.filename)
+            # ドテンしたら現在の建玉だけでファイルを作り直す
+            self.file.renew_file( self._snapshot() )
+            self._logger.info( " pos_size = {} / average_price = {}".format(self.size, self.average_price))
 
         self._update_profitfile()
 
@@ -102,23 +134,11 @@ class OpenPositionFIFO(object):
     @property
     def average_price(self):
         if len(self._position)==0 : return 0
-
-        value = []
-        size = []
-        side = self.side
-        positions = list(self._position)
-
-        for p in positions:
-            value.append(p['price']*p['size'])
-            size.append(p['size'])
-            if side != p['side']:
-                self._logger.error("Position list error!!!   {} != {}".format(side, p['side']))
-
-        return round(sum(value) / sum(size))
+        return round(self._total_value / self._total_size)
 
     @property
     def size(self):
-        return round(sum(p['size'] for p in list(self._position)) * (-1 if self.side=='SELL' else 1), 8)
+        return round(self._total_size * (-1 if self.side=='SELL' else 1), 8)
 
     # 損益計算 (フィアット建て)
     @property
@@ -134,3 +154,56 @@ class OpenPositionFIFO(object):
         return int(self.realized+self.commission)
 
 
+
+# テストコード
+if __name__ == "__main__":
+    import os
+    import random
+    import tempfile
+
+    class Logger(object):
+        call_every1sec = []
+        def info(self, *args) : pass
+        def error(self, *args) : print(*args)
+
+    # 合計値を使わずに建玉リストから計算した値
+    def recompute(pos):
+        positions = list(pos._position)
+        if len(positions)==0 :
+            return 'NONE', 0, 0
+        side = positions[-1]['side']
+        assert all(p['side']==side for p in positions), "Position list error"
+        assert pos._lots=={p['id']:p for p in positions}
+        size = sum(p['size'] for p in positions)
+        return side, round(sum(p['price']*p['size'] for p in positions)/size), round(size*(-1 if side=='SELL' else 1), 8)
+
+    # ランダムな約定の列 (同じIDへの追加約定・部分クローズ・ドテンを含む) で合計値と再計算の結果を比較
+    folder = tempfile.mkdtemp()
+    for seed in range(200):
+        random.seed(seed)
+        pos = OpenPositionFIFO(Logger(), update_profitfile=lambda:None, order_rate=1, order_currency='JPY')
+        pos.file.filename = os.path.join(folder, f'pos{seed}.json')
+        ids = [f'id{i}' for i in range(random.randint(1,30))]
+        for step in range(random.randint(1,300)):
+            pos.ref_ltp = random.randint(4000000, 6000000)
+            pos.executed(id=random.choice(ids), side=random.choice(('BUY','SELL')),
+                         price=random.randint(4000000, 6000000)+random.choice((0,0.5,0.25)),
+                         size=round(random.randint(1,300)*random.choice((0.01,0.001,0.00000001)),8))
+            side, average_price, size = recompute(pos)
+            assert pos.side==side and pos.size==size, (seed, step, pos.side, side, pos.size, size)
+            assert abs(pos.average_price-average_price)<=1, (seed, step, pos.average_price, average_price)
+            assert abs(pos.unreal-int((pos.ref_ltp-average_price)*size))<=abs(size)+1, (seed, step)
+    print( "running totals match the recomputation" )
+
+    # 建玉数ごとの参照時間
+    import time
+    for num in (10, 100, 1000):
+        pos = OpenPositionFIFO(Logger(), update_profitfile=lambda:None, order_rate=1, order_currency='JPY')
+        pos.file.filename = os.path.join(folder, f'bench{num}.json')
+        for i in range(num):
+            pos.executed(id=f'id{i}', side='BUY', price=5000000+i, size=0.01)
+        pos.ref_ltp = 5000000
+        start = time.perf_counter()
+        for i in range(1000):
+            pos.size, pos.average_price, pos.unreal
+        print( "{:>5} lots : size/average_price/unreal {:.2f}us".format(num, (time.perf_counter()-start)/1000*1000000) )
@@ -19,6 +19,7 @@ class OpenPositionGross(object):
         self.base_position = 0
 
         self.file = JsonFile(self._logger)
+        self.file.set_snapshot(self._snapshot)   # 1時間ごとに現在の建玉だけのファイルに圧縮
 
     def renew_posfile(self, filename):
         first_load = (self.file.filename!=filename)
@@ -66,6 +67,10 @@ class OpenPositionGross(object):
         self._logger.info( " pos_size = {} / average_price = {}".format(self.size, self.average_price)) 
         self._logger.info( '-'*100 )
 
+    def _snapshot(self):
+        with self._position_lock :
+            return [{'position':p} for p in list(self._long_position.values())+list(self._short_position.values())]
+
     def is_myorder(self, id):
         return (id in self._long_position) or (id in self._short_position)
 
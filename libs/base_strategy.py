@@ -70,17 +70,22 @@ class Strategy:
         return ex
 
 
-    def Scheduler(self, interval=1, basetime=None, callback=None, args=()):
+    def Scheduler(self, interval=1, basetime=None, callback=None, args=(), policy='skip'):
         from libs.utils.scheduler import Scheduler
-        return Scheduler(self._logger, interval=interval, basetime=basetime, callback=callback, args=args)
+        return Scheduler(self._logger, interval=interval, basetime=basetime, callback=callback, args=args, policy=policy)
 
     def ExecutionQueue(self, callback, args=(), exchange=None):
-        from collections import deque
-        exec_que = deque(maxlen=10000)
+        exec_que = (exchange or self.exchange).execution_info.deque(maxlen=10000)
         self._exec_que_list.append([exchange,exec_que])
         (exchange or self.exchange).execution_info.add_handler( exec_que=exec_que, handler=callback, args=args )
         return exec_que
 
+    # 約定履歴を列形式 (ExecutionBlock) で受け取るリーダー  reader.read() で未読分の配列を取得
+    def ExecutionReader(self, callback, args=(), exchange=None):
+        reader = (exchange or self.exchange).execution_info.reader()
+        (exchange or self.exchange).execution_info.add_handler( exec_que=reader, handler=callback, args=args )
+        return reader
+
     def AddBoardUpdateHandler(self, callback, args=(), exchange=None):
         (exchange or self.exchange).board_info.add_handler(callback, args)
 
@@ -115,6 +120,47 @@ class Strategy:
             self._logger.error( "Private websocket is not connected!" )
             return {'stat': -999, 'msg': "Private websocket is not connected!", 'ids': []}
 
+    # オーダーの変更 (変更APIのある取引所では同じIDのまま価格・数量を変更、無い取引所ではキャンセルと出し直しを同時に送信)
+    #   size は変更後の注文数量 (約定済みの分を含む)
+    async def amend_order(self, id, price=None, size=None, **kwargs):
+        if self.exchange.ws.connected:
+            return await self.exchange.amend_order(id=id, price=price, size=None if size is None else round(size,8),
+                                **dict(self._strategy_param.get('order',{}).get('option',{}), **kwargs))
+        else:
+            self._logger.error( "Private websocket is not connected!" )
+            return {'stat': -999, 'msg': "Private websocket is not connected!", 'ids': []}
+
+    # 発注済みオーダーの自動キャンセルまでの時間を延長 (省略時は発注オプションの auto_cancel_after 秒後)
+    #   出し直す代わりにそのまま置いておくオーダーを、出し直した場合と同じ時刻に自動キャンセルさせる
+    def refresh_expire(self, id, auto_cancel_after=None):
+        if auto_cancel_after is None :
+            auto_cancel_after = self._strategy_param.get('order',{}).get('option',{}).get('auto_cancel_after', 2592000)
+        return self.exchange.my.order.refresh_expire(id, auto_cancel_after)
+
+    # 複数の発注をまとめて送信 (一括発注に対応している取引所では1回のリクエストで送信)
+    async def sendorders(self, orders):
+        if self.exchange.ws.connected:
+            option = self._strategy_param.get('order',{}).get('option',{})
+            return await self.exchange.sendorders([dict(option, **dict(o, size=round(o['size'],8))) for o in orders])
+        else:
+            self._logger.error( "Private websocket is not connected!" )
+            return [{'stat': -999, 'msg': "Private websocket is not connected!", 'ids': []} for o in orders]
+
+    async def cancelorders(self, ids):
+        if self.exchange.ws.connected:
+            return await self.exchange.cancelorders(ids)
+        else:
+            self._logger.error( "Private websocket is not connected!" )
+            return [{'stat': -999, 'msg': "Private websocket is not connected!", 'ids': []} for id in ids]
+
+    # 全オーダーのキャンセル (取引所によっては手動や他のbotからのオーダーもキャンセルされる)
+    async def cancel_all(self, symbol=None):
+        if self.exchange.ws.connected:
+            return await self.exchange.cancel_all(symbol)
+        else:
+            self._logger.error( "Private websocket is not connected!" )
+            return {'stat': -999, 'msg': "Private websocket is not connected!", 'ids': []}
+
     async def close_position(self):
         if self.current_pos >= self.minimum_order_size:
             res = await self.sendorder(order_type='MARKET', side='SELL', size=self.current_pos)
@@ -141,6 +187,9 @@ class Strategy:
     def get_size_group(self, splitsize, limitprice=1000000, limitnum=5, startprice=0):
         return self.exchange.board_info.get_size_group(splitsize=splitsize, limitprice=limitprice, limitnum=limitnum, startprice=startprice)
 
+    def get_size_groups(self, splitsizes, limitprice=1000000, limitnum=5, startprice=0):
+        return self.exchange.board_info.get_size_groups(splitsizes=splitsizes, limitprice=limitprice, limitnum=limitnum, startprice=startprice)
+
     def get_price_group(self, splitprice):
         return self.exchange.board_info.get_price_group(splitprice=splitprice)
 
@@ -176,6 +225,15 @@ class Strategy:
     def bids(self):
         return self.exchange.board_info.bids
 
+    # [price, size] の NumPy 配列 (ベスト側が先頭)
+    @property
+    def asks_array(self):
+        return self.exchange.board_info.asks_array
+
+    @property
+    def bids_array(self):
+        return self.exchange.board_info.bids_array
+
     @property
     def mid_price(self):
         return self.exchange.board_info.mid
@@ -239,6 +297,9 @@ class Strategy:
     def get_historical_counter(self, sec):
         return self.exchange.my.order.historical_counter(sec)
 
+    def count_historical(self, name, value=1):
+        self.exchange.my.order.count_historical(name, value)
+
     @property
     def log_folder(self):
         return self._strategy_param['logging']['folder']
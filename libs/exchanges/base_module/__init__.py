@@ -3,8 +3,10 @@
 
 __all__ = ['MultiProc_WS',
            'RestAPIExchange',
+           'RateLimiter',
            'WebsocketExchange']
 
 from .multiproc import MultiProc_WS
 from .base_rest import RestAPIExchange
+from .rate_limiter import RateLimiter
 from .base_ws import WebsocketExchange
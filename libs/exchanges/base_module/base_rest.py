@@ -4,30 +4,45 @@
 import asyncio
 import time
 import traceback
+from .rate_limiter import RateLimiter
 
 class RestAPIExchange(object):
 
+    _symbol_option = 'symbol'      # sendorder でシンボルを指定する引数の名前
+
     def __init__(self):
 
         self.HttpAccessTime = time.time()
 
+        # APIリミットの管理 (バケットは各取引所クラスで登録する)
+        self.rate_limiter = RateLimiter(self._logger, self.__class__.__name__)
+        self.auto_cancel_delay = {'count':0, 'total':0.0, 'max':0.0}
+
         # 取引制限
         self._noTrade = False
         self.close_while_noTrade = False
         self._close_event = asyncio.Event()
 
     # 自動キャンセル実現のためのタスク
+    #   次の expire の時刻まで眠り、期限を過ぎたオーダーをまとめて (cancelorders で同時に) キャンセルする
     async def _cancel_task(self):
         while self._logger.running:
-            await asyncio.sleep(0.3)
+            order = self.my.order
+            # 次の expire まで待つ (より早い expire のオーダーが追加されたら起こされる)
+            order.expire_event.clear()
+            next_expire = order.next_expire()
+            timeout = 1.0 if next_expire is None else min(1.0, max(0.0, next_expire-time.time()))
+            if timeout>0 :
+                try:
+                    await asyncio.wait_for(order.expire_event.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
 
             # オーダーの自動キャンセル
             try:
-                cancel = [o for o in self.my.order.order_dict.items() if o[1]['expire']<time.time()]
-                for id,value in cancel:
-                    await self.cancelorder(id)
-                    self._logger.debug('        in orderlist : {}'.format(value))
-                    self._logger.info('        Cancel automatically : [{}]'.format(id))
+                expired = order.pop_expired(time.time())
+                if expired :
+                    asyncio.create_task(self._auto_cancel(expired))
             except Exception as e:
                 self._logger.error("Error occured at _cancel_thread: {}".format(e))
                 self._logger.info(traceback.format_exc())
@@ -37,6 +52,35 @@ class RestAPIExchange(object):
                 self._close_event.clear()
                 await self.close_position()
 
+    async def _auto_cancel(self, expired):
+        now = time.time()
+        for id, expire in expired:
+            # 期限からキャンセルを出すまでの遅れ
+            delay = now-expire
+            self.auto_cancel_delay['count'] += 1
+            self.auto_cancel_delay['total'] += delay
+            self.auto_cancel_delay['max'] = max(self.auto_cancel_delay['max'], delay)
+            self._logger.debug('        in orderlist : {}'.format(self.my.order.order_dict.get(id)))
+            self._logger.info('        Cancel automatically : [{}] ({:+.0f}ms)'.format(id, delay*1000))
+        try:
+            await self.cancelorders([id for id, expire in expired])
+        except Exception as e:
+            self._logger.error("Error occured at _auto_cancel: {}".format(e))
+            self._logger.info(traceback.format_exc())
+        finally:
+            # キャンセルできずに mark_as_invalidate されなかったオーダーは少し後に再度キャンセル
+            self.my.order.retry_expired(expired)
+
+    # APIリミットでの待ち時間と自動キャンセルの遅れ、発注中に保留したwebsocketイベントの数
+    def disp_api_stats(self):
+        self.rate_limiter.disp_stats()
+        d = self.auto_cancel_delay
+        if d['count'] :
+            self._logger.info( "    auto cancel delay  count:{:>7}  ave:{:8.1f}ms  max:{:8.1f}ms".format(d['count'], d['total']/d['count']*1000, d['max']*1000) )
+        p = self.my.order.pending_stats
+        if p['buffered'] :
+            self._logger.info( "    pending ws events  buffered:{}  replayed:{}  dropped:{}".format(p['buffered'], p['replayed'], p['dropped']) )
+
     @property
     def noTrade(self):
         return self._noTrade
@@ -63,3 +107,67 @@ class RestAPIExchange(object):
             res = await self.sendorder(order_type='MARKET', side='BUY', size=-current_pos)
             self.PendingUntil = max(self.PendingUntil, time.time()+30)
             return res
+
+    # 複数の発注 (一括発注のエンドポイントが無い取引所では sendorder を同時に呼び出す。送信間隔は rate_limiter で調整される)
+    async def sendorders(self, orders):
+        """
+        sendorders( [{'order_type':'LIMIT', 'side':'BUY', 'size':0.01, 'price':4800000, ...}, ...] )   # sendorder の引数の辞書のリスト
+
+        return: [ sendorder の戻り値, ... ]    # orders と同じ順番
+        """
+        return list(await asyncio.gather(*[self.sendorder(**o) for o in orders]))
+
+    # 複数のキャンセル (一括キャンセルのエンドポイントが無い取引所では cancelorder を同時に呼び出す)
+    async def cancelorders(self, ids):
+        """
+        cancelorders( [id, ...] )
+
+        return: [ cancelorder の戻り値, ... ]  # ids と同じ順番
+        """
+        return list(await asyncio.gather(*[self.cancelorder(id) for id in ids]))
+
+    # オーダーの変更 (変更APIの無い取引所ではキャンセルと出し直しを同時に送る)
+    async def amend_order(self, id, price=None, size=None, **kwargs):
+        """
+        amend_order( id,             # 変更するオーダーのID
+                     price=None,     # 変更後の価格 (省略時は変更しない)
+                     size=None,      # 変更後の注文数量 (約定済みの分を含む。省略時は変更しない)
+                     **kwargs )      # 出し直す場合の sendorder のオプション
+
+        return: { 'stat': エラーコード,      # 変更成功時 0
+                  'msg':  エラーメッセージ,
+                  'ids' : 変更後のオーダーIDのリスト  # 出し直した場合は新しいID
+                }
+        """
+        o = self.my.order.order_dict.get(id)
+        if o is None :
+            self._logger.info("ID:{} is already filled or canceld or expired".format(id) )
+            return {'stat': -999, 'msg': "Order is already filled or canceld or expired", 'ids': []}
+
+        # 出し直すのは未約定の残り (size を指定した場合は約定済みの分を引いた数量)
+        remain = o.remain if size is None else round(size-(o.size-o.remain),8)
+        if remain<=0 :
+            return dict(await self.cancelorder(id), ids=[])
+
+        kwargs.setdefault(self._symbol_option, o.get('symbol', self.symbol))
+        if 'expire' in o :
+            kwargs.setdefault('auto_cancel_after', max(1, min(2592000, o['expire']-time.time())))
+        cancel, res = await asyncio.gather(self.cancelorder(id),
+                                           self.sendorder(order_type='LIMIT', side=o.side, size=remain, price=o.price if price is None else price, **kwargs))
+        if cancel.get('stat')!=0 :
+            # 元のオーダーが約定済みなどでキャンセルできなかった場合は、出し直したオーダーもキャンセルして二重にポジションを持たないようにする
+            self._logger.error("Cancel failed [amend_order] : {}".format(cancel) )
+            if res.get('ids') :
+                await self.cancelorders(res['ids'])
+            return {'stat': cancel.get('stat') or -999, 'msg': cancel.get('msg'), 'ids': []}
+        return res
+
+    # 全オーダーのキャンセル (symbol を指定した場合はそのシンボルのオーダーだけ)
+    #   全キャンセルのエンドポイントが無い取引所ではオーダーリストにある自分のオーダーをキャンセルする
+    async def cancel_all(self, symbol=None):
+        ids = [id for id,o in self.my.order.order_dict.items() if symbol is None or o.get('symbol')==symbol]
+        results = await self.cancelorders(ids)
+        errors = [r for r in results if r.get('stat',-999)!=0]
+        if errors :
+            return {'stat': errors[0].get('stat',-999), 'msg': errors[0].get('msg'), 'ids': [id for id,r in zip(ids,results) if r.get('stat')==0]}
+        return {'stat': 0, 'msg': "", 'ids': ids}
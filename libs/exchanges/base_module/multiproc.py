@@ -11,6 +11,7 @@ import signal
 import traceback
 import pybotters
 import time
+from .shm_ring import ShmEventQueue
 from threading import Thread
 from logging import getLogger, StreamHandler, FileHandler, Formatter, INFO, DEBUG
 
@@ -22,6 +23,8 @@ class SubProc_WS():
         self._apis = argv['apis']
         self._send_json = argv.get('send_json')
         self._options = argv.get('options')
+        self._raw = argv.get('raw', False)
+        self._normalizer = argv.get('normalizer')
         self._subscribe_json = deque()
         self._connected = connected
         self._stop = proc_stop
@@ -54,7 +57,11 @@ class SubProc_WS():
             self._connected.value = False
             self._client = pybotters.Client(apis=self._apis)
             send_json = self._send_json
-            self.ws = await self._client.ws_connect(self._endpoint, send_json=send_json, hdlr_json=self._onmessage_handler, heartbeat=10.0, **self._options)
+            # 共有メモリ転送の場合は受信文字列をデコードせずにそのまま渡す
+            if self._raw :
+                self.ws = await self._client.ws_connect(self._endpoint, send_json=send_json, hdlr_str=self._onmessage_handler, heartbeat=10.0, **self._options)
+            else:
+                self.ws = await self._client.ws_connect(self._endpoint, send_json=send_json, hdlr_json=self._onmessage_handler, heartbeat=10.0, **self._options)
             self._put_event( ('pid', os.getpid()) )
             self._put_event(('logger.info', "websocket connect to  : {}".format(self._endpoint)))
             self._put_event(('logger.info', "subscribe : {}".format(send_json)))
@@ -88,9 +95,21 @@ class SubProc_WS():
         self._put_event(('logger.info', "websocket stopped"))
 
     async def _onmessage(self, msg, ws):
-        self._put_event(('msg', msg, time.time()))
+        recv_time = time.time()
+
+        # 取引所クラスのノーマライザが指定されていれば、このプロセス内で解析して数値化済みのレコードを送る
+        record = None
+        if self._normalizer :
+            try:
+                record = self._normalizer(msg)
+            except Exception:
+                self._put_event(('logger.error',traceback.format_exc()))
+        if record is not None :
+            self._put_event(('rec', record, recv_time))
+        else:
+            self._put_event(('msg', msg, recv_time))
         if self.logger :
-            self.logger.info("{}".format(msg.keys()))
+            self.logger.info("{}".format(msg[:100] if self._raw else msg.keys()))
 
         if self._subscribe_json:
             send_json = self._subscribe_json.popleft()
@@ -105,7 +124,7 @@ class ClientWebSocketResponse():
         dummy = True
 
 class MultiProc_WS():
-    def __init__(self, logger, exchange_name, handler, endpoint, apis, send_json, lock, disconnect_handler=None, **options ):
+    def __init__(self, logger, exchange_name, handler, endpoint, apis, send_json, lock, disconnect_handler=None, normalizer=None, record_handler=None, **options ):
         self._logger = logger
         self._exchange_name = exchange_name
         self._handler = handler
@@ -115,6 +134,10 @@ class MultiProc_WS():
         self._lock = lock
         self._disconnect_handler = disconnect_handler
         self._options = options
+
+        # ws_normalize が有効な場合はサブプロセスで normalizer を実行し、結果を record_handler で受け取る
+        self._normalizer = normalizer if getattr(self._logger, 'ws_normalize', False) and record_handler else None
+        self._record_handler = record_handler
         self.pid = None
         self._time_lag = deque(maxlen=100)
         self._stop = False
@@ -123,6 +146,10 @@ class MultiProc_WS():
         self._discord_queue = deque(maxlen=10)
         self.wdt = 0
 
+        # サブプロセスからのイベント転送方式 ('queue': multiprocessing.Queue / 'shm': 共有メモリリングバッファ)
+        self._transport = getattr(self._logger, 'ws_transport', 'queue')
+        self._shm_size = getattr(self._logger, 'ws_shm_size', 16)*1024*1024
+
     def _mean(self,q) : return sum(q) / (len(q) + 1e-7)
 
     async def _start_websocket(self, logging=False):
@@ -138,10 +165,16 @@ class MultiProc_WS():
 
             # キューの再作成
             if hasattr(self,'_event_queue') :
-                self._event_queue.put(('delete',))
+                if self._transport == 'shm' :
+                    self._event_queue.interrupt()
+                else:
+                    self._event_queue.put(('delete',))
                 while hasattr(self,'_event_queue') :
                     await asyncio.sleep(1)
-            self._event_queue = multiprocessing.Queue()
+            if self._transport == 'shm' :
+                self._event_queue = ShmEventQueue(capacity=self._shm_size)
+            else:
+                self._event_queue = multiprocessing.Queue()
             self._command_queue = multiprocessing.Queue()
             self._proc_stop = multiprocessing.Value(c_bool, False)
             self._connected = multiprocessing.Value(c_bool, False)
@@ -151,7 +184,9 @@ class MultiProc_WS():
                             endpoint=self._endpoint,
                             apis=self._apis,
                             send_json = self._send_json,
-                            options = self._options)
+                            options = self._options,
+                            normalizer = self._normalizer,
+                            raw = (self._transport == 'shm' and self._normalizer is None))
 
             if logging :
                 self._ws_logger = getLogger(__name__+self._exchange_name)
@@ -225,6 +260,15 @@ class MultiProc_WS():
                 if self.wdt<30 :
                     self.wdt = 0
 
+            # 受信プロセスで解析済みのレコード
+            elif data[0] == 'rec' :
+                self._logger.ws_timestamp = data[2]
+                self._time_lag.append(time.time()-data[2])
+                self._lock.wait()
+                self._record_handler(data[1],ws)
+                if self.wdt<30 :
+                    self.wdt = 0
+
             # 起動確認
             elif data[0] == 'pid' :
                 self.pid = int(data[1])
@@ -262,6 +306,7 @@ class MultiProc_WS():
                 self._logger.info( "[{}:websocket error] {}".format(self._exchange_name,data[1]) )
 
             elif data[0] == 'delete' :
+                self._event_queue.close()
                 del self._event_queue
 
             else :
@@ -271,6 +316,11 @@ class MultiProc_WS():
     def time_lag(self):
         return self._mean(self._time_lag)
 
+    # 共有メモリ転送時に読み出しが間に合わず捨てられたイベント数
+    @property
+    def overflow(self):
+        return self._event_queue.dropped if self._transport == 'shm' and hasattr(self,'_event_queue') else 0
+
     @property
     def connected(self):
         return self._connected.value
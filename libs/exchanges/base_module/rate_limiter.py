@@ -0,0 +1,249 @@
+# coding: utf-8
+#!/usr/bin/python3
+
+import asyncio
+import heapq
+import itertools
+import time
+
+# リクエストの種類(レーン)ごとの優先度 (小さいほど先に送信する)
+PRIORITY = {'cancel':0, 'amend':1, 'order':2, 'query':3, 'candle':4}
+
+# トークンバケット
+#   rate 個/秒 で補充され、最大 capacity 個まで貯まる
+#   reserve を指定すると、amend より優先度の低いレーンは残り reserve 個には手を付けない (キャンセル用に残しておく)
+class TokenBucket(object):
+    def __init__(self, rate, capacity, reserve=0):
+        self.rate = rate
+        self.capacity = capacity
+        self.reserve = reserve
+        self.tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._waiters = []       # [priority, seq, future, deadline] のヒープ
+        self._timer = None
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens+(now-self._updated)*self.rate)
+        self._updated = now
+
+    def _floor(self, priority):
+        return self.reserve if priority>PRIORITY['amend'] else 0
+
+    # count 個目のトークンが使えるようになるまでの秒数
+    def _time_to(self, priority, count=1):
+        return max(0.0, (self._floor(priority)+count-self.tokens)/self.rate)
+
+    # 自分より先に送信される待ちの数
+    def _ahead(self, priority):
+        return sum(1 for w in self._waiters if w[0]<=priority and not w[2].done())
+
+
+# 取引所ごとのAPIリミットを管理するクラス
+#   エンドポイントの種類ごとにトークンバケットを登録し (add_bucket)、リクエストの前に acquire() でトークンを取得する
+#   トークンが無い場合はレーンの優先度順に待たせる (cancel > amend > order > query > candle)
+#   timeout を指定すると、期限までに順番が回ってこないと見込まれる場合や期限を過ぎた場合は False を返す
+#   レスポンスヘッダの残り回数が分かる取引所では update() でトークン数を補正する
+class RateLimiter(object):
+    def __init__(self, logger, name=''):
+        self._logger = logger
+        self._name = name
+        self._buckets = {}
+        self._seq = itertools.count()
+        self.stats = {}          # (バケット名, レーン) : {'count', 'total', 'max', 'rejected'}
+
+    def add_bucket(self, bucket, rate, capacity, reserve=0):
+        self._buckets[bucket] = TokenBucket(rate, capacity, reserve)
+
+    def tokens(self, bucket):
+        b = self._buckets[bucket]
+        b._refill(time.monotonic())
+        return b.tokens
+
+    # レスポンスヘッダの残り回数 (上限 limit 回) をバケットの容量に換算して、実際の残りより多く見積もっていれば減らす
+    def update(self, bucket, remaining, limit=None):
+        b = self._buckets.get(bucket)
+        if b is None or remaining is None :
+            return
+        try:
+            remaining = float(remaining)
+        except (TypeError, ValueError):
+            return
+        b._refill(time.monotonic())
+        b.tokens = min(b.tokens, remaining*b.capacity/(limit or b.capacity))
+
+    async def acquire(self, buckets, lane='query', timeout=None):
+        """
+        acquire( buckets,        # バケット名 (複数のバケットを消費する場合はタプル)
+                 lane='query',   # 'cancel', 'amend', 'order', 'query', 'candle'
+                 timeout=None )  # 待つ最大秒数 (None の場合はトークンが取れるまで待つ)
+
+        return: トークンが取得できれば True
+        """
+        if isinstance(buckets, str) :
+            buckets = (buckets,)
+        start = time.monotonic()
+        deadline = start+timeout if timeout is not None else None
+        priority = PRIORITY[lane]
+
+        acquired = []
+        result = True
+        for name in buckets:
+            bucket = self._buckets.get(name)
+            if bucket is None :
+                continue
+            if not await self._acquire(bucket, priority, deadline) :
+                # 取得済みのトークンは戻しておく
+                for b in acquired:
+                    b.tokens = min(b.capacity, b.tokens+1)
+                result = False
+                break
+            acquired.append(bucket)
+
+        wait_time = time.monotonic()-start
+        stats = self.stats.setdefault(('+'.join(buckets), lane), {'count':0, 'total':0.0, 'max':0.0, 'rejected':0})
+        stats['count'] += 1
+        stats['total'] += wait_time
+        stats['max'] = max(stats['max'], wait_time)
+        if not result :
+            stats['rejected'] += 1
+        elif wait_time>0.1 :
+            self._logger.debug( "[{}] {} request waited {:.3f}sec ({})".format(self._name, lane, wait_time, '+'.join(buckets)) )
+        return result
+
+    async def _acquire(self, bucket, priority, deadline):
+        now = time.monotonic()
+        bucket._refill(now)
+        ahead = bucket._ahead(priority)
+        if ahead==0 and bucket.tokens-1>=bucket._floor(priority) :
+            bucket.tokens -= 1
+            return True
+
+        # 期限までに順番が回ってこない見込みであれば待たずに諦める
+        if deadline is not None and now+bucket._time_to(priority, ahead+1)>deadline :
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(bucket._waiters, [priority, next(self._seq), future, deadline])
+        self._schedule(bucket)
+        try:
+            return await future
+        finally:
+            if not future.done() :
+                future.cancel()
+
+    # 先頭の待ちにトークンが補充されるか、いずれかの待ちが期限切れになる時刻に _dispatch を呼ぶ
+    def _schedule(self, bucket):
+        if bucket._timer is not None :
+            bucket._timer.cancel()
+            bucket._timer = None
+        if not bucket._waiters :
+            return
+        now = time.monotonic()
+        delay = bucket._time_to(bucket._waiters[0][0])
+        deadlines = [w[3] for w in bucket._waiters if w[3] is not None]
+        if deadlines :
+            delay = min(delay, max(0.0, min(deadlines)-now))
+        bucket._timer = asyncio.get_running_loop().call_later(delay, self._dispatch, bucket)
+
+    def _dispatch(self, bucket):
+        bucket._timer = None
+        now = time.monotonic()
+        bucket._refill(now)
+
+        # キャンセルされた待ちと期限切れの待ちを外す
+        waiters = []
+        for w in bucket._waiters:
+            if w[2].done() :
+                continue
+            if w[3] is not None and w[3]<now :
+                w[2].set_result(False)
+                continue
+            waiters.append(w)
+        if len(waiters)!=len(bucket._waiters) :
+            heapq.heapify(waiters)
+            bucket._waiters = waiters
+
+        # 優先度順にトークンを割り当てる
+        while bucket._waiters and bucket.tokens-1>=bucket._floor(bucket._waiters[0][0]) :
+            w = heapq.heappop(bucket._waiters)
+            bucket.tokens -= 1
+            w[2].set_result(True)
+
+        self._schedule(bucket)
+
+    def disp_stats(self):
+        if not self.stats :
+            return
+        self._logger.info( "---------------------API rate limit ({})".format(self._name) )
+        for name, b in self._buckets.items():
+            b._refill(time.monotonic())
+            self._logger.info( "    {:<16} tokens:{:7.1f}/{:<5} waiting:{}".format(name, b.tokens, b.capacity, len(b._waiters)) )
+        for (buckets, lane), s in sorted(self.stats.items(), key=lambda x:(PRIORITY[x[0][1]], x[0][0])):
+            self._logger.info( "    {:<16} {:<7} count:{:>7}  ave:{:8.1f}ms  max:{:8.1f}ms  rejected:{}".format(
+                buckets, lane, s['count'], s['total']/s['count']*1000, s['max']*1000, s['rejected']) )
+
+
+# テストコード
+if __name__ == "__main__":
+    import random
+
+    class Logger(object):
+        def info(self, *args) : print(*args)
+        def debug(self, *args) : pass
+
+    async def main():
+        logger = Logger()
+
+        # 1秒に5回のバケットで、ローソク足の取得が溜まっている所にキャンセルが来た場合
+        limiter = RateLimiter(logger, 'test')
+        limiter.add_bucket('private', rate=5, capacity=5)
+        done = []
+        async def request(lane, i, timeout=None):
+            if await limiter.acquire('private', lane, timeout):
+                done.append((lane, i, time.monotonic()))
+        start = time.monotonic()
+        tasks = [asyncio.create_task(request('candle', i)) for i in range(20)]
+        await asyncio.sleep(0.3)
+        tasks.append(asyncio.create_task(request('cancel', 0)))
+        await asyncio.gather(*tasks)
+        cancel = [d for d in done if d[0]=='cancel'][0]
+        print( "cancel waited {:.3f}sec behind {} candle requests".format(cancel[2]-start-0.3, 20) )
+        assert cancel[2]-start-0.3 < 0.25
+        assert done[-1][2]-start > (20+1-5)/5-0.1
+
+        # 期限までに順番が回ってこない場合は待たずに False
+        limiter = RateLimiter(logger, 'deadline')
+        limiter.add_bucket('private', rate=2, capacity=2)
+        results = await asyncio.gather(*[limiter.acquire('private', 'order', timeout=1.2) for i in range(6)])
+        assert results.count(True)==4, results
+
+        # reserve は order からは使わず、cancel だけが使う
+        limiter = RateLimiter(logger, 'reserve')
+        limiter.add_bucket('private', rate=0.001, capacity=10, reserve=3)
+        assert [await limiter.acquire('private', 'order', timeout=0) for i in range(10)].count(True)==7
+        assert [await limiter.acquire('private', 'cancel', timeout=0) for i in range(10)].count(True)==3
+
+        # レスポンスヘッダでの補正 (上限500回のうち残り50回 → 容量10のバケットでは残り1回)
+        limiter = RateLimiter(logger, 'header')
+        limiter.add_bucket('private', rate=0.001, capacity=10)
+        limiter.update('private', 50, limit=500)
+        assert round(limiter.tokens('private'))==1
+
+        # 優先度がランダムなリクエストでも、送信レートが上限を超えない
+        limiter = RateLimiter(logger, 'random')
+        limiter.add_bucket('public', rate=20, capacity=10)
+        sent = []
+        async def rand_request():
+            await asyncio.sleep(random.random()*0.5)
+            if await limiter.acquire('public', random.choice(list(PRIORITY)), timeout=random.choice([None, 0.2, 1])):
+                sent.append(time.monotonic())
+        await asyncio.gather(*[rand_request() for i in range(100)])
+        sent.sort()
+        for i in range(len(sent)-10):
+            # 容量10 + 1秒あたり20回を超えない
+            window = [t for t in sent[i:] if t-sent[i]<=1.0]
+            assert len(window)<=10+20+1, len(window)
+        print( "sent {} of 100 random requests".format(len(sent)) )
+        limiter.disp_stats()
+
+    asyncio.run(main())
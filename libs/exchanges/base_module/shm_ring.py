@@ -0,0 +1,176 @@
+# coding: utf-8
+#!/usr/bin/python3
+
+from collections import deque
+import json
+import marshal
+import multiprocessing
+from multiprocessing import shared_memory
+import struct
+import time
+
+# SubProc_WS → MultiProc_WS 間のイベント転送用 共有メモリリングバッファ
+#   multiprocessing.Queue と同じ put()/get()/close() を持ち、MultiProc_WS からは差し替えて使用する
+#   書き込みはサブプロセス(1つ)、読み出しはメインプロセスの _main_loop スレッド(1つ)だけが行う (SPSC)
+#
+#   ヘッダ (64bytes)
+#      0: write_pos  書き込み済み位置 (単調増加, サブプロセスのみ更新)
+#      8: read_pos   読み出し済み位置 (単調増加, メインプロセスのみ更新)
+#     16: seq        書き込んだレコードの通番 (オーバーフローで捨てたものも含む)
+#     24: dropped    空き不足で捨てたレコード数
+#   レコード (8bytes境界)
+#      len(u32) seq(u64) timestamp(f64) kind(u8) payload(len bytes)
+#        payload は msg : 受信したJSON文字列 / rec : marshal形式のレコード / その他 : JSON配列
+class ShmEventQueue(object):
+
+    _HEADER_SIZE = 64
+    _REC = struct.Struct('<IQdB')
+    _WRAP = 0xFFFFFFFF     # バッファ末尾まで使わずに先頭へ戻る印
+
+    # イベント種別 (kind) のテーブル
+    _KINDS = ('msg', 'rec', 'wdt', 'status_change', 'pid',
+              'logger.trace', 'logger.debug', 'logger.info', 'logger.warning', 'logger.error')
+    _KIND_ID = {k:i for i,k in enumerate(_KINDS)}
+
+    def __init__(self, capacity=16*1024*1024):
+        self._capacity = (capacity+7)//8*8
+        self._shm = shared_memory.SharedMemory(create=True, size=self._HEADER_SIZE+self._capacity)
+        self._shm.buf[:self._HEADER_SIZE] = bytes(self._HEADER_SIZE)
+        self._ready = multiprocessing.Event()
+        self._owner = True
+        self._attach()
+
+    def _attach(self):
+        self._buf = self._shm.buf
+        self._next_seq = self._get(16)+1
+        self._local = deque()
+        self._closing = False
+        self.lost = 0     # 読み出し側で検出した通番の欠落数
+
+    # spawn で起動された場合にもサブプロセス側で同じ共有メモリへアタッチする
+    def __getstate__(self):
+        return {'name':self._shm.name, 'capacity':self._capacity, 'ready':self._ready}
+
+    def __setstate__(self, state):
+        self._capacity = state['capacity']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._ready = state['ready']
+        self._owner = False
+        self._attach()
+
+    def _get(self, offset):
+        return struct.unpack_from('<Q', self._buf, offset)[0]
+
+    def _set(self, offset, value):
+        struct.pack_into('<Q', self._buf, offset, value)
+
+    @property
+    def dropped(self):
+        return self._get(24)
+
+    # ---------------------------------------書き込み側 (SubProc_WS)
+    def put(self, d):
+        kind = d[0] if d[0] in self._KIND_ID else 'logger.info'
+        if d[0] == 'msg' :
+            payload = d[1] if type(d[1])==bytes else (d[1].encode() if type(d[1])==str else json.dumps(d[1]).encode())
+            ts = d[2]
+        elif d[0] == 'rec' :
+            payload = marshal.dumps(d[1])
+            ts = d[2]
+        elif kind == d[0] :
+            payload = json.dumps(d[1:]).encode()
+            ts = time.time()
+        else:
+            # テーブルに無いイベントはそのままログへ回す
+            payload = json.dumps(["unknown event : {}".format(d)]).encode()
+            ts = time.time()
+        return self._put(self._KIND_ID[kind], payload, ts)
+
+    def _put(self, kind_id, payload, ts):
+        seq = self._get(16)+1
+        self._set(16, seq)
+
+        size = (self._REC.size+len(payload)+7)//8*8
+        write_pos = self._get(0)
+        offset = write_pos % self._capacity
+        tail = self._capacity-offset
+        need = size+(tail if tail<size else 0)
+
+        # 読み出しが追いついていない場合は捨てて件数だけ記録 (読み出し側は通番の欠落で検出)
+        if size>self._capacity//2 or need > self._capacity-(write_pos-self._get(8)) :
+            self._set(24, self._get(24)+1)
+            return False
+
+        if tail<size :
+            struct.pack_into('<I', self._buf, self._HEADER_SIZE+offset, self._WRAP)
+            write_pos += tail
+            offset = 0
+
+        base = self._HEADER_SIZE+offset
+        self._REC.pack_into(self._buf, base, len(payload), seq, ts, kind_id)
+        self._buf[base+self._REC.size:base+self._REC.size+len(payload)] = payload
+
+        # レコードを書き終えてから書き込み位置を公開する
+        self._set(0, write_pos+size)
+        self._ready.set()
+        return True
+
+    # ---------------------------------------読み出し側 (MultiProc_WS._main_loop)
+    def _read(self):
+        read_pos = self._get(8)
+        if read_pos == self._get(0) :
+            return False
+
+        offset = read_pos % self._capacity
+        if struct.unpack_from('<I', self._buf, self._HEADER_SIZE+offset)[0]==self._WRAP :
+            read_pos += self._capacity-offset
+            offset = 0
+
+        base = self._HEADER_SIZE+offset
+        length, seq, ts, kind_id = self._REC.unpack_from(self._buf, base)
+        payload = bytes(self._buf[base+self._REC.size:base+self._REC.size+length])
+        self._set(8, read_pos+(self._REC.size+length+7)//8*8)
+
+        # 通番が飛んでいれば書き込み側でオーバーフローが発生している
+        if seq != self._next_seq :
+            self.lost += seq-self._next_seq
+            self._local.append(('logger.warning', "shared memory ring overflow : {} events lost (total {})".format(seq-self._next_seq, self.lost)))
+        self._next_seq = seq+1
+
+        kind = self._KINDS[kind_id]
+        if kind == 'msg' :
+            self._local.append(('msg', json.loads(payload), ts))
+        elif kind == 'rec' :
+            self._local.append(('rec', marshal.loads(payload), ts))
+        else:
+            self._local.append((kind,)+tuple(json.loads(payload)))
+        return True
+
+    def get(self):
+        while True:
+            if self._local :
+                return self._local.popleft()
+            if self._read() :
+                continue
+            if self._closing :
+                return ('delete',)
+
+            # 書き込み通知を待つ (clear後に再確認してから待つことで通知の取りこぼしを防ぐ)
+            self._ready.clear()
+            if self._get(8) != self._get(0) or self._closing :
+                continue
+            self._ready.wait(1)
+
+    # 読み出しスレッドに ('delete',) を返させる (Queue へ ('delete',) を put するのと同じ役割)
+    def interrupt(self):
+        self._closing = True
+        self._ready.set()
+
+    def close(self):
+        self._buf = None
+        try:
+            self._shm.close()
+            if self._owner :
+                self._shm.unlink()
+        except Exception:
+            pass
@@ -8,16 +8,16 @@ import traceback
 import pandas as pd
 
 import pybotters
-from pybotters.store import DataStore
 
-from libs.utils import TimeConv, Scheduler, LockCounter
+from libs.utils import TimeConv, Scheduler, LockCounter, KlineStore
+from libs.utils.time_conv import utcstr_to_ns
 from libs.market import *
 from libs.exchanges.base_module import MultiProc_WS, RestAPIExchange, WebsocketExchange
 from libs.account import AccountInfo, OpenPositionFIFO
 
 # https://lightning.bitflyer.com/docs?lang=ja
 
-class Kline(DataStore):
+class Kline(KlineStore):
     _KEYS = ['symbol', 'interval', 'timestamp']
     _MAXLEN = 5000000
 
@@ -29,8 +29,33 @@ class Kline(DataStore):
                        'volume':item[5], 'ask_volume':item[6], 'bid_volume':item[7], 'sell_volume':item[8], 'buy_volume':item[9]}
                        for item in message.get('kline',[])])
 
+# websocket受信プロセス内で実行するメッセージの前処理 (ws_normalize: true の場合)
+#   約定 : ('executions', channel, [(ts_ns, price, size, side, id), ...])
+#   板   : ('board', channel, ask_prices, ask_sizes, bid_prices, bid_sizes)
+#   それ以外は None を返して従来通り辞書のまま転送する
+def normalize_message(msg):
+    params = msg.get('params')
+    if not params :
+        return None
+    channel = params.get('channel','')
+    message = params.get('message')
+
+    if channel.startswith('lightning_executions_') :
+        return ('executions', channel, [(utcstr_to_ns(i['exec_date']), i['price'], i['size'], i['side'],
+                                         i['buy_child_order_acceptance_id']+'='+i['sell_child_order_acceptance_id']) for i in message])
+
+    if channel.startswith('lightning_board_') :
+        asks = message.get('asks',[])
+        bids = message.get('bids',[])
+        return ('board', channel, [float(i['price']) for i in asks], [float(i['size']) for i in asks],
+                                  [float(i['price']) for i in bids], [float(i['size']) for i in bids])
+
+    return None
+
 class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, WebsocketExchange):
 
+    _symbol_option = 'product_code'
+
     # シンボルごとの価格呼び値（BTCなど指定のない物は1）
     _price_unit_dict = {'XRP_JPY':0.01, 'XLM_JPY':0.001, 'MONA_JPY':0.001, 'ETH_BTC':0.00001, 'BCH_BTC':0.00001 }
     def round_order_price(self, price, symbol=None):
@@ -62,7 +87,6 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
         self._client = pybotters.Client(apis={self.exchange_name: [apikey[0],apikey[1]]})
         self._candle_api_lock = asyncio.Lock()
         self._datastore_lock = LockCounter(self._logger, self.__class__.__name__)
-        self._order_dict_lock = LockCounter(self._logger, "order_dict")
         self._candle_subscribed = {}
         super().__init__()
         self.create_candle_class('candle')
@@ -76,6 +100,12 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
         RestAPIExchange.__init__(self)
         WebsocketExchange.__init__(self)
 
+        # 5分間に500回 (IPごとにも500回)、発注系は5分間に300回
+        # 新規オーダーは残り50回になったら出さずに、キャンセル用に残しておく
+        self.rate_limiter.add_bucket('private', rate=500/300, capacity=500, reserve=50)
+        self.rate_limiter.add_bucket('order', rate=300/300, capacity=300, reserve=50)
+        self.rate_limiter.add_bucket('public', rate=500/300, capacity=500)
+
         # 定期的にpublucAPIへアクセスしてIPごとのアクセス制限をチェック
         self.server_health='NONE'
         self._logger.call_every1sec.append({'name':'check_server_status', 'handler':self._check_server_status, 'interval':10, 'counter':0})
@@ -88,15 +118,19 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
         self.XRateLimitReset = int(r.headers.get('X-RateLimit-Reset',self.XRateLimitReset))
         self.OrderRequestRateLimitRemaining = int(r.headers.get('X-OrderRequest-RateLimit-Remaining',self.OrderRequestRateLimitRemaining))
         self.OrderRequestRateLimitReset = int(r.headers.get('X-OrderRequest-RateLimit-Reset',self.OrderRequestRateLimitReset))
+        self.rate_limiter.update('private', r.headers.get('X-RateLimit-Remaining'), limit=500)
+        self.rate_limiter.update('order', r.headers.get('X-OrderRequest-RateLimit-Remaining'), limit=300)
 
     def _update_public_limit(self,r):
         if r.status != 200 :
             self._logger.error( "{}: {}".format(r.status, r.reason) )
         self.RateLimitRemainingPerIP = int(r.headers.get('X-RateLimit-Remaining',self.RateLimitRemaining))
         self.XRateLimitResetPerIP = int(r.headers.get('X-RateLimit-Reset',self.XRateLimitReset))
+        self.rate_limiter.update('public', r.headers.get('X-RateLimit-Remaining'), limit=500)
 
     async def _check_server_status(self):
         try:
+            await self.rate_limiter.acquire('public', 'query')
             res = await self._client.get('https://api.bitflyer.com/v1/gethealth')
             self._update_public_limit(res)
             data = await res.json()
@@ -150,7 +184,10 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
         self.my = AccountInfo(self._logger, OpenPositionFIFO)
 
         # データ保存用クラス
-        self.board_info = BoardInfo( self._logger )
+        if getattr(self._logger, 'board_engine', 'dict')=='array' :
+            self.board_info = BoardInfoArray( self._logger, tick_size=self._price_unit_dict.get(self.symbol,1) )
+        else:
+            self.board_info = BoardInfo( self._logger )
         self.execution_info = ExecuionInfo( self._logger )
         self.execution_info.spot_last = 0
         self.ticker_info = TickerInfo()
@@ -159,18 +196,19 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
 
         # 指定のチャンネルの購読
         self._handler = {'None':None}
+        self._rec_handler = {}
         self._ws_args = []
         if self._param.get('execution', True) :
-            self._subscribe(topic=f"lightning_executions_{self.symbol}", handler=self._on_executions)
+            self._subscribe(topic=f"lightning_executions_{self.symbol}", handler=self._on_executions, rec_handler=self._on_executions_rec)
             if self.symbol=='FX_BTC_JPY':  # SFD算出用に現物も購読する
-                self._subscribe(topic="lightning_executions_BTC_JPY", handler=self._on_spot_executions)
+                self._subscribe(topic="lightning_executions_BTC_JPY", handler=self._on_spot_executions, rec_handler=self._on_spot_executions_rec)
 
         if self._param.get('ticker', False) :
             self._subscribe(topic=f"lightning_ticker_{self.symbol}", handler=self._on_ticker)
 
         if self._param.get('board', False) :
-            self._subscribe(topic=f"lightning_board_snapshot_{self.symbol}", handler=self._on_board_snapshot)
-            self._subscribe(topic=f"lightning_board_{self.symbol}", handler=self._on_board)
+            self._subscribe(topic=f"lightning_board_snapshot_{self.symbol}", handler=self._on_board_snapshot, rec_handler=self._on_board_snapshot_rec)
+            self._subscribe(topic=f"lightning_board_{self.symbol}", handler=self._on_board, rec_handler=self._on_board_rec)
 
         if self.auth :
             self._subscribe(topic=f"child_order_events", handler=self._on_child_order_events)
@@ -184,6 +222,8 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
                       send_json = self._ws_args,
                       lock = self._datastore_lock,
                       disconnect_handler = self._disconnected,
+                      normalizer = normalize_message,
+                      record_handler = self._onrecord,
                       **options )
         asyncio.create_task(self.ws._start_websocket(logging=False), name="bitflyer_websocket")
 
@@ -205,9 +245,11 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
 
         return self
 
-    def _subscribe(self, topic, handler):
+    def _subscribe(self, topic, handler, rec_handler=None):
         self._logger.debug( "subscribe : {}".format(topic) )
         self._handler[topic]=handler
+        if rec_handler :
+            self._rec_handler[topic]=rec_handler
         self._ws_args.append({"method": "subscribe", "params": {"channel": topic}})
 
     # メッセージハンドラ
@@ -227,12 +269,45 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
         else:
             super()._onmessage(msg,ws)
 
+    # 受信プロセスで解析済みのレコードのハンドラ (ws_normalize: true の場合)
+    def _onrecord(self, rec, ws):
+        self._logger.debug("recv bitFlyer record [{}]".format(rec[1]))
+        channel_handler = self._rec_handler.get(rec[1])
+        if channel_handler != None:
+            channel_handler(rec)
+
+    def _on_executions_rec(self, rec):
+        executions = rec[2]
+        self.execution_info.time = self._ns_to_dt(executions[-1][0])
+        self.execution_info.append_latency(time.time()*1000 - executions[-1][0]/1000000)
+        for ts, price, size, side, id in executions:
+            self.execution_info.append_execution_ns(price, size, side, ts, id)
+        self.my.position.ref_ltp = self.execution_info.last
+        self.execution_info._event.set()
+
+    def _on_spot_executions_rec(self, rec):
+        if rec[2] :
+            self.execution_info.spot_last = rec[2][-1][1]
+
+    def _on_board_snapshot_rec(self, rec):
+        self.board_info.initialize_dict()
+        self._on_board_rec(rec)
+
+    def _on_board_rec(self, rec):
+        self.board_info.time = self._jst_now_dt()
+        self.board_info.update_asks_array(rec[2], rec[3])
+        self.board_info.update_bids_array(rec[4], rec[5])
+        self.board_info.event.set()
+        for event in self.board._events:
+            event.set()
+
     def _on_executions(self, params):
         message = params.get("message")
-        self.execution_info.time = self._utcstr_to_dt(message[-1]['exec_date'])
-        self.execution_info.append_latency((self._jst_now_dt().timestamp() - self.execution_info.time.timestamp())*1000)
+        timestamp = self._utcstr_to_ns(message[-1]['exec_date'])
+        self.execution_info.time = self._ns_to_dt(timestamp)
+        self.execution_info.append_latency(time.time()*1000 - timestamp/1000000)
         for i in message:
-            self.execution_info.append_execution(i['price'],i['size'],i['side'],self._utcstr_to_dt(i['exec_date']),i["buy_child_order_acceptance_id"]+'='+i["sell_child_order_acceptance_id"])
+            self.execution_info.append_execution_ns(i['price'],i['size'],i['side'],self._utcstr_to_ns(i['exec_date']),i["buy_child_order_acceptance_id"]+'='+i["sell_child_order_acceptance_id"])
         self.my.position.ref_ltp = self.execution_info.last
         self.execution_info._event.set()
 
@@ -276,38 +351,40 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
         """
         self._logger.debug("_on_my_orders={}".format(message))
 
-        self._order_dict_lock.wait()
-        datas = message.get('message',[])
-        for d in datas:
-            self._logger.trace( self.__class__.__name__ + " : "+d['event_type']+" : " + str(d) )
-            id = d['child_order_acceptance_id']
+        # 発注中でまだ登録されていない注文のイベントは new_order で登録されるまで保留される
+        for d in message.get('message',[]):
+            self.my.order.apply(d['child_order_acceptance_id'], self._on_child_order_event, d)
 
-            if d['event_type']=='ORDER' :
-                if self.my.order.update_order( id, side=d['side'], price=d['price'], size=d['size'] ) :
-                    self._logger.debug( self.__class__.__name__ + " : ORDER : " + str(d) )
+    def _on_child_order_event(self,d):
+        self._logger.trace( self.__class__.__name__ + " : "+d['event_type']+" : " + str(d) )
+        id = d['child_order_acceptance_id']
 
-            elif d['event_type']=='EXECUTION' :
-                self._logger.debug( self.__class__.__name__ + " : EXECUTION : " + str(d) )
-                if self.my.order.executed( id, side=d['side'], price=d['price'], size=d['size'], remain=d['outstanding_size'] ) :
-                    self.my.position.executed( id=id, side=d['side'], price=d['price'], size=d['size'], commission=d['sfd'] )
+        if d['event_type']=='ORDER' :
+            if self.my.order.update_order( id, side=d['side'], price=d['price'], size=d['size'] ) :
+                self._logger.debug( self.__class__.__name__ + " : ORDER : " + str(d) )
 
-            elif d['event_type']=='EXPIRE' :
-                if self.my.order.remove_order( id ) :
-                    self._logger.debug( self.__class__.__name__ + " : EXPIRE : " + str(d) )
+        elif d['event_type']=='EXECUTION' :
+            self._logger.debug( self.__class__.__name__ + " : EXECUTION : " + str(d) )
+            if self.my.order.executed( id, side=d['side'], price=d['price'], size=d['size'], remain=d['outstanding_size'] ) :
+                self.my.position.executed( id=id, side=d['side'], price=d['price'], size=d['size'], commission=d['sfd'] )
 
-            elif d['event_type']=='CANCEL' :
-                if self.my.order.remove_order( id ) :
-                    self._logger.debug( self.__class__.__name__ + " : CANCEL : " + str(d) )
+        elif d['event_type']=='EXPIRE' :
+            if self.my.order.remove_order( id ) :
+                self._logger.debug( self.__class__.__name__ + " : EXPIRE : " + str(d) )
 
-            elif d['event_type']=='CANCEL_FAILED' :
-                if self.my.order.is_myorder( id ) :
-                    self._logger.debug( self.__class__.__name__ + " : CANCEL_FAILED : " + str(d) )
+        elif d['event_type']=='CANCEL' :
+            if self.my.order.remove_order( id ) :
+                self._logger.debug( self.__class__.__name__ + " : CANCEL : " + str(d) )
 
-            elif d['event_type']=='ORDER_FAILED' :
-                if self.my.order.is_myorder( id ) :
-                    self._logger.debug( self.__class__.__name__ + " : ORDER_FAILED : " + str(d) )
-            else:
-                self._logger.debug( self.__class__.__name__ + " : UNKNOWN : " + str(d) )
+        elif d['event_type']=='CANCEL_FAILED' :
+            if self.my.order.is_myorder( id ) :
+                self._logger.debug( self.__class__.__name__ + " : CANCEL_FAILED : " + str(d) )
+
+        elif d['event_type']=='ORDER_FAILED' :
+            if self.my.order.is_myorder( id ) :
+                self._logger.debug( self.__class__.__name__ + " : ORDER_FAILED : " + str(d) )
+        else:
+            self._logger.debug( self.__class__.__name__ + " : UNKNOWN : " + str(d) )
 
     # APIからのローソク足取得
     async def get_candles( self, timeframe, num_of_candle=500, symbol=None, since=None, need_result=True ):
@@ -474,6 +551,7 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
     # APIからTickerを取得
     async def ticker_api(self, **kwrgs):
         try:
+            await self.rate_limiter.acquire('public', 'candle')
             res = await self._client.get('https://api.bitflyer.com/v1/ticker', params={'product_code': kwrgs.get('symbol', self.symbol)})
             self._update_public_limit(res)
             data = await res.json()
@@ -489,6 +567,7 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
             symbol = kwrgs.get('symbol', self.symbol)
             if symbol == 'FX_BTC_JPY' or symbol.startswith('BTCJPY'):
                 # 証拠金取引の場合（FXかまたは先物の場合）
+                await self.rate_limiter.acquire('private', 'query')
                 res = await self._client.get('https://api.bitflyer.com/v1/me/getpositions', params={'product_code': symbol})
                 self._update_private_limit(res)
                 data = await res.json()
@@ -507,6 +586,7 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
     # 現物口座の残高 (JPY)
     async def getbalance(self):
         try:
+            await self.rate_limiter.acquire('private', 'query')
             res = await self._client.get('https://api.bitflyer.com/v1/me/getbalance')
             self._update_private_limit(res)
             data = await res.json()
@@ -528,12 +608,14 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
         try:
             if self.symbol == 'FX_BTC_JPY' or self.symbol.startswith('BTCJPY'):
                 if coin=='ALL' :
+                    await self.rate_limiter.acquire('private', 'query')
                     r = await self._client.get('https://api.bitflyer.com/v1/me/getcollateralaccounts')
                     self._update_private_limit(r)
                     res = await r.json()
                     collateral = float(res[0]['amount'])+float(res[1]['amount'])*0.5*self.ticker(symbol='BTC_JPY')['ltp']
                     return {'stat': 0, 'collateral': collateral, 'msg': res}
                 else:
+                    await self.rate_limiter.acquire('private', 'query')
                     r = await self._client.get('https://api.bitflyer.com/v1/me/getcollateral')
                     self._update_private_limit(r)
                     res = await r.json()
@@ -581,14 +663,6 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
             self._logger.info("No trade period" )
             return {'stat': -999, 'msg': "No trade period", 'ids': []}
 
-        if self.RateLimitRemaining<50 and time.time()<self.XRateLimitReset:
-            self._logger.info("RateLimitRemaining : {}/500".format(self.RateLimitRemaining) )
-            return {'stat': -999, 'msg': "RateLimitRemaining "+str(self.RateLimitRemaining)+"/500", 'ids': []}
-
-        if self.OrderRequestRateLimitRemaining<50 and time.time()<self.OrderRequestRateLimitReset:
-            self._logger.info("OrderRequestRateLimitRemaining : {}/300".format(self.OrderRequestRateLimitRemaining) )
-            return {'stat': -999, 'msg': "OrderRequestRateLimitRemaining "+str(self.OrderRequestRateLimitRemaining)+"/300", 'ids': []}
-
         if self.PendingUntil > time.time() :
             self._logger.info("Order pending : {:.1f}sec".format(self.PendingUntil-time.time()) )
             return {'stat': -999, 'msg': "Order pending : {:.1f}sec".format(self.PendingUntil-time.time()), 'ids': []}
@@ -619,9 +693,15 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
         if params['size']<self.minimum_order_size(symbol=params['product_code']) :
             return {'stat': -153, 'msg': '最低取引数量を満たしていません', 'ids': []}
 
+        # 1秒以内に送信できなければオーダーしない
+        if not await self.rate_limiter.acquire(('private','order'), 'order', timeout=1) :
+            self._logger.info("RateLimitRemaining : {:.0f}/500  OrderRequestRateLimitRemaining : {:.0f}/300".format(
+                self.rate_limiter.tokens('private'), self.rate_limiter.tokens('order')) )
+            return {'stat': -999, 'msg': "RateLimitRemaining", 'ids': []}
+
         self._logger.debug("[sendorder] : {}".format(params) )
 
-        with self._order_dict_lock :
+        with self.my.order.sending() :
             try :
                 r = await self._client.post('https://api.bitflyer.com/v1/me/sendchildorder', data=params)
                 self._update_private_limit(r)
@@ -659,14 +739,6 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
 #            self._logger.info("ID:{} is already filled or canceld or expired".format(id) )
 #            return {'stat':-999 , 'msg':"Order is already filled or canceld or expired"}
 
-        if self.api_remain1<50 :
-            self._logger.info("LimitRemaining : {}".format(self.api_remain1) )
-            return {'stat': -999, 'msg': 'LimitRemaining(api_remain1) '+str(self.api_remain1)+'/500'}
-
-        if self.api_remain3<50 :
-            self._logger.info("OrderLimitRemaining(api_remain3) : {}/500".format(self.api_remain3) )
-            return {'stat': -999, 'msg': "LimitRemaining(api_remain3) "+str(self.api_remain3)+"/300"}
-
         kwargs['child_order_acceptance_id']=id
 
         self._logger.debug("[cancelorder] : {}".format(kwargs) )
@@ -675,6 +747,8 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
         self.my.order.mark_as_invalidate( id )
 
         try :
+            # キャンセルは残しておいた50回も使って最優先で送信する
+            await self.rate_limiter.acquire(('private','order'), 'cancel')
             r = await self._client.post('https://api.bitflyer.com/v1/me/cancelchildorder', data=kwargs)
             self._update_private_limit(r)
             res = await r.text()
@@ -688,3 +762,36 @@ class Bitflyer(pybotters.bitFlyerDataStore, TimeConv, RestAPIExchange, Websocket
             return {'stat':res.get('status') , 'msg':res.get('error_message')}
 
         return {'stat': 0, 'msg': ""}
+
+    # 全キャンセル (取引所側のオーダーを全てキャンセルするので、手動や他のbotからのオーダーもキャンセルされる)
+    async def cancel_all(self, symbol=None):
+        """
+        cancel_all( symbol="FX_BTC_JPY" )     # 省略時には起動時に指定した symbol が選択されます
+
+        return: { 'stat': エラーコード,      # キャンセル成功時 0
+                  'msg':  エラーメッセージ,
+                  'ids':  キャンセルしたオーダーリスト内のオーダーIDのリスト,
+                }
+        """
+
+        product_code = symbol or self.symbol
+        ids = [id for id,o in self.my.order.order_dict.items() if o.get('symbol')==product_code]
+        self._logger.debug("[cancel_all] : {}".format(product_code) )
+
+        self.my.order.mark_as_invalidate_all( ids )
+
+        try :
+            await self.rate_limiter.acquire(('private','order'), 'cancel')
+            r = await self._client.post('https://api.bitflyer.com/v1/me/cancelallchildorders', data={'product_code': product_code})
+            self._update_private_limit(r)
+            res = await r.text()
+        except Exception as e:
+            self._logger.error(traceback.format_exc())
+            return {'stat': -999, 'msg': str(e), 'ids': []}
+
+        if res :
+            res = await r.json()
+            self._logger.error("Error response [cancel_all] : {}".format(res) )
+            return {'stat':res.get('status') , 'msg':res.get('error_message'), 'ids': []}
+
+        return {'stat': 0, 'msg': "", 'ids': ids}
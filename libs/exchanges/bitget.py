@@ -2,17 +2,15 @@
 #!/usr/bin/python3
 
 import asyncio
-from collections import deque
 from datetime import datetime, timedelta, timezone
 import time
 import traceback
+import uuid
 import pandas as pd
-import random
 
 
 import pybotters
-from pybotters.store import DataStore
-from libs.utils import TimeConv, LockCounter
+from libs.utils import TimeConv, LockCounter, KlineStore
 from libs.market import *
 from libs.exchanges.base_module import MultiProc_WS, RestAPIExchange, WebsocketExchange
 from libs.account import AccountInfo, OpenPositionKeepAve, OpenPositionKeepAveLinear
@@ -21,7 +19,7 @@ from libs.account import AccountInfo, OpenPositionKeepAve, OpenPositionKeepAveLi
 # https://github.com/BitgetLimited/v3-bitget-api-sdk
 
 
-class Kline(DataStore):
+class Kline(KlineStore):
     _KEYS = ['symbol', 'interval', 'timestamp']
     _MAXLEN = 1000000
 
@@ -63,74 +61,50 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
         self._client = pybotters.Client(apis={self.exchange_name: [apikey[0],apikey[1],apikey[2]]}, base_url=self._api_url)
         self._candle_api_lock = asyncio.Lock()
         self._datastore_lock = LockCounter(self._logger, self.__class__.__name__)
-        self._order_dict_lock = LockCounter(self._logger, "order_dict")
         self._candle_subscribed = []
         super().__init__()
 
         self.PendingUntil = time.time()
         self.RateLimitRemaining_private = 10
         self.RateLimitRemaining_public = 20
-        self._request_count_private = deque(maxlen=5)
-        self._request_count_public = deque(maxlen=10)
+        self._last_private_request = 0
+        self._last_public_request = 0
 
         RestAPIExchange.__init__(self)
         WebsocketExchange.__init__(self)
 
+        # privateは1秒に5回 (残り1回はキャンセル用に残す)、publicは1秒に10回
+        self.rate_limiter.add_bucket('private', rate=5, capacity=5, reserve=1)
+        self.rate_limiter.add_bucket('public', rate=10, capacity=10)
+
     # APIリミットの管理
     def _update_public_limit(self,r):
         if r.status != 200 :
             self._logger.error( "{}: {}".format(r.status, r.reason) )
         self.RateLimitRemaining_public = int(r.headers.get('X-RateLimit-Remaining',self.RateLimitRemaining_public))
+        self.rate_limiter.update('public', r.headers.get('X-RateLimit-Remaining'), limit=20)
 
-    async def check_public_request_limit(self, id=None):
-        # 前回オーダーから3秒以上経っていたらカウンターを初期化
-        if len(self._request_count_public)!=0 :
-            if time.time()-list(self._request_count_public)[-1]>3 :
-                self.RateLimitRemaining_public = 20
-
-        if len(self._request_count_public)<10 :        # 10回
-            # 今回の時間を追加
-            self._request_count_public.append(time.time())
-            return
-
-        w = list(self._request_count_public)[0]+1-time.time()                            # 1秒あたり
-        while w>0:
-            w += random.random()
-            self._logger.info( "public request sleep : {:.3f}".format(w, id) )
-            await asyncio.sleep(w)
-            w = list(self._request_count_public)[0]+1-time.time()                        # 1秒あたり
-
-        # 今回の時間を追加
-        self._request_count_public.append(time.time())
-        return
+    async def check_public_request_limit(self, lane='query', timeout=None):
+        # 前回のリクエストから3秒以上経っていたらカウンターを初期化
+        if time.time()-self._last_public_request>3 :
+            self.RateLimitRemaining_public = 20
+        result = await self.rate_limiter.acquire('public', lane, timeout)
+        self._last_public_request = time.time()
+        return result
 
     def _update_private_limit(self,r):
         if r.status != 200 :
             self._logger.error( "{}: {}".format(r.status, r.reason) )
         self.RateLimitRemaining_private = int(r.headers.get('X-RateLimit-Remaining',self.RateLimitRemaining_private))
+        self.rate_limiter.update('private', r.headers.get('X-RateLimit-Remaining'), limit=10)
 
-    async def check_private_request_limit(self, id=None):
-        self._logger.debug( "private deque : {}".format(self._request_count_private) )
-        # 前回オーダーから3秒以上経っていたらカウンターを初期化
-        if len(self._request_count_private)!=0 :
-            if time.time()-list(self._request_count_private)[-1]>3 :
-                self.RateLimitRemaining_private = 10
-
-        if len(self._request_count_private)<5 :        # 5回
-            # 今回の時間を追加
-            self._request_count_private.append(time.time())
-            return
-
-        w = list(self._request_count_private)[0]+1-time.time()                            # 1秒あたり
-        while w>0:
-            w += random.random()
-            self._logger.info( "private request sleep : {:.3f} {}".format(w,id) )
-            await asyncio.sleep(w)
-            w = list(self._request_count_private)[0]+1-time.time()                        # 1秒あたり
-
-        # 今回の時間を追加
-        self._request_count_private.append(time.time())
-        return
+    async def check_private_request_limit(self, lane='query', timeout=None):
+        # 前回のリクエストから3秒以上経っていたらカウンターを初期化
+        if time.time()-self._last_private_request>3 :
+            self.RateLimitRemaining_private = 10
+        result = await self.rate_limiter.acquire('private', lane, timeout)
+        self._last_private_request = time.time()
+        return result
 
     @property
     def api_remain1(self):
@@ -295,9 +269,9 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
 
     def _on_executions(self,msg):
         trades = msg.get('data')
-        self.execution_info.time = self._epoc_to_dt(int(trades[0][0])/1000)
+        self.execution_info.time = self._ns_to_dt(self._epoch_ms_to_ns(trades[0][0]))
         for t in trades:
-            self.execution_info.append_execution(float(t[1]),float(t[2]),"BUY" if t[3]=="buy" else "SELL", self._epoc_to_dt(int(t[0])/1000))
+            self.execution_info.append_execution_ns(float(t[1]),float(t[2]),"BUY" if t[3]=="buy" else "SELL", self._epoch_ms_to_ns(t[0]))
         self.execution_info.append_latency(self._jst_now_dt().timestamp()*1000 - int(trades[0][0]))
         self.my.position.ref_ltp = self.execution_info.last
         self.execution_info._event.set()
@@ -366,39 +340,42 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
         '''
         self._logger.debug("_on_my_orders={}".format(message))
 
-        self._order_dict_lock.wait()
+        # 発注中でまだ登録されていない注文のイベントは new_order で登録されるまで保留される
         for d in message.get('data',[]) :
-            id = d.get('ordId')
-            if d['status']=='new' :
-                if self.my.order.update_order(id, side=d['side'].upper(), price=float(d['px']), size=float(d['sz'])) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] New :"+ str(d) )
+            self.my.order.apply(d.get('ordId'), self._on_my_order, d)
 
-                else:
-                    self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
+    def _on_my_order(self,d):
+        id = d.get('ordId')
+        if d['status']=='new' :
+            if self.my.order.update_order(id, side=d['side'].upper(), price=float(d['px']), size=float(d['sz'])) :
+                self._logger.debug( self.__class__.__name__ + " : [order] New :"+ str(d) )
 
-            elif d['status']=='full-fill' :
-                if self.my.order.executed( id=id, side=d['side'].upper(), price=float(d['fillPx']), size=float(d['accFillSz']) ) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] Filled : " + str(d) )
+            else:
+                self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
 
-                    # --------------------------------------------------------------------------------
+        elif d['status']=='full-fill' :
+            if self.my.order.executed( id=id, side=d['side'].upper(), price=float(d['fillPx']), size=float(d['accFillSz']) ) :
+                self._logger.debug( self.__class__.__name__ + " : [order] Filled : " + str(d) )
 
-                    if self.is_linear() :
-                        self.my.position.executed( id, price=float(d['fillPx']), side=d['side'].upper(), size=float(d['accFillSz']), commission=float(d['fillFee']) )
-                    else:
-                        self.my.position.executed( id, price=float(d['fillPx']), side=d['side'].upper(), size=float(d['accFillSz']), commission=float(d['fillFee'])/self.my.position.ref_ltp )
-                    # --------------------------------------------------------------------------------
+                # --------------------------------------------------------------------------------
 
+                if self.is_linear() :
+                    self.my.position.executed( id, price=float(d['fillPx']), side=d['side'].upper(), size=float(d['accFillSz']), commission=float(d['fillFee']) )
                 else:
-                    self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
+                    self.my.position.executed( id, price=float(d['fillPx']), side=d['side'].upper(), size=float(d['accFillSz']), commission=float(d['fillFee'])/self.my.position.ref_ltp )
+                # --------------------------------------------------------------------------------
 
-            elif d['status']=='cancelled' :
-                if self.my.order.remove_order( id ) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] Canceled : " + str(d) )
-                else:
-                    self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
+            else:
+                self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
 
+        elif d['status']=='cancelled' :
+            if self.my.order.remove_order( id ) :
+                self._logger.debug( self.__class__.__name__ + " : [order] Canceled : " + str(d) )
             else:
-                self._logger.debug( self.__class__.__name__ + " : [order] Unknown : " + str(d) )
+                self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
+
+        else:
+            self._logger.debug( self.__class__.__name__ + " : [order] Unknown : " + str(d) )
 
 
     # wsでローソク足を受信したら登録されたターゲット足を生成
@@ -453,7 +430,7 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
 
             try:
                 responce = ''
-                await self.check_public_request_limit('getcandles')
+                await self.check_public_request_limit('candle')
                 res =await self._client.get('/market/candles', params={'symbol': target_symbol+'_'+insttype, 'granularity':60, 'startTime':max(starttime,limittime)*1000, 'endTime':endtime*1000 })
                 self._update_public_limit(res)
                 responce = await res.json()
@@ -548,7 +525,7 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
         try:
             symbol = kwrgs.get('symbol', self.symbol)
             insttype = 'UMCBL' if self.is_linear(symbol) else 'DMCBL'
-            await self.check_public_request_limit('getticker')
+            await self.check_public_request_limit('candle')
             res = await self._client.get('/market/ticker', params={'symbol': symbol+'_'+insttype})
             self._update_public_limit(res)
             if res.status==200:
@@ -567,7 +544,7 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
         try:
             symbol = kwrgs.get('symbol', self.symbol)
             insttype = 'UMCBL' if self.is_linear(symbol) else 'DMCBL'
-            await self.check_private_request_limit('getpositions')
+            await self.check_private_request_limit('query')
             r = await self._client.get('/position/allPosition', params={'productType': insttype.lower()})
             self._update_private_limit(r)
             res = await r.json()
@@ -607,7 +584,7 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
     async def getbalance(self):
         try:
             insttype = 'UMCBL' if self.is_linear(self.symbol) else 'DMCBL'
-            await self.check_private_request_limit('getbalance')
+            await self.check_private_request_limit('query')
             r = await self._client.get('/account/accounts', params={'productType':insttype, })
             self._update_private_limit(r)
             return await r.json()
@@ -639,10 +616,6 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
             self._logger.info("No trade period" )
             return {'stat': -999, 'msg': "No trade period", 'ids': []}
 
-        if self.RateLimitRemaining_private<2:
-            self._logger.info("RateLimitRemaining_private : {}/10".format(self.RateLimitRemaining_private) )
-            return {'stat': -999, 'msg': "RateLimitRemaining_private "+str(self.RateLimitRemaining_private)+"/10", 'ids': []}
-
         if self.PendingUntil > time.time() :
             self._logger.info("Order pending : {:.1f}sec".format(self.PendingUntil-time.time()) )
             return {'stat': -999, 'msg': "Order pending : {:.1f}sec".format(self.PendingUntil-time.time()), 'ids': []}
@@ -690,9 +663,13 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
             params['size'] = available
             params['side'] = 'close_short' if side.lower()=='buy' else 'close_long'
 
-            with self._order_dict_lock :
+            # 1秒以内に送信できなければオーダーしない
+            if not await self.check_private_request_limit('order', timeout=1) :
+                self._logger.info("RateLimitRemaining_private : {:.1f}/5".format(self.rate_limiter.tokens('private')) )
+                return {'stat': -999, 'msg': "RateLimitRemaining_private", 'ids': []}
+
+            with self.my.order.sending() :
                 try:
-                    await self.check_private_request_limit(params)
                     self._logger.info("[send closeorder] : {}".format(params) )
                     r = await self._client.post('/order/placeOrder', data=params)
                     self._update_private_limit(r)
@@ -725,9 +702,13 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
         params['size'] = remain
         params['side']='open_long' if side.lower()=='buy' else 'open_short'
 
-        with self._order_dict_lock :
+        # 1秒以内に送信できなければオーダーしない
+        if not await self.check_private_request_limit('order', timeout=1) :
+            self._logger.info("RateLimitRemaining_private : {:.1f}/5".format(self.rate_limiter.tokens('private')) )
+            return {'stat': -999, 'msg': "RateLimitRemaining_private", 'ids': ordered_id_list}
+
+        with self.my.order.sending() :
             try:
-                await self.check_private_request_limit(params)
                 self._logger.info("[sendorder] : {}".format(params) )
                 r = await self._client.post('/order/placeOrder', data=params)
                 self._update_private_limit(r)
@@ -750,6 +731,198 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
                 return {'stat':ret_code , 'msg':res.get('msg'), 'ids':ordered_id_list}
 
 
+    # 一括発注 (シンボルごとに最大50件ずつ batch-orders でまとめて送信)
+    async def sendorders(self, orders):
+        """
+        sendorders( [{'order_type':'LIMIT', 'side':'BUY', 'size':1000, 'price':4800000, ...}, ...] )   # sendorder の引数の辞書のリスト
+
+        return: [ { 'stat': エラーコード, 'msg': エラーメッセージ, 'ids': オーダーIDのリスト }, ... ]    # orders と同じ順番
+        """
+
+        results = [None]*len(orders)
+        batches = {}         # symbol : [(orders内の番号, orderData, new_orderの引数), ...]
+        available = {}       # (symbol, holdSide) : 決済オーダーに使えるポジション
+        positions = self.positions.find()
+        pos_side = self.my.position.side
+
+        for i, o in enumerate(orders):
+            kwargs = dict(o)
+            side = kwargs['side']
+            if self.noTrade and (pos_side==side or pos_side=='NONE'):
+                results[i] = {'stat': -999, 'msg': "No trade period", 'ids': []}
+                continue
+            if self.PendingUntil > time.time() :
+                results[i] = {'stat': -999, 'msg': "Order pending : {:.1f}sec".format(self.PendingUntil-time.time()), 'ids': []}
+                continue
+
+            symbol = kwargs.get('symbol', self.symbol).upper()
+            price = self.round_order_price(kwargs.get('price',0), symbol=symbol)
+            size = kwargs['size']
+            if self.noTrade :
+                size = min(abs(self.my.position.size),size)
+            if size<self.minimum_order_size(symbol=symbol) :
+                results[i] = {'stat': -153, 'msg': '最低取引数量を満たしていません', 'ids': []}
+                continue
+
+            data = {'orderType': kwargs['order_type'].lower(), 'price': price}
+            for k,v in kwargs.items():
+                if k=='timeInForceValue' :
+                    if v in ["normal", "postOnly", "ioc", "fok"] :
+                        data[k]=v
+                elif k in ['presetTakeProfitPrice','presetStopLossPrice']:
+                    data[k]=v
+            expire = time.time()+kwargs.get('auto_cancel_after',2592000)
+            register = not kwargs.get('adjust_flag', False)
+
+            # 反対側のポジションがあれば先に決済オーダーとして使い、残りを新規オーダーにする
+            hold_side = 'short' if side.lower()=='buy' else 'long'
+            if (symbol, hold_side) not in available :
+                available[(symbol, hold_side)] = sum([float(p['available']) for p in positions if p['instName']==symbol and p['holdSide']==hold_side])
+            close_size = round(min(size, available[(symbol, hold_side)]),8)
+            if close_size<self.minimum_order_size(symbol=symbol) :
+                close_size = 0
+            available[(symbol, hold_side)] -= close_size
+            parts = []
+            if close_size>0 :
+                parts.append(('close_'+hold_side, close_size))
+            if round(size-close_size,8)>0 :
+                parts.append(('open_long' if side.lower()=='buy' else 'open_short', round(size-close_size,8)))
+
+            results[i] = {'stat': 0, 'msg': "", 'ids': []}
+            for order_side, part_size in parts:
+                batches.setdefault(symbol, []).append((i, dict(data, side=order_side, size=part_size, clientOid=uuid.uuid4().hex),
+                    {'symbol':symbol, 'side':side.upper(), 'price':price, 'size':part_size, 'expire':expire, 'invalidate':time.time()+2592000} if register else None))
+
+        for symbol, entries in batches.items():
+            insttype = 'UMCBL' if self.is_linear(symbol) else 'DMCBL'
+            for n in range(0, len(entries), 50):
+                chunk = entries[n:n+50]
+                params = {'symbol': symbol+'_'+insttype, 'marginCoin': self._collateral_coin.get(symbol,'USD'), 'orderDataList': [e[1] for e in chunk]}
+
+                # 1秒以内に送信できなければオーダーしない
+                if not await self.check_private_request_limit('order', timeout=1) :
+                    self._logger.info("RateLimitRemaining_private : {:.1f}/5".format(self.rate_limiter.tokens('private')) )
+                    for i,data,order in chunk:
+                        results[i].update({'stat': -999, 'msg': "RateLimitRemaining_private"})
+                    continue
+
+                with self.my.order.sending() :
+                    try:
+                        self._logger.info("[sendorders] : {}".format(params) )
+                        r = await self._client.post('/order/batch-orders', data=params)
+                        self._update_private_limit(r)
+                        res = await r.json()
+                    except Exception as e:
+                        self._logger.error(traceback.format_exc())
+                        for i,data,order in chunk:
+                            results[i].update({'stat': -999, 'msg': str(e)})
+                        continue
+
+                    ret_code = int(res.get('code',-999))
+                    if ret_code!=0 :
+                        self._logger.error("Send order param : {}".format(params) )
+                        self._logger.error("Error response [sendorders] : {}".format(res) )
+                        for i,data,order in chunk:
+                            results[i].update({'stat': ret_code, 'msg': res.get('msg')})
+                        continue
+
+                    # 成功したオーダーだけをまとめてオーダーリストに登録
+                    accepted = {d['clientOid']:d['orderId'] for d in (res.get('data') or {}).get('orderInfo',[])}
+                    failure = {d['clientOid']:d for d in (res.get('data') or {}).get('failure',[])}
+                    new_orders = []
+                    for i,data,order in chunk:
+                        order_id = accepted.get(data['clientOid'])
+                        if order_id :
+                            results[i]['ids'].append(order_id)
+                            if order :
+                                new_orders.append(dict(order, id=order_id))
+                        else:
+                            f = failure.get(data['clientOid'],{})
+                            self._logger.error("Error response [sendorders] : {} {}".format(data, f) )
+                            results[i].update({'stat': f.get('errorCode',-999), 'msg': f.get('errorMsg')})
+                    self.my.order.new_orders(new_orders)
+
+        return results
+
+    # 一括キャンセル (シンボルごとに最大50件ずつ cancel-batch-orders でまとめて送信)
+    async def cancelorders(self, ids):
+        """
+        cancelorders( [id, ...] )
+
+        return: [ { 'stat': エラーコード, 'msg': エラーメッセージ }, ... ]    # ids と同じ順番
+        """
+
+        results = {}
+        groups = {}          # symbol : [id, ...]
+        for id in ids:
+            if id not in self.my.order.order_dict :
+                self._logger.info("ID:{} is already filled or canceld or expired".format(id) )
+                results[id] = {'stat':-999 , 'msg':"Order is already filled or canceld or expired"}
+            elif id not in results :
+                groups.setdefault(self.my.order.order_dict[id]['symbol'], []).append(id)
+                results[id] = None
+
+        for symbol, group in groups.items():
+            insttype = 'UMCBL' if self.is_linear(symbol) else 'DMCBL'
+            for n in range(0, len(group), 50):
+                chunk = group[n:n+50]
+                params = {'symbol': symbol+'_'+insttype, 'marginCoin': self._collateral_coin.get(symbol,'USD'), 'orderIds': chunk}
+                try:
+                    await self.check_private_request_limit('cancel')
+                    self._logger.info("[cancelorders] : {}".format(params) )
+                    self.my.order.mark_as_invalidate_all( chunk )
+                    r = await self._client.post('/order/cancel-batch-orders', data=params)
+                    self._update_private_limit(r)
+                    res = await r.json()
+                except Exception as e:
+                    self._logger.error(traceback.format_exc())
+                    results.update({id:{'stat': -999, 'msg': str(e)} for id in chunk})
+                    continue
+
+                ret_code = int(res.get('code',-999))
+                if ret_code!=0 :
+                    self._logger.error("Error response [cancelorders] : {}".format(res) )
+                    results.update({id:{'stat': ret_code, 'msg': res.get('msg')} for id in chunk})
+                    continue
+
+                failure = {f.get('order_id'):f for f in (res.get('data') or {}).get('fail_infos',[])}
+                for id in chunk:
+                    if id in failure :
+                        self._logger.error("Error response [cancelorders] : {}".format(failure[id]) )
+                        results[id] = {'stat': failure[id].get('err_code',-999), 'msg': failure[id].get('err_msg')}
+                    else:
+                        results[id] = {'stat': 0, 'msg': ""}
+
+        return [results[id] for id in ids]
+
+    # 全キャンセル (取引所側のオーダーを全てキャンセルするので、手動や他のbotからのオーダーもキャンセルされる)
+    #   symbol を省略した場合はオーダーリストにある全てのシンボル
+    async def cancel_all(self, symbol=None):
+        symbols = [symbol.upper()] if symbol else (sorted(set(o.get('symbol') for o in self.my.order.order_dict.values())) or [self.symbol])
+        canceled = []
+        for target_symbol in symbols:
+            ids = [id for id,o in self.my.order.order_dict.items() if o.get('symbol')==target_symbol]
+            insttype = 'UMCBL' if self.is_linear(target_symbol) else 'DMCBL'
+            params = {'symbol': target_symbol+'_'+insttype, 'marginCoin': self._collateral_coin.get(target_symbol,'USD')}
+            try:
+                await self.check_private_request_limit('cancel')
+                self._logger.info("[cancel_all] : {}".format(params) )
+                self.my.order.mark_as_invalidate_all( ids )
+                r = await self._client.post('/order/cancel-symbol-orders', data=params)
+                self._update_private_limit(r)
+                res = await r.json()
+            except Exception as e:
+                self._logger.error(traceback.format_exc())
+                return {'stat': -999, 'msg': str(e), 'ids': canceled}
+
+            ret_code = int(res.get('code',-999))
+            if ret_code!=0 :
+                self._logger.error("Error response [cancel_all] : {}".format(res) )
+                return {'stat': ret_code, 'msg': res.get('msg'), 'ids': canceled}
+            canceled += ids
+
+        return {'stat': 0, 'msg': "", 'ids': canceled}
+
     # キャンセル
     async def cancelorder(self, id, **kwargs ):
         """
@@ -766,10 +939,6 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
             self._logger.info("ID:{} is already filled or canceld or expired".format(id) )
             return {'stat':-999 , 'msg':"Order is already filled or canceld or expired"}
 
-        if self.RateLimitRemaining_private<2:
-            self._logger.info("RateLimitRemaining_private : {}/10".format(self.RateLimitRemaining_private) )
-            return {'stat': -999, 'msg': "RateLimitRemaining_private "+str(self.RateLimitRemaining_private)+"/10", 'ids': []}
-
         kwargs['orderId']=id
 
         symbol = kwargs.get("symbol", self.my.order.order_dict[id]['symbol'] )
@@ -778,7 +947,7 @@ class Bitget(pybotters.BitgetDataStore, TimeConv, RestAPIExchange, WebsocketExch
         kwargs['marginCoin'] = self._collateral_coin.get(symbol,'USD')
 
         try:
-            await self.check_private_request_limit(kwargs)
+            await self.check_private_request_limit('cancel')
             self._logger.info("[cancelorder] : {}".format(kwargs) )
             self.my.order.mark_as_invalidate( id )
             r = await self._client.post('/order/cancel-order', data=kwargs)
@@ -1,13 +1,12 @@
 # coding: utf-8
 #!/usr/bin/python3
 
-from pybotters.store import DataStore
+import traceback
 
-from libs.utils import TimeConv
-from libs.market import *
+from libs.utils import TimeConv, KlineStore
 from libs.exchanges.base_module import RestAPIExchange, WebsocketExchange
 
-class Kline(DataStore):
+class Kline(KlineStore):
     _KEYS = ['symbol', 'interval', 'timestamp']
     _MAXLEN = 3000000
 
@@ -22,8 +21,15 @@ class Kline(DataStore):
 class Bybit(TimeConv, RestAPIExchange, WebsocketExchange):
 
     # APIリミットの管理
-    def _update_api_limit(self,d):
+    #   注文系 (発注・キャンセル・変更) は1分に100回 (残り10回はキャンセル・変更用に残す)、その他のprivateは1分に120回
+    def _add_rate_limit_buckets(self):
+        self.rate_limiter.add_bucket('order', rate=100/60, capacity=100, reserve=10)
+        self.rate_limiter.add_bucket('private', rate=120/60, capacity=120)
+        self.rate_limiter.add_bucket('public', rate=50, capacity=50)
+
+    def _update_api_limit(self,d, bucket='private'):
         self.RateLimitRemaining = int(d.get('rate_limit_status',self.RateLimitRemaining))
+        self.rate_limiter.update(bucket, d.get('rate_limit_status'), limit=d.get('rate_limit'))
 
     @property
     def api_remain1(self):
@@ -37,6 +43,80 @@ class Bybit(TimeConv, RestAPIExchange, WebsocketExchange):
     def api_remain3(self):
         return 300
 
+    # 全キャンセル (取引所側のオーダーを全てキャンセルするので、手動や他のbotからのオーダーもキャンセルされる)
+    async def cancel_all(self, symbol=None):
+        target_symbol = symbol or self.symbol
+        ids = [id for id,o in self.my.order.order_dict.items() if o.get('symbol')==target_symbol]
+        self._logger.info("[cancel_all] : {}".format(target_symbol) )
+
+        self.my.order.mark_as_invalidate_all( ids )
+
+        try:
+            await self.rate_limiter.acquire('order', 'cancel')
+            r = await self._client.post(self._cancel_all_endpoint, data={'symbol': target_symbol})
+            res = await r.json()
+            self._update_api_limit(res, 'order')
+        except Exception as e:
+            self._logger.error(traceback.format_exc())
+            return {'stat': -999, 'msg': str(e), 'ids': []}
+
+        ret_code = res.get('ret_code',-999)
+        if ret_code==0 :
+            return {'stat': 0, 'msg': "", 'ids': ids}
+
+        self._logger.error("Error response [cancel_all] : {}".format(res) )
+        return {'stat':ret_code , 'msg':res.get('ret_msg'), 'ids': []}
+
+    # オーダーの変更 (価格・数量を変更しても同じIDのまま)
+    async def amend_order(self, id, price=None, size=None, **kwargs):
+        """
+        amend_order( id,             # 変更するオーダーのID
+                     price=None,     # 変更後の価格 (省略時は変更しない)
+                     size=None )     # 変更後の注文数量 (約定済みの分を含む。省略時は変更しない)
+
+        return: { 'stat': エラーコード,      # 変更成功時 0
+                  'msg':  エラーメッセージ,
+                  'ids' : [id]
+                }
+        """
+        if id not in self.my.order.order_dict :
+            self._logger.info("ID:{} is already filled or canceld or expired".format(id) )
+            return {'stat': -999, 'msg': "Order is already filled or canceld or expired", 'ids': []}
+
+        symbol = self.my.order.order_dict[id].get('symbol', self.symbol)
+        params = {'order_id':id, 'symbol':symbol}
+        if price is not None :
+            price = params['p_r_price'] = self.round_order_price(price, symbol=symbol)
+        if size is not None :
+            size = self._round_order_size(size, symbol=symbol)
+            params['p_r_qty'] = size if self.is_linear else int(size)
+
+        # レスポンスより先に届いた約定は、変更の成否をオーダーリストに反映してから適用する
+        with self.my.order.amending(id) :
+            try:
+                self._logger.info("[amend_order] : {}".format(params) )
+                await self.rate_limiter.acquire('order', 'amend')
+                r = await self._client.post(self._amend_endpoint, data=params)
+                res = await r.json()
+                self._update_api_limit(res, 'order')
+            except Exception as e:
+                self._logger.error(traceback.format_exc())
+                return {'stat': -999, 'msg': str(e), 'ids': []}
+
+            ret_code = res.get('ret_code',-999)
+            if ret_code==0 :
+                self.my.order.amend_order( id, price=price, size=size )
+                if 'auto_cancel_after' in kwargs :
+                    self.my.order.refresh_expire( id, kwargs['auto_cancel_after'] )
+                return {'stat': 0, 'msg': "", 'ids': [id]}
+
+        self._logger.error("Error response [amend_order] : {}".format(res) )
+        return {'stat':ret_code , 'msg':res.get('ret_msg'), 'ids': []}
+
+    # 価格の変更 (従来の名前)
+    async def changeorder(self, id, price, **kwargs ):
+        return await self.amend_order(id, price=price)
+
     # データストアへの接続を共通名に変換
     @property
     def ticker(self):
@@ -65,6 +145,7 @@ class Bybit(TimeConv, RestAPIExchange, WebsocketExchange):
     # オーダー単位の管理
     async def _get_market_info(self):
         # マーケット情報の取得
+        await self.rate_limiter.acquire('public', 'query')
         res = await self._client.get('/v2/public/symbols')
         data = await res.json()
         market_info = data.get('result',[])
@@ -21,6 +21,9 @@ from libs.exchanges.bybit import Bybit
 # インバースタイプ契約
 class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
 
+    _amend_endpoint = '/v2/private/order/replace'
+    _cancel_all_endpoint = '/v2/private/order/cancelAll'
+
     # インバースタイプ契約
     @property
     def is_linear(self):
@@ -50,11 +53,11 @@ class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
         self._client = pybotters.Client(apis={self.exchange_name: [apikey[0],apikey[1]]}, base_url=self._api_url)
         self._candle_api_lock = asyncio.Lock()
         self._datastore_lock = LockCounter(self._logger, self.__class__.__name__)
-        self._order_dict_lock = LockCounter(self._logger, "order_dict")
         self._candle_subscribed = []
         pybotters.BybitInverseDataStore.__init__(self)
         RestAPIExchange.__init__(self)
         WebsocketExchange.__init__(self)
+        self._add_rate_limit_buckets()
 
         self.PendingUntil = time.time()
         self.RateLimitRemaining = 100
@@ -160,10 +163,13 @@ class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
         '''
         self._logger.info("_on_my_account={}".format(message))
 
-        self._order_dict_lock.wait()
+        # 発注中でまだ登録されていない注文のイベントは new_order で登録されるまで保留される
         for d in message.get('data',[]) :
-            if self.my.order.executed( id=d['order_id'], side=d['side'].upper(), price=float(d['price']), size=d['exec_qty'] ) :
-                self.my.position.executed( id=d['order_id'], side=d['side'].upper(), price=float(d['price']), size=d['exec_qty'] )
+            self.my.order.apply(d['order_id'], self._on_my_execution, d)
+
+    def _on_my_execution(self,d):
+        if self.my.order.executed( id=d['order_id'], side=d['side'].upper(), price=float(d['price']), size=d['exec_qty'] ) :
+            self.my.position.executed( id=d['order_id'], side=d['side'].upper(), price=float(d['price']), size=d['exec_qty'] )
 
     def _on_my_positions(self,message):
         '''
@@ -179,25 +185,28 @@ class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
         '''
         self._logger.debug("_on_my_orders={}".format(message))
 
-        self._order_dict_lock.wait()
+        # 発注中でまだ登録されていない注文のイベントは new_order で登録されるまで保留される
         for d in message.get('data',[]) :
-            id = d.get('order_id')
-            if d['order_status']=='New' :
-                if self.my.order.update_order(id, side=d['side'].upper(), price=float(d['price']), size=d['qty']) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] New Order : " + str(d) )
-            elif d['order_status']=='Cancelled' :
-                if self.my.order.remove_order( id ) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] Canceled : " + str(d) )
-                    self.my.position.executed( id, commission=-float(d['cum_exec_fee']) )  # ここまでに得たコミッションを適用
-            elif d['order_status']=='Filled' :
-                if self.my.order.is_myorder( id ) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] Filled : " + str(d) )
-                    self.my.position.executed( id, commission=-float(d['cum_exec_fee']) )
-            elif d['order_status']=='PartiallyFilled' :
-                if self.my.order.is_myorder( id ) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] PartiallyFilled : " + str(d) )
-            else:
-                self._logger.debug( self.__class__.__name__ + " : [order] Unknown : " + str(d) )
+            self.my.order.apply(d.get('order_id'), self._on_my_order, d)
+
+    def _on_my_order(self,d):
+        id = d.get('order_id')
+        if d['order_status']=='New' :
+            if self.my.order.update_order(id, side=d['side'].upper(), price=float(d['price']), size=d['qty']) :
+                self._logger.debug( self.__class__.__name__ + " : [order] New Order : " + str(d) )
+        elif d['order_status']=='Cancelled' :
+            if self.my.order.remove_order( id ) :
+                self._logger.debug( self.__class__.__name__ + " : [order] Canceled : " + str(d) )
+                self.my.position.executed( id, commission=-float(d['cum_exec_fee']) )  # ここまでに得たコミッションを適用
+        elif d['order_status']=='Filled' :
+            if self.my.order.is_myorder( id ) :
+                self._logger.debug( self.__class__.__name__ + " : [order] Filled : " + str(d) )
+                self.my.position.executed( id, commission=-float(d['cum_exec_fee']) )
+        elif d['order_status']=='PartiallyFilled' :
+            if self.my.order.is_myorder( id ) :
+                self._logger.debug( self.__class__.__name__ + " : [order] PartiallyFilled : " + str(d) )
+        else:
+            self._logger.debug( self.__class__.__name__ + " : [order] Unknown : " + str(d) )
 
     async def get_candles( self, timeframe, num_of_candle=500, symbol=None, since=None, need_result=True ):
 
@@ -232,9 +241,10 @@ class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
 
             try:
                 responce = ''
+                await self.rate_limiter.acquire('public', 'candle')
                 res = await self._client.get("/v2/public/kline/list", params={'symbol': target_symbol, 'interval': '1', 'from':starttime})
                 responce = await res.json()
-                self._update_api_limit(responce)
+                self._update_api_limit(responce, 'public')
                 rows = responce['result']
 
                 # 得られたデータが空っぽなら終了
@@ -319,9 +329,10 @@ class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
     # APIからTickerを取得
     async def ticker_api(self, **kwrgs):
         try:
+            await self.rate_limiter.acquire('public', 'query')
             res = await self._client.get('/v2/public/tickers', params={'symbol': kwrgs.get('symbol', self.symbol)})
             data = await res.json()
-            self._update_api_limit(data)
+            self._update_api_limit(data, 'public')
             self.my.position.ref_ltp = data['result'][0]['last_price']
             return {'stat':data['ret_code'] , 'ltp':data['result'][0]['last_price'], 'msg':data}
         except Exception as e:
@@ -331,6 +342,7 @@ class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
     # APIから現在ポジを取得
     async def getpositions(self, **kwrgs):
         try:
+            await self.rate_limiter.acquire('private', 'query')
             r = await self._client.get("/v2/private/position/list", params={'symbol':kwrgs.get('symbol', self.symbol)})
             res = await r.json()
             self._update_api_limit(res)
@@ -346,6 +358,7 @@ class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
     # ウォレット残高
     async def getbalance(self, coin):
         try:
+            await self.rate_limiter.acquire('private', 'query')
             if coin : 
                 r = await self._client.get("/v2/private/wallet/balance", params={'coin': coin,})
             else:
@@ -381,9 +394,9 @@ class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
             self._logger.info("No trade period" )
             return {'stat': -999, 'msg': "No trade period", 'ids': []}
 
-        if self.RateLimitRemaining<10:
-            self._logger.info("RateLimitRemaining : {}/120".format(self.RateLimitRemaining) )
-            return {'stat': -999, 'msg': "RateLimitRemaining "+str(self.RateLimitRemaining)+"/120", 'ids': []}
+        if not await self.rate_limiter.acquire('order', 'order', timeout=1) :
+            self._logger.info("RateLimitRemaining : {:.1f}/100".format(self.rate_limiter.tokens('order')) )
+            return {'stat': -999, 'msg': "RateLimitRemaining {:.1f}/100".format(self.rate_limiter.tokens('order')), 'ids': []}
 
         if self.PendingUntil > time.time() :
             self._logger.info("Order pending : {:.1f}sec".format(self.PendingUntil-time.time()) )
@@ -414,11 +427,11 @@ class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
             return {'stat': -153, 'msg': '最低取引数量を満たしていません', 'ids': []}
 
         self._logger.debug("[sendorder] : {}".format(params) )
-        with self._order_dict_lock :
+        with self.my.order.sending() :
             try:
                 r = await self._client.post('/v2/private/order/create', data=params)
                 res = await r.json()
-                self._update_api_limit(res)
+                self._update_api_limit(res, 'order')
             except Exception as e:
                 self._logger.error(traceback.format_exc())
                 return {'stat': -999, 'msg': str(e), 'ids':[]}
@@ -456,10 +469,6 @@ class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
             self._logger.info("ID:{} is already filled or canceld or expired".format(id) )
             return {'stat':-999 , 'msg':"Order is already filled or canceld or expired"}
 
-        if self.RateLimitRemaining<10:
-            self._logger.info("RateLimitRemaining : {}/120".format(self.RateLimitRemaining) )
-            return {'stat': -999, 'msg': "RateLimitRemaining "+str(self.RateLimitRemaining)+"/120", 'ids': []}
-
         kwargs['order_id']=id
         kwargs['symbol'] = kwargs.get("symbol", self.my.order.order_dict[id]['symbol'] )
 
@@ -468,9 +477,10 @@ class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
         self.my.order.mark_as_invalidate( id )
 
         try:
+            await self.rate_limiter.acquire('order', 'cancel')
             r = await self._client.post('/v2/private/order/cancel', data=kwargs)
             res = await r.json()
-            self._update_api_limit(res)
+            self._update_api_limit(res, 'order')
         except Exception as e:
             self._logger.error(traceback.format_exc())
             return {'stat': -999, 'msg': str(e)}
@@ -486,17 +496,3 @@ class BybitInverse(pybotters.BybitInverseDataStore, Bybit):
         self._logger.error("Error response [cancelorder] : {}".format(res) )
         return {'stat':ret_code , 'msg':res.get('msg')}
 
-    # 変更
-    async def changeorder(self, id, price, *kwargs ):
-        try:
-            params = {'order_id':id, 'symbol':self.symbol, 'p_r_price':self.round_order_price(price)}
-            self._logger.info("[changeorder] : {}".format(params) )
-            r = await self._client.post('/v2/private/order/replace', data=params)
-            res = await r.json()
-            self._update_api_limit(res)
-        except Exception as e:
-            self._logger.error(traceback.format_exc())
-            return {'stat': -999, 'msg': str(e)}
-
-        return {'stat':res.get('ret_code',-1) , 'msg':res.get('msg')}
-
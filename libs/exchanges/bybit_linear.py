@@ -22,6 +22,9 @@ from libs.exchanges.bybit import Bybit
 # リニアUSDT契約
 class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
 
+    _amend_endpoint = '/private/linear/order/replace'
+    _cancel_all_endpoint = '/private/linear/order/cancel-all'
+
     # リニアUSDT契約
     @property
     def is_linear(self):
@@ -51,11 +54,11 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
         self._client = pybotters.Client(apis={self.exchange_name: [apikey[0],apikey[1]]}, base_url=self._api_url)
         self._candle_api_lock = asyncio.Lock()
         self._datastore_lock = LockCounter(self._logger, self.__class__.__name__)
-        self._order_dict_lock = LockCounter(self._logger, "order_dict")
         self._candle_subscribed = []
         pybotters.BybitUSDTDataStore.__init__(self)
         RestAPIExchange.__init__(self)
         WebsocketExchange.__init__(self)
+        self._add_rate_limit_buckets()
 
         self.PendingUntil = time.time()
         self.RateLimitRemaining = 100
@@ -164,10 +167,13 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
         '''
         self._logger.info("_on_my_account={}".format(message))
 
-        self._order_dict_lock.wait()
+        # 発注中でまだ登録されていない注文のイベントは new_order で登録されるまで保留される
         for d in message.get('data',[]) :
-            if self.my.order.executed( id=d['order_id'], side=d['side'].upper(), price=float(d['price']), size=d['exec_qty'] ) :
-                self.my.position.executed( id=d['order_id'], side=d['side'].upper(), price=float(d['price']), size=d['exec_qty'] )
+            self.my.order.apply(d['order_id'], self._on_my_execution, d)
+
+    def _on_my_execution(self,d):
+        if self.my.order.executed( id=d['order_id'], side=d['side'].upper(), price=float(d['price']), size=d['exec_qty'] ) :
+            self.my.position.executed( id=d['order_id'], side=d['side'].upper(), price=float(d['price']), size=d['exec_qty'] )
 
     def _on_my_positions(self,message):
         '''
@@ -183,25 +189,28 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
         '''
         self._logger.debug("_on_my_orders={}".format(message))
 
-        self._order_dict_lock.wait()
+        # 発注中でまだ登録されていない注文のイベントは new_order で登録されるまで保留される
         for d in message.get('data',[]) :
-            id = d.get('order_id')
-            if d['order_status']=='New' :
-                if self.my.order.update_order(id, side=d['side'].upper(), price=float(d['price']), size=d['qty']) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] New Order : " + str(d) )
-            elif d['order_status']=='Cancelled' :
-                if self.my.order.remove_order( id ) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] Canceled : " + str(d) )
-                    self.my.position.executed( id, commission=-float(d['cum_exec_fee']) )  # ここまでに得たコミッションを適用
-            elif d['order_status']=='Filled' :
-                if self.my.order.is_myorder( id ) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] Filled : " + str(d) )
-                    self.my.position.executed( id, commission=-float(d['cum_exec_fee']) )
-            elif d['order_status']=='PartiallyFilled' :
-                if self.my.order.is_myorder( id ) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] PartiallyFilled : " + str(d) )
-            else:
-                self._logger.debug( self.__class__.__name__ + " : [order] Unknown : " + str(d) )
+            self.my.order.apply(d.get('order_id'), self._on_my_order, d)
+
+    def _on_my_order(self,d):
+        id = d.get('order_id')
+        if d['order_status']=='New' :
+            if self.my.order.update_order(id, side=d['side'].upper(), price=float(d['price']), size=d['qty']) :
+                self._logger.debug( self.__class__.__name__ + " : [order] New Order : " + str(d) )
+        elif d['order_status']=='Cancelled' :
+            if self.my.order.remove_order( id ) :
+                self._logger.debug( self.__class__.__name__ + " : [order] Canceled : " + str(d) )
+                self.my.position.executed( id, commission=-float(d['cum_exec_fee']) )  # ここまでに得たコミッションを適用
+        elif d['order_status']=='Filled' :
+            if self.my.order.is_myorder( id ) :
+                self._logger.debug( self.__class__.__name__ + " : [order] Filled : " + str(d) )
+                self.my.position.executed( id, commission=-float(d['cum_exec_fee']) )
+        elif d['order_status']=='PartiallyFilled' :
+            if self.my.order.is_myorder( id ) :
+                self._logger.debug( self.__class__.__name__ + " : [order] PartiallyFilled : " + str(d) )
+        else:
+            self._logger.debug( self.__class__.__name__ + " : [order] Unknown : " + str(d) )
 
     async def get_candles( self, timeframe, num_of_candle=500, symbol=None, since=None, need_result=True ):
 
@@ -236,9 +245,10 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
 
             try:
                 responce = ''
+                await self.rate_limiter.acquire('public', 'candle')
                 res = await self._client.get("/public/linear/kline", params={'symbol': target_symbol, 'interval': '1', 'from':starttime})
                 responce = await res.json()
-                self._update_api_limit(responce)
+                self._update_api_limit(responce, 'public')
                 rows = responce['result']
 
                 # 得られたデータが空っぽなら終了
@@ -323,9 +333,10 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
     # APIからTickerを取得
     async def ticker_api(self, **kwrgs):
         try:
+            await self.rate_limiter.acquire('public', 'query')
             res = await self._client.get('/public/linear/recent-trading-records', params={'symbol': kwrgs.get('symbol', self.symbol), 'limit':1})
             data = await res.json()
-            self._update_api_limit(data)
+            self._update_api_limit(data, 'public')
             self.my.position.ref_ltp = data['result'][0]['price']
             return {'stat':data['ret_code'] , 'ltp':data['result'][0]['price'], 'msg':data}
         except Exception as e:
@@ -335,6 +346,7 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
     # APIから現在ポジを取得
     async def getpositions(self, **kwrgs):
         try:
+            await self.rate_limiter.acquire('private', 'query')
             r = await self._client.get("/private/linear/position/list", params={'symbol':kwrgs.get('symbol', self.symbol)})
             res = await r.json()
             self._update_api_limit(res)
@@ -350,6 +362,7 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
     # ウォレット残高
     async def getbalance(self, coin):
         try:
+            await self.rate_limiter.acquire('private', 'query')
             if coin : 
                 r = await self._client.get("/v2/private/wallet/balance", params={'coin': coin,})
             else:
@@ -385,9 +398,9 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
             self._logger.info("No trade period" )
             return {'stat': -999, 'msg': "No trade period", 'ids': []}
 
-        if self.RateLimitRemaining<10:
-            self._logger.info("RateLimitRemaining : {}/120".format(self.RateLimitRemaining) )
-            return {'stat': -999, 'msg': "RateLimitRemaining "+str(self.RateLimitRemaining)+"/120", 'ids': []}
+        if not await self.rate_limiter.acquire('order', 'order', timeout=1) :
+            self._logger.info("RateLimitRemaining : {:.1f}/100".format(self.rate_limiter.tokens('order')) )
+            return {'stat': -999, 'msg': "RateLimitRemaining {:.1f}/100".format(self.rate_limiter.tokens('order')), 'ids': []}
 
         if self.PendingUntil > time.time() :
             self._logger.info("Order pending : {:.1f}sec".format(self.PendingUntil-time.time()) )
@@ -432,11 +445,11 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
             params['close_on_trigger'] = True
 
             self._logger.debug("[send closeorder] : {}".format(params) )
-            with self._order_dict_lock :
+            with self.my.order.sending() :
                 try:
                     r = await self._client.post('/private/linear/order/create', data=params)
                     res = await r.json()
-                    self._update_api_limit(res)
+                    self._update_api_limit(res, 'order')
                 except Exception as e:
                     self._logger.error(traceback.format_exc())
                     return {'stat': -999, 'msg': str(e), 'ids':[]}
@@ -468,12 +481,16 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
         params['close_on_trigger'] = False
         params.pop('position_idx', None)
 
+        # 決済オーダーを出した場合は新規オーダーの分のトークンも取得する
+        if available>=self.minimum_order_size(symbol=params['symbol']) :
+            await self.rate_limiter.acquire('order', 'order')
+
         self._logger.debug("[sendorder] : {}".format(params) )
-        with self._order_dict_lock :
+        with self.my.order.sending() :
             try:
                 r = await self._client.post('/private/linear/order/create', data=params)
                 res = await r.json()
-                self._update_api_limit(res)
+                self._update_api_limit(res, 'order')
             except Exception as e:
                 self._logger.error(traceback.format_exc())
                 return {'stat': -999, 'msg': str(e), 'ids':[]}
@@ -513,10 +530,6 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
             self._logger.info("ID:{} is already filled or canceld or expired".format(id) )
             return {'stat':-999 , 'msg':"Order is already filled or canceld or expired"}
 
-        if self.RateLimitRemaining<10:
-            self._logger.info("RateLimitRemaining : {}/120".format(self.RateLimitRemaining) )
-            return {'stat': -999, 'msg': "RateLimitRemaining "+str(self.RateLimitRemaining)+"/120", 'ids': []}
-
         kwargs['order_id']=id
         kwargs['symbol'] = kwargs.get("symbol", self.my.order.order_dict[id]['symbol'] )
 
@@ -525,9 +538,10 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
         self.my.order.mark_as_invalidate( id )
 
         try:
+            await self.rate_limiter.acquire('order', 'cancel')
             r = await self._client.post('/private/linear/order/cancel', data=kwargs)
             res = await r.json()
-            self._update_api_limit(res)
+            self._update_api_limit(res, 'order')
         except Exception as e:
             self._logger.error(traceback.format_exc())
             return {'stat': -999, 'msg': str(e)}
@@ -542,17 +556,3 @@ class BybitUSDT(pybotters.BybitUSDTDataStore, Bybit):
 
         self._logger.error("Error response [cancelorder] : {}".format(res) )
         return {'stat':ret_code , 'msg':res.get('msg')}
-
-    # 変更
-    async def changeorder(self, id, price, *kwargs ):
-        try:
-            params = {'order_id':id, 'symbol':self.symbol, 'p_r_price':self.round_order_price(price)}
-            self._logger.info("[changeorder] : {}".format(params) )
-            r = await self._client.post('/private/linear/order/replace', data=params)
-            res = await r.json()
-            self._update_api_limit(res)
-        except Exception as e:
-            self._logger.error(traceback.format_exc())
-            return {'stat': -999, 'msg': str(e)}
-
-        return {'stat':res.get('ret_code',-1) , 'msg':res.get('msg')}
\ No newline at end of file
@@ -2,16 +2,14 @@
 #!/usr/bin/python3
 
 import asyncio
-from collections import deque
 from datetime import datetime, timedelta, timezone
 import time
 import traceback
 import pandas as pd
 
 import pybotters
-from pybotters.store import DataStore
 
-from libs.utils import TimeConv, Scheduler, LockCounter
+from libs.utils import TimeConv, Scheduler, LockCounter, KlineStore
 from libs.market import *
 from libs.exchanges.base_module import MultiProc_WS, RestAPIExchange, WebsocketExchange
 from libs.account import AccountInfo, OpenPositionGross, OpenPositionKeepAveLinear
@@ -19,7 +17,7 @@ from libs.account import AccountInfo, OpenPositionGross, OpenPositionKeepAveLine
 # https://api.coin.z.com/docs/#private-api
 # https://api.coin.z.com/docs/#references
 
-class Kline(DataStore):
+class Kline(KlineStore):
     _KEYS = ['symbol', 'interval', 'timestamp']
     _MAXLEN = 1000000
 
@@ -119,39 +117,24 @@ class GMOCoin(pybotters.GMOCoinDataStore, TimeConv, RestAPIExchange, WebsocketEx
         self._client = pybotters.Client(apis={'gmocoin': [apikey[0],apikey[1]]}, base_url=self._api_url)
         self._candle_api_lock = asyncio.Lock()
         self._datastore_lock = LockCounter(self._logger, self.__class__.__name__)
-        self._order_dict_lock = LockCounter(self._logger, "order_dict")
         self._candle_subscribed = {}
         super().__init__()
         self.create_candle_class('candle')
         self.PendingUntil = time.time()
-        self._get_request = deque(maxlen=3)
-        self._post_request = deque(maxlen=3)
 
         RestAPIExchange.__init__(self)
         WebsocketExchange.__init__(self)
 
+        # GETは1秒に2回、POSTは2秒に2回
+        self.rate_limiter.add_bucket('get', rate=2, capacity=2)
+        self.rate_limiter.add_bucket('post', rate=1, capacity=2)
+
     # APIリミットの管理 (GMOにはリミットカウンタが無い）
-    async def check_get_request_limit(self):
-        self._get_request.append(time.time())
-        if len(self._get_request)<3 :            # 3回
-            return
-        t = self._get_request.popleft()
-        w = t+1-time.time()                      # 1秒あたり
-        if w>0 :
-            self._logger.info( "get request sleep : {:.3f}".format(w) )
-            await asyncio.sleep(w)
-        return
-
-    async def check_post_request_limit(self):
-        self._post_request.append(time.time())
-        if len(self._post_request)<3 :           # 3回
-            return
-        t = self._post_request.popleft()
-        w = t+2-time.time()                      # 2秒あたり
-        if w>0 :
-            self._logger.info( "post request sleep : {:.3f}".format(w) )
-            await asyncio.sleep(w)
-        return
+    async def check_get_request_limit(self, lane='query'):
+        return await self.rate_limiter.acquire('get', lane)
+
+    async def check_post_request_limit(self, lane='order'):
+        return await self.rate_limiter.acquire('post', lane)
 
     def _check_api_responce(self,r):
         if r.status != 200 :
@@ -366,9 +349,10 @@ class GMOCoin(pybotters.GMOCoinDataStore, TimeConv, RestAPIExchange, WebsocketEx
             super()._onmessage(msg,ws)
 
     def _on_executions(self,msg):
-        self.execution_info.time = self._utcstr_to_dt(msg['timestamp'])
-        self.execution_info.append_latency((self._jst_now_dt().timestamp() - self.execution_info.time.timestamp())*1000)
-        self.execution_info.append_execution(float(msg['price']),float(msg['size']),msg['side'],self.execution_info.time)
+        timestamp = self._utcstr_to_ns(msg['timestamp'])
+        self.execution_info.time = self._ns_to_dt(timestamp)
+        self.execution_info.append_latency(time.time()*1000 - timestamp/1000000)
+        self.execution_info.append_execution_ns(float(msg['price']),float(msg['size']),msg['side'],timestamp)
         self.my.position.ref_ltp = self.execution_info.last
         self.execution_info._event.set()
 
@@ -403,7 +387,10 @@ class GMOCoin(pybotters.GMOCoinDataStore, TimeConv, RestAPIExchange, WebsocketEx
         """
         self._logger.trace( self.__class__.__name__ + " : EXECUTION : " + str(msg) )
 
-        self._order_dict_lock.wait()
+        # 発注中でまだ登録されていない注文のイベントは new_order で登録されるまで保留される
+        self.my.order.apply(str(msg['orderId']), self._on_my_execution_event, msg)
+
+    def _on_my_execution_event(self,msg):
         # オーダーリストから削除
         order_info = self.my.order.executed( id=str(msg['orderId']), side=msg['side'], price=float(msg['executionPrice']), size=float(msg['executionSize']) )
 
@@ -429,7 +416,10 @@ class GMOCoin(pybotters.GMOCoinDataStore, TimeConv, RestAPIExchange, WebsocketEx
         """
         self._logger.debug( "_on_my_orders= " + message['orderStatus'] + " : " + str(message) )
 
-        self._order_dict_lock.wait()
+        # 発注中でまだ登録されていない注文のイベントは new_order で登録されるまで保留される
+        self.my.order.apply(str(message['orderId']), self._on_my_order_event, message)
+
+    def _on_my_order_event(self,message):
         if message['orderStatus']=='ORDERED' :
             if self.my.order.update_order( id=str(message['orderId']), side=message['side'], price=float(message['orderPrice']), size=float(message['orderSize']) ) :
                 self._logger.debug( 'updated order dict: {}'.format(self.my.order.order_dict) )
@@ -513,7 +503,7 @@ class GMOCoin(pybotters.GMOCoinDataStore, TimeConv, RestAPIExchange, WebsocketEx
             try:
                 responce = ''
                 params = {'symbol': target_symbol, 'interval': "1min", 'date':date_str}
-                await self.check_get_request_limit()
+                await self.check_get_request_limit('candle')
                 res = await self._client.get("/public/v1/klines", params=params)
                 self._check_api_responce(res)
                 responce = await res.json()
@@ -612,7 +602,7 @@ class GMOCoin(pybotters.GMOCoinDataStore, TimeConv, RestAPIExchange, WebsocketEx
     # APIからTickerを取得
     async def ticker_api(self, **kwrgs):
         try:
-            await self.check_get_request_limit()
+            await self.check_get_request_limit('candle')
             res = await self._client.get('/public/v1/ticker', params={'symbol': kwrgs.get('symbol', self.symbol)})
             self._check_api_responce(res)
             data = await res.json()
@@ -741,7 +731,7 @@ class GMOCoin(pybotters.GMOCoinDataStore, TimeConv, RestAPIExchange, WebsocketEx
                 params['settlePosition'] = [{'positionId':int(o['position_id']), 'size':str(o['size'])}]
                 self._logger.debug("[sendorder(close)] : {}".format(params) )
                 await self.check_post_request_limit()
-                with self._order_dict_lock :
+                with self.my.order.sending() :
                     try:
                         r = await self._client.post('/private/v1/closeOrder', data=params)
                         self._check_api_responce(r)
@@ -763,6 +753,7 @@ class GMOCoin(pybotters.GMOCoinDataStore, TimeConv, RestAPIExchange, WebsocketEx
                         # {'status': 4, 'messages': [{'message_code': 'ERR-5003', 'message_string': 'Requests are too many.'}]
                         elif res.get('messages',[{}])[0].get('message_code')=='ERR-5003' :
                             # APIリミットエラーの場合には次のアクセスを2秒後まで禁止
+                            self.rate_limiter.update('post', 0)
                             await asyncio.sleep(2)
 
                     except Exception:
@@ -774,7 +765,7 @@ class GMOCoin(pybotters.GMOCoinDataStore, TimeConv, RestAPIExchange, WebsocketEx
         self._logger.debug("[sendorder] : {}".format(params) )
 
         await self.check_post_request_limit()
-        with self._order_dict_lock :
+        with self.my.order.sending() :
             try:
                 r = await self._client.post('/private/v1/order', data=params)
                 self._check_api_responce(r)
@@ -793,6 +784,7 @@ class GMOCoin(pybotters.GMOCoinDataStore, TimeConv, RestAPIExchange, WebsocketEx
                 # {'status': 4, 'messages': [{'message_code': 'ERR-5003', 'message_string': 'Requests are too many.'}]
                 elif res.get('messages',[{}])[0].get('message_code')=='ERR-5003' :
                     # APIリミットエラーの場合には次のアクセスを2秒後まで禁止
+                    self.rate_limiter.update('post', 0)
                     self.PendingUntil = max(self.PendingUntil, time.time()+2)
 
                 self._logger.error("Send order param : {}".format(params) )
@@ -827,7 +819,7 @@ class GMOCoin(pybotters.GMOCoinDataStore, TimeConv, RestAPIExchange, WebsocketEx
         self.my.order.mark_as_invalidate( id )
 
         try:
-            await self.check_post_request_limit()
+            await self.check_post_request_limit('cancel')
             r = await self._client.post('/private/v1/cancelOrder', data=kwargs)
             self._check_api_responce(r)
             res = await r.json()
@@ -847,9 +839,54 @@ class GMOCoin(pybotters.GMOCoinDataStore, TimeConv, RestAPIExchange, WebsocketEx
             # {'status': 4, 'messages': [{'message_code': 'ERR-5003', 'message_string': 'Requests are too many.'}]
             elif res.get('messages',[{}])[0].get('message_code')=='ERR-5003' :
                 # APIリミットエラーの場合には次のアクセスを2秒後まで禁止
+                self.rate_limiter.update('post', 0)
                 self.PendingUntil = max(self.PendingUntil, time.time()+2)
 
             return {'stat':res.get('status') , 'msg':res.get('messages')}
 
         return {'stat': 0, 'msg': ""}
 
+    # オーダーの変更 (GMOの変更APIは価格のみなので、数量を変更する場合はキャンセルと出し直し)
+    async def amend_order(self, id, price=None, size=None, **kwargs):
+        """
+        amend_order( id,             # 変更するオーダーのID
+                     price=None,     # 変更後の価格
+                     size=None )     # 変更後の注文数量 (約定済みの分を含む。指定した場合はキャンセルと出し直し)
+
+        return: { 'stat': エラーコード,      # 変更成功時 0
+                  'msg':  エラーメッセージ,
+                  'ids' : 変更後のオーダーIDのリスト
+                }
+        """
+        if size is not None or price is None :
+            return await RestAPIExchange.amend_order(self, id, price=price, size=size, **kwargs)
+
+        if id not in self.my.order.order_dict :
+            self._logger.info("ID:{} is already filled or canceld or expired".format(id) )
+            return {'stat': -999, 'msg': "Order is already filled or canceld or expired", 'ids': []}
+
+        price = self.round_order_price(price)
+        params = {'orderId':int(id), 'price':str(price)}
+        self._logger.debug("[amend_order] : {}".format(params) )
+
+        with self.my.order.amending(id) :
+            try:
+                await self.check_post_request_limit('amend')
+                r = await self._client.post('/private/v1/changeOrder', data=params)
+                self._check_api_responce(r)
+                res = await r.json()
+            except Exception as e:
+                self._logger.error(traceback.format_exc())
+                return {'stat': -999, 'msg': str(e), 'ids': []}
+
+            if res.get('status')==0 :
+                self.my.order.amend_order( id, price=price )
+                if 'auto_cancel_after' in kwargs :
+                    self.my.order.refresh_expire( id, kwargs['auto_cancel_after'] )
+                return {'stat': 0, 'msg': "", 'ids': [id]}
+
+        self._logger.error("Error response [amend_order id:{}] : {}".format(id,res) )
+        if res.get('messages',[{}])[0].get('message_code')=='ERR-5003' :
+            self.rate_limiter.update('post', 0)
+            self.PendingUntil = max(self.PendingUntil, time.time()+2)
+        return {'stat':res.get('status') , 'msg':res.get('messages'), 'ids': []}
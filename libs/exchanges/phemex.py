@@ -2,7 +2,6 @@
 #!/usr/bin/python3
 
 import asyncio
-from collections import deque
 from datetime import datetime, timedelta, timezone
 import random
 import time
@@ -10,8 +9,7 @@ import traceback
 import pandas as pd
 
 import pybotters
-from pybotters.store import DataStore
-from libs.utils import TimeConv, LockCounter
+from libs.utils import TimeConv, LockCounter, KlineStore
 from libs.market import *
 from libs.exchanges.base_module import MultiProc_WS, RestAPIExchange, WebsocketExchange
 from libs.account import AccountInfo, OpenPositionKeepAve, OpenPositionKeepAveLinear
@@ -21,7 +19,7 @@ from libs.account import AccountInfo, OpenPositionKeepAve, OpenPositionKeepAveLi
 # https://github.com/phemex/phemex-python-api/blob/master/phemex/client.py
 # https://github.com/ccxt/ccxt/blob/master/python/ccxt/phemex.py
 
-class Kline(DataStore):
+class Kline(KlineStore):
     _KEYS = ['symbol', 'interval', 'timestamp']
     _MAXLEN = 3000000
 
@@ -69,44 +67,32 @@ class Phemex(pybotters.PhemexDataStore, TimeConv, RestAPIExchange, WebsocketExch
         self._client = pybotters.Client(apis={self.exchange_name: [apikey[0],apikey[1]]}, base_url=self._api_url)
         self._candle_api_lock = asyncio.Lock()
         self._datastore_lock = LockCounter(self._logger, self.__class__.__name__)
-        self._order_dict_lock = LockCounter(self._logger, "order_dict")
         self._candle_subscribed = []
         self._candle_subscribe_id = 300
         super().__init__()
 
         self.PendingUntil = time.time()
         self.RateLimitRemaining = 500
-        self._request_count = deque(maxlen=300)
 
         RestAPIExchange.__init__(self)
         WebsocketExchange.__init__(self)
 
+        # contract グループ (privateのAPI) は1分に500回 (残り20回はキャンセル・変更用に残す)、publicは5分に5000回
+        self.rate_limiter.add_bucket('contract', rate=500/60, capacity=500, reserve=20)
+        self.rate_limiter.add_bucket('public', rate=5000/300, capacity=1000)
+
     # APIリミットの管理
-    def _update_api_limit(self,r):
+    def _update_api_limit(self,r, bucket='contract'):
         if r.status != 200 :
             self._logger.error( "{}: {}".format(r.status, r.reason) )
         self.RateLimitRemaining = int(r.headers.get('X-RateLimit-Remaining-CONTRACT',self.RateLimitRemaining))
+        self.rate_limiter.update(bucket, r.headers.get('X-RateLimit-Remaining-CONTRACT'), limit=500)
         if 'X-RateLimit-Retry-After-CONTRACT' in r.headers :
-            self.PendingUntil = max(self.api.PendingUntil, time.time()+r.headers['X-RateLimit-Retry-After-CONTRACT'])
-
-    async def check_request_limit(self):
-        # 前回オーダーから60秒以上経っていたらカウンターを初期化
-        if len(self._request_count)!=0 :
-            t = self._request_count.pop()
-            if time.time()-t>60 :
-                self.RateLimitRemaining = 500
-            self._request_count.append(t)
-
-        # 今回の時間を追加
-        self._request_count.append(time.time())
-        if len(self._request_count)<300 :        # 300回
-            return
-        t = self._request_count.popleft()
-        w = t+60-time.time()                     # 60秒あたり
-        if w>0 :
-            self._logger.info( "public request sleep : {:.3f}".format(w) )
-            await asyncio.sleep(w)
-        return
+            self.PendingUntil = max(self.PendingUntil, time.time()+float(r.headers['X-RateLimit-Retry-After-CONTRACT']))
+            self.rate_limiter.update(bucket, 0)
+
+    async def check_request_limit(self, lane='query', timeout=None, bucket='contract'):
+        return await self.rate_limiter.acquire(bucket, lane, timeout)
 
     @property
     def api_remain1(self):
@@ -123,6 +109,11 @@ class Phemex(pybotters.PhemexDataStore, TimeConv, RestAPIExchange, WebsocketExch
     def minimum_order_size(self, symbol=None):
         return self._minimum_order_size_dict.get(symbol or self.symbol, 1)
 
+    # 注文数量は契約数 (整数) 単位
+    def _round_order_size(self, value, symbol=None):
+        size_unit = self.minimum_order_size(symbol)
+        return int(round(value/size_unit)*size_unit)
+
     def round_order_price(self, price, symbol=None):
         price_unit = self._price_unit_dict.get((symbol or self.symbol),1)
         return round(round(price/price_unit)*price_unit, 8)
@@ -158,9 +149,9 @@ class Phemex(pybotters.PhemexDataStore, TimeConv, RestAPIExchange, WebsocketExch
         self.symbol = symbol
 
         # マーケット情報の取得
-        await self.check_request_limit()
+        await self.check_request_limit(bucket='public')
         res = await self._client.get('/public/products')
-        self._update_api_limit(res)
+        self._update_api_limit(res, 'public')
         data = await res.json()
         market_info = [s for s in data['data']['products'] if s['type']=='Perpetual']
 
@@ -306,49 +297,52 @@ class Phemex(pybotters.PhemexDataStore, TimeConv, RestAPIExchange, WebsocketExch
 
         self._logger.debug("_on_my_orders={}".format(message))
 
-        self._order_dict_lock.wait()
+        # 発注中でまだ登録されていない注文のイベントは new_order で登録されるまで保留される
         for d in message.get('orders',[]) :
-            id = d.get('orderID')
-            if d['ordStatus']=='New' :
-                if self.my.order.update_order(id, side=d['side'].upper(), price=float(d['priceEp'])/10000, size=d['orderQty']) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] "+d['action']+" : " + str(d) )
+            self.my.order.apply(d.get('orderID'), self._on_my_order, d)
 
-                else:
-                    self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
+    def _on_my_order(self,d):
+        id = d.get('orderID')
+        if d['ordStatus']=='New' :
+            if self.my.order.update_order(id, side=d['side'].upper(), price=float(d['priceEp'])/10000, size=d['orderQty']) :
+                self._logger.debug( self.__class__.__name__ + " : [order] "+d['action']+" : " + str(d) )
 
-            elif d['ordStatus']=='Canceled' and d['action']!='Replace':
-                if self.my.order.remove_order( id ) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] Canceled : " + str(d) )
+            else:
+                self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
 
+        elif d['ordStatus']=='Canceled' and d['action']!='Replace':
+            if self.my.order.remove_order( id ) :
+                self._logger.debug( self.__class__.__name__ + " : [order] Canceled : " + str(d) )
+
+            else:
+                self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
+
+        elif d['ordStatus']=='Filled' :
+            if self.my.order.executed( id=id, side=d['side'].upper(), price=d['execPriceEp']/10000, size=d['execQty'] ) :
+                self._logger.debug( self.__class__.__name__ + " : [order] Filled : " + str(d) )
+                if self.is_linear :
+                    self.my.position.executed( id, price=d['execPriceEp']/10000, side=d['side'].upper(), size=d['execQty'],
+                                                commission=self._round(-d['execQty']*self._order_rate[self.symbol]*d['execPriceEp']*d['feeRateEr']/1000000000000) )
                 else:
-                    self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
-
-            elif d['ordStatus']=='Filled' :
-                if self.my.order.executed( id=id, side=d['side'].upper(), price=d['execPriceEp']/10000, size=d['execQty'] ) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] Filled : " + str(d) )
-                    if self.is_linear :
-                        self.my.position.executed( id, price=d['execPriceEp']/10000, side=d['side'].upper(), size=d['execQty'],
-                                                    commission=self._round(-d['execQty']*self._order_rate[self.symbol]*d['execPriceEp']*d['feeRateEr']/1000000000000) )
-                    else:
-                        self.my.position.executed( id, price=d['execPriceEp']/10000, side=d['side'].upper(), size=d['execQty'],
-                                                    commission=self._round(-d['execQty']*self._order_rate[self.symbol]/d['execPriceEp']*d['feeRateEr']/10000) )
-                else:
-                    self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
-
-            elif d['ordStatus']=='PartiallyFilled' :
-                if self.my.order.executed( id=id, side=d['side'].upper(), price=d['execPriceEp']/10000, size=d['execQty'] ) :
-                    self._logger.debug( self.__class__.__name__ + " : [order] PartiallyFilled : " + str(d) )
-                    if self.is_linear :
-                        self.my.position.executed( id, price=d['execPriceEp']/10000, side=d['side'].upper(), size=d['execQty'],
-                                                    commission=self._round(-d['execQty']*self._order_rate[self.symbol]*d['execPriceEp']*d['feeRateEr']/1000000000000) )
-                    else:
-                        self.my.position.executed( id, price=d['execPriceEp']/10000, side=d['side'].upper(), size=d['execQty'],
-                                                    commission=self._round(-d['execQty']*self._order_rate[self.symbol]/d['execPriceEp']*d['feeRateEr']/10000) )
+                    self.my.position.executed( id, price=d['execPriceEp']/10000, side=d['side'].upper(), size=d['execQty'],
+                                                commission=self._round(-d['execQty']*self._order_rate[self.symbol]/d['execPriceEp']*d['feeRateEr']/10000) )
+            else:
+                self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
+
+        elif d['ordStatus']=='PartiallyFilled' :
+            if self.my.order.executed( id=id, side=d['side'].upper(), price=d['execPriceEp']/10000, size=d['execQty'] ) :
+                self._logger.debug( self.__class__.__name__ + " : [order] PartiallyFilled : " + str(d) )
+                if self.is_linear :
+                    self.my.position.executed( id, price=d['execPriceEp']/10000, side=d['side'].upper(), size=d['execQty'],
+                                                commission=self._round(-d['execQty']*self._order_rate[self.symbol]*d['execPriceEp']*d['feeRateEr']/1000000000000) )
                 else:
-                    self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
-
+                    self.my.position.executed( id, price=d['execPriceEp']/10000, side=d['side'].upper(), size=d['execQty'],
+                                                commission=self._round(-d['execQty']*self._order_rate[self.symbol]/d['execPriceEp']*d['feeRateEr']/10000) )
             else:
-                self._logger.debug( self.__class__.__name__ + " : [order] Unknown : " + str(d) )
+                self._logger.trace( self.__class__.__name__ + " : Not My order : " + str(id) )
+
+        else:
+            self._logger.debug( self.__class__.__name__ + " : [order] Unknown : " + str(d) )
 
     # 損益額の丸め
     def _round(self,value):
@@ -404,9 +398,9 @@ class Phemex(pybotters.PhemexDataStore, TimeConv, RestAPIExchange, WebsocketExch
 
             try:
                 responce = ''
-                await self.check_request_limit()
+                await self.check_request_limit('candle', bucket='public')
                 res = await self._client.get('/exchange/public/md/kline', params={'symbol':target_symbol, 'resolution':60, 'from':starttime, 'to':min(endtime,limittime)})
-                self._update_api_limit(res)
+                self._update_api_limit(res, 'public')
 
                 # 429: Too Many Requests
                 if res.status==429:
@@ -515,9 +509,9 @@ class Phemex(pybotters.PhemexDataStore, TimeConv, RestAPIExchange, WebsocketExch
     # APIからTickerを取得
     async def ticker_api(self, **kwrgs):
         try:
-            await self.check_request_limit()
+            await self.check_request_limit(bucket='public')
             res = await self._client.get('/md/ticker/24hr', params={'symbol': kwrgs.get('symbol', self.symbol)})
-            self._update_api_limit(res)
+            self._update_api_limit(res, 'public')
             if res.status==200:
                 data = await res.json()
                 self.my.position.ref_ltp = data['result']['close']/10000
@@ -605,9 +599,9 @@ class Phemex(pybotters.PhemexDataStore, TimeConv, RestAPIExchange, WebsocketExch
             self._logger.info("No trade period" )
             return {'stat': -999, 'msg': "No trade period", 'ids': []}
 
-        if self.RateLimitRemaining<10:
-            self._logger.info("RateLimitRemaining : {}/500".format(self.RateLimitRemaining) )
-            return {'stat': -999, 'msg': "RateLimitRemaining "+str(self.RateLimitRemaining)+"/500", 'ids': []}
+        if not await self.check_request_limit('order', timeout=1) :
+            self._logger.info("RateLimitRemaining : {:.1f}/500".format(self.rate_limiter.tokens('contract')) )
+            return {'stat': -999, 'msg': "RateLimitRemaining {:.1f}/500".format(self.rate_limiter.tokens('contract')), 'ids': []}
 
         if self.PendingUntil > time.time() :
             self._logger.info("Order pending : {:.1f}sec".format(self.PendingUntil-time.time()) )
@@ -647,9 +641,8 @@ class Phemex(pybotters.PhemexDataStore, TimeConv, RestAPIExchange, WebsocketExch
             return {'stat': -153, 'msg': '最低取引数量を満たしていません', 'ids': []}
 
         self._logger.info("[sendorder] : {}".format(params) )
-        with self._order_dict_lock :
+        with self.my.order.sending() :
             try:
-                await self.check_request_limit()
                 r = await self._client.post('/orders', data=params)
                 self._update_api_limit(r)
                 res = await r.json()
@@ -685,10 +678,6 @@ class Phemex(pybotters.PhemexDataStore, TimeConv, RestAPIExchange, WebsocketExch
             self._logger.info("ID:{} is already filled or canceld or expired".format(id) )
             return {'stat':-999 , 'msg':"Order is already filled or canceld or expired"}
 
-        if self.RateLimitRemaining<10:
-            self._logger.info("RateLimitRemaining : {}/120".format(self.RateLimitRemaining) )
-            return {'stat': -999, 'msg': "RateLimitRemaining "+str(self.RateLimitRemaining)+"/120", 'ids': []}
-
         kwargs['orderID']=id
         kwargs['symbol']=kwargs.get("symbol", self.my.order.order_dict[id]['symbol'] )
 
@@ -697,7 +686,7 @@ class Phemex(pybotters.PhemexDataStore, TimeConv, RestAPIExchange, WebsocketExch
         self.my.order.mark_as_invalidate( id )
 
         try:
-            await self.check_request_limit()
+            await self.check_request_limit('cancel')
             r = await self._client.delete('/orders/cancel', params=kwargs)
             self._update_api_limit(r)
             res = await r.json()
@@ -718,19 +707,56 @@ class Phemex(pybotters.PhemexDataStore, TimeConv, RestAPIExchange, WebsocketExch
         self._logger.error("Error response [cancelorder] : {}".format(res) )
         return {'stat':ret_code , 'msg':res.get('msg')}
 
-    # 変更
-    async def changeorder(self, id, price, **kwargs ):
-        try:
-            params = {'orderID':id, 'symbol':self.symbol,
-                      'priceEp':int((self.round_order_price(price,kwargs.get('symbol', self.my.order.order_dict.get(id,{}).get('symbol',self.symbol))))*10000)}
-            self._logger.info("[changeorder] : {}".format(params) )
-            await self.check_request_limit()
-            r = await self._client.put('/orders/replace', params=params)
-            self._update_api_limit(r)
-            res = await r.json()
+    # オーダーの変更 (価格・数量を変更しても同じIDのまま)
+    async def amend_order(self, id, price=None, size=None, **kwargs):
+        """
+        amend_order( id,             # 変更するオーダーのID
+                     price=None,     # 変更後の価格 (省略時は変更しない)
+                     size=None )     # 変更後の注文数量 (約定済みの分を含む。省略時は変更しない)
 
-        except Exception as e:
-            self._logger.error( traceback.format_exc() )
-            return {'stat': -999, 'msg': str(e)}
-        return {'stat':res.get('code',-1) , 'msg':res.get('msg')}
+        return: { 'stat': エラーコード,      # 変更成功時 0
+                  'msg':  エラーメッセージ,
+                  'ids' : [id]
+                }
+        """
+        if id not in self.my.order.order_dict :
+            self._logger.info("ID:{} is already filled or canceld or expired".format(id) )
+            return {'stat': -999, 'msg': "Order is already filled or canceld or expired", 'ids': []}
+
+        symbol = kwargs.get('symbol', self.my.order.order_dict[id].get('symbol',self.symbol))
+        params = {'orderID':id, 'symbol':symbol}
+        if price is not None :
+            price = self.round_order_price(price, symbol)
+            params['priceEp'] = int(price*10000)
+        if size is not None :
+            size = params['orderQty'] = self._round_order_size(size, symbol=symbol)
+            # 最低取引量のチェック（無駄なAPIを叩かないように事前にチェック）
+            if size<self.minimum_order_size(symbol=symbol) :
+                return {'stat': -153, 'msg': '最低取引数量を満たしていません', 'ids': []}
+
+        # レスポンスより先に届いた約定は、変更の成否をオーダーリストに反映してから適用する
+        with self.my.order.amending(id) :
+            try:
+                self._logger.info("[amend_order] : {}".format(params) )
+                await self.check_request_limit('amend')
+                r = await self._client.put('/orders/replace', params=params)
+                self._update_api_limit(r)
+                res = await r.json()
+            except Exception as e:
+                self._logger.error( traceback.format_exc() )
+                return {'stat': -999, 'msg': str(e), 'ids': []}
+
+            ret_code = res.get('code',-999)
+            if ret_code==0 :
+                self.my.order.amend_order( id, price=price, size=size )
+                if 'auto_cancel_after' in kwargs :
+                    self.my.order.refresh_expire( id, kwargs['auto_cancel_after'] )
+                return {'stat': 0, 'msg': "", 'ids': [id]}
+
+        self._logger.error("Error response [amend_order] : {}".format(res) )
+        return {'stat':ret_code , 'msg':res.get('msg'), 'ids': []}
+
+    # 価格の変更 (従来の名前)
+    async def changeorder(self, id, price, **kwargs ):
+        return await self.amend_order(id, price=price, **kwargs)
 
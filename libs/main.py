@@ -32,6 +32,15 @@ class Trade(object):
             self.trade_yaml.start()    # 自動更新スタート
             self.strategy_yaml.start() # 自動更新スタート
 
+            # websocketサブプロセスからのイベント転送方式
+            self._logger.ws_transport = self.trade_yaml.params.get('ws_transport','queue')
+            self._logger.ws_shm_size = self.trade_yaml.params.get('ws_shm_size',16)
+            self._logger.ws_normalize = self.trade_yaml.params.get('ws_normalize',False)
+            self._logger.board_engine = self.trade_yaml.params.get('board_engine','dict')
+
+            # 建玉・損益・統計ファイルの fsync のタイミング
+            self._logger.journal_fsync = self.trade_yaml.params.get('journal_fsync','interval')
+
             # 取引所クラスの作成
             apikey = [self.trade_yaml.params.get('trade',{}).get('apikey',''),
                       self.trade_yaml.params.get('trade',{}).get('secret',''),
@@ -96,14 +105,13 @@ class Trade(object):
             os._exit(0)
 
         try :
-            matplot_lock = LockCounter(self._logger, "matplot_lock")
+            # グラフ描画用の常駐プロセス
+            self.plot_renderer = PlotRenderer(self._logger)
             # ポジショングラフのプロットクラス
-            self.posgraph = PositionGraph(self._logger, stats=self.stats, strategy=strategy_yaml_file, lock=matplot_lock,
-                                      setting = self.strategy_yaml.params.get('plot',{}).get('setting',{}),
-                                      terminate=self.strategy_yaml.params.get('discord_bot_token','')=='' )
+            self.posgraph = PositionGraph(self._logger, stats=self.stats, strategy=strategy_yaml_file, renderer=self.plot_renderer,
+                                      setting = self.strategy_yaml.params.get('plot',{}).get('setting',{}) )
             # 損益グラフのプロットクラス
-            self.profgraph = ProfitGraph(self._logger, stats=self.stats, strategy=strategy_yaml_file, lock=matplot_lock,
-                                        terminate=self.strategy_yaml.params.get('discord_bot_token','')=='')
+            self.profgraph = ProfitGraph(self._logger, stats=self.stats, strategy=strategy_yaml_file, renderer=self.plot_renderer)
 
             # 1時間ごとに現在のパラメータ表示
             Scheduler(self._logger, interval=3600, basetime=1, callback=self._disp_params)
@@ -171,7 +179,8 @@ class Trade(object):
         # 発注中のオーダーをキャンセル
         ids = [o['id'] for o in self.exchange.my.order.list]
         self._logger.info( "candel orders : {}".format(ids) )
-        await asyncio.gather(*[self.exchange.cancelorder( id ) for id in ids])
+        if ids :
+            await self.exchange.cancelorders( ids )
 
         timeout = 60
         while len(self.exchange.my.order.list)!=0 and timeout>0:
@@ -270,6 +279,16 @@ class Trade(object):
         if self.exchange.auth!=None:
             self.exchange.my.disp_stats()
 
+        # 定期実行ジョブの実行時間
+        self._logger.timer_wheel.disp_stats()
+
+        # 板情報などのロック待ち時間
+        RWLock.disp_stats(self._logger)
+
+        # APIリミットでの待ち時間と自動キャンセルの遅れ
+        if hasattr(self.exchange,'disp_api_stats'):
+            self.exchange.disp_api_stats()
+
         # strategy.yaml の 'parameters' 項目だけをリスト表示
         self.strategy_yaml.params['parameters']={}
         self.strategy_yaml.load_param()
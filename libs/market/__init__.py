@@ -2,11 +2,15 @@
 #!/usr/bin/python3
 
 __all__ = ['BoardInfo',
+           'BoardInfoArray',
            'ExecuionInfo',
+           'ExecutionRing',
            'TickerInfo',
            'GaitameUSDJPY']
 
 from .board_info import BoardInfo
+from .board_array import BoardInfoArray
 from .execution_info import ExecuionInfo
+from .execution_ring import ExecutionRing
 from .ticker_info import TickerInfo
 from .kawase import *
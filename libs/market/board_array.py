@@ -0,0 +1,386 @@
+# coding: utf-8
+#!/usr/bin/python3
+
+from bisect import bisect_left
+from operator import itemgetter
+import numpy as np
+from libs.market.board_info import BoardInfo
+
+# 片側の板
+#   keys          : 呼び値単位の価格の整数キーを昇順に並べたリスト (ベスト側が末尾になるように asks は符号を反転)
+#   prices, sizes : keys と同じ並びの価格・サイズのリスト (更新とベスト付近の参照はリストのまま行う)
+#   levels        : float64 (capacity,2) [price, size] の配列 (参照された時に変更のあった位置以降だけを書き戻す)
+#   ベスト側を末尾に置くことで、ベスト付近の挿入・削除でずれるのは末尾の数件だけになり、書き戻しもその分だけで済む
+class _BookSide(object):
+    def __init__(self, sign, tick_size, capacity=1024):
+        self.sign = sign
+        self._key_scale = -sign/tick_size     # 価格 → 整数キー
+        self.keys = []
+        self._key_set = set()
+        self.prices = []
+        self.sizes = []
+        self.levels = np.zeros((capacity,2), dtype=np.float64)
+        self._synced = 0        # levels[:_synced] はリストと一致している
+        self.version = 0
+        self._depth_version = -1
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def best(self):
+        return self.prices[-1]
+
+    # ベスト側が先頭になる [price, size] の配列 (コピー無し)
+    @property
+    def view(self):
+        n = len(self.keys)
+        synced = self._synced
+        if synced < n :
+            if n > len(self.levels) :
+                levels = np.zeros((max(n, len(self.levels)*2),2), dtype=np.float64)
+                levels[:synced] = self.levels[:synced]
+                self.levels = levels
+            self.levels[synced:n,0] = self.prices[synced:]
+            self.levels[synced:n,1] = self.sizes[synced:]
+        self._synced = n
+        return self.levels[n-1::-1] if n!=0 else self.levels[:0]
+
+    # ベスト側からの累積サイズ (先頭 n 価格分)
+    #   板が更新されたら捨てて、参照された範囲までだけ後ろへ継ぎ足していく
+    def depth(self, n):
+        if self._depth_version != self.version :
+            self._depth = self.levels[:0,1]
+            self._depth_version = self.version
+        m = len(self._depth)
+        if m < n :
+            tail = np.cumsum(self.view[m:n,1])
+            if m!=0 :
+                tail += self._depth[m-1]
+            self._depth = np.concatenate((self._depth, tail))
+        return self._depth[:n]
+
+    # strategy から self.asks[0][0] や self.asks[:5] のように参照された場合の互換アクセス (ベスト側が先頭)
+    def __getitem__(self, index):
+        prices, sizes = self.prices, self.sizes
+        last = len(prices)-1
+        if isinstance(index, slice) :
+            return [[prices[last-i], sizes[last-i]] for i in range(*index.indices(last+1))]
+        if index < 0 :
+            index += last+1
+        if not 0 <= index <= last :
+            raise IndexError("board index out of range")
+        return [prices[last-index], sizes[last-index]]
+
+    def __iter__(self):
+        for price, size in zip(reversed(self.prices), reversed(self.sizes)):
+            yield [price, size]
+
+    # 価格・サイズの組をまとめて反映 (サイズ0は削除)
+    def update(self, prices, sizes):
+        keys = self.keys
+        key_set = self._key_set
+        level_prices = self.prices
+        level_sizes = self.sizes
+        key_scale = self._key_scale
+        synced = self._synced
+        self.version += 1
+        if len(keys)==0 :
+            # スナップショットなど空の板への反映は、先頭への挿入を繰り返さないようにまとめて並べる
+            levels = {}
+            for price, size in zip(prices, sizes):
+                key = round(price*key_scale)
+                if size==0 :
+                    levels.pop(key, None)
+                else:
+                    levels[key] = (price, size)
+            keys.extend(sorted(levels))
+            key_set.update(keys)
+            level_prices.extend([levels[key][0] for key in keys])
+            level_sizes.extend([levels[key][1] for key in keys])
+            self._synced = 0
+            return
+        for price, size in zip(prices, sizes):
+            key = round(price*key_scale)
+            if size==0 :
+                # 板に無い価格の削除は多いので二分探索の前に弾く
+                if key not in key_set :
+                    continue
+                key_set.remove(key)
+                i = bisect_left(keys, key)
+                del keys[i]
+                del level_prices[i]
+                del level_sizes[i]
+            elif key in key_set :
+                i = bisect_left(keys, key)
+                level_sizes[i] = size
+            else:
+                key_set.add(key)
+                i = bisect_left(keys, key)
+                keys.insert(i, key)
+                level_prices.insert(i, price)
+                level_sizes.insert(i, size)
+            if i < synced :
+                synced = i
+        self._synced = synced
+
+    def set(self, price, size):
+        self.update((price,), (size,))
+
+# 板情報を管理するクラス (NumPy配列版)
+#   BoardInfo と同じインターフェースで、価格を呼び値(tick_size)単位の整数キーで並べた配列で保持する
+#   strategy からは asks_array / bids_array でコピー無しに [price, size] の配列を参照できる
+class BoardInfoArray(BoardInfo):
+    _scan_levels = 32       # 累積サイズの配列は書き戻しだけで参照できるので、早めに配列側へ切り替える
+
+    def __init__(self, logger, tick_size=1):
+        self._tick_size = tick_size
+        super().__init__(logger)
+
+    def _clear(self):
+        self._asks = _BookSide(1, self._tick_size)
+        self._bids = _BookSide(-1, self._tick_size)
+        self._asks_index = self._asks     # 累積サイズのインデックスは板そのものが兼ねる
+        self._bids_index = self._bids
+        self._id_price = {}
+
+    # ---------------------------------------Type A
+    # bitflyer/FTX/Coinbase/Kraken/Phemex/binance/GMO
+    def _update(self, side, d, sign):
+        if len(d)==0 :
+            return
+        # 価格・サイズの取り出しと数値化は map で行い、update のループ内で1件ずつ取り出す
+        if type(d[0])==dict :
+            side.update(map(float, map(itemgetter('price'), d)), map(float, map(itemgetter('size'), d))) # binance/GMO
+        else:
+            side.update(map(float, map(itemgetter(0), d)), map(float, map(itemgetter(1), d)))            # bitflyer/FTX/Coinbase/Kraken/Phemex
+
+    def _update_array(self, side, prices, sizes, sign):
+        side.update(prices, sizes)
+
+    # ---------------------------------------Type B / Type C
+    # id で届く差分は id→価格 の対応を保持して価格キーに変換する (価格順に並ぶので sign は不要)
+    def _sd_and_key(self, data):
+        return (self._bids if data['side']=='Buy' else self._asks), data['id']
+
+    def _insert(self, data, conv):
+        for d in data:
+            side, id = self._sd_and_key(d)
+            price = float(d['price'])
+            self._id_price[id] = price
+            side.set(price, conv(float(d['size']), price))
+
+    def _change(self, data, conv):
+        for d in data:
+            side, id = self._sd_and_key(d)
+            price = self._id_price.get(id)
+            if price :
+                side.set(price, conv(float(d['size']), price))
+
+    def _delete(self, data):
+        for d in data:
+            side, id = self._sd_and_key(d)
+            price = self._id_price.pop(id, None)
+            if price :
+                side.set(price, 0)
+
+    # bitmex / Btcmex / bybit(sign=-1)
+    def insert(self, data, sign=1):
+        with self._lock.write():
+            self._insert(data, lambda size, price: size/price)
+
+    def change(self, data, sign=1):
+        with self._lock.write():
+            self._change(data, lambda size, price: size/price)
+
+    def delete(self, data, sign=1):
+        with self._lock.write():
+            self._delete(data)
+
+    # bybit linear(sign=-1)
+    def insert2(self, data, sign=1):
+        with self._lock.write():
+            self._insert(data, lambda size, price: size)
+
+    def change2(self, data, sign=1):
+        with self._lock.write():
+            self._change(data, lambda size, price: size)
+
+    def delete2(self, data, sign=1):
+        with self._lock.write():
+            self._delete(data)
+
+    @property
+    def bids(self): return self._bids # bidsは買い板
+
+    @property
+    def asks(self): return self._asks # askは売り板
+
+    @property
+    def best_bid(self):
+        with self._lock:
+            return float(self._bids.prices[-1]) if len(self._bids)!=0 else float(0)
+
+    @property
+    def best_ask(self):
+        with self._lock:
+            return float(self._asks.prices[-1]) if len(self._asks)!=0 else float(0)
+
+    # ベスト側から _scan_levels 価格までリストを辿って splitsize ごとの価格を求める (打ち切った場合の扱いは BoardInfo._scan と同じ)
+    def _scan(self, side, splitsize, limitprice, limitnum, startprice):
+        prices, sizes = side.prices, side.sizes
+        sign = side.sign
+        start = startprice*sign
+        limit = start+limitprice
+        total = 0
+        pos = []
+        i = len(prices)-1
+        stop = max(-1, i-self._scan_levels)
+        while i > stop :
+            price = prices[i]
+            key = price*sign
+            if startprice==0 :
+                startprice = price
+                start, limit = key, key+limitprice
+            elif key <= start :
+                i -= 1
+                continue
+            total += sizes[i]
+            if total > splitsize :
+                pos.append(price)
+                if len(pos)>=limitnum :
+                    return pos, None, len(prices)-i
+                total -= splitsize
+            if key > limit :
+                return pos, None, len(prices)-i
+            i -= 1
+        return pos, (total if i>=0 else None), len(prices)-1-i
+
+
+
+
+# テストコード (板更新のベンチマーク)
+#   python3 -m libs.market.board_array [TRACEレベルで記録したbitFlyerのtradeログ]
+#   ログを指定した場合は "recv data [...]" に記録された lightning_board のメッセージを、
+#   指定しない場合は生成したランダムな差分を BoardInfo と BoardInfoArray の両方に流して比較する
+if __name__ == "__main__":
+    import ast
+    import gc
+    import random
+    import sys
+    import time
+
+    class DummyLogger(object):
+        running = False
+        ws_timestamp = 0
+        def trace(self, str): pass
+        def info(self, str): print(str)
+        def error(self, str): print(str)
+
+    def load_messages(filename):
+        messages = []
+        with open(filename, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                pos = line.find('recv data [')
+                if pos<0 or 'lightning_board' not in line :
+                    continue
+                try:
+                    msg = ast.literal_eval(line[pos+11:line.rindex(']')])
+                    messages.append(msg['params'])
+                except Exception:
+                    pass
+        return messages
+
+    def generate_messages(num=20000, mid=5000000):
+        messages = [{'channel':'lightning_board_snapshot_FX_BTC_JPY', 'message':{'mid_price':mid,
+                     'asks':[{'price':mid+i, 'size':round(random.random(),8)} for i in range(1,3000)],
+                     'bids':[{'price':mid-i, 'size':round(random.random(),8)} for i in range(1,3000)]}}]
+        for i in range(num):
+            mid += random.randint(-3,3)
+            messages.append({'channel':'lightning_board_FX_BTC_JPY', 'message':{'mid_price':mid,
+                'asks':[{'price':mid+random.randint(1,200), 'size':random.choice([0,0,round(random.random(),8)])} for j in range(random.randint(1,10))]+
+                       [{'price':mid-j, 'size':0} for j in range(4)],
+                'bids':[{'price':mid-random.randint(1,200), 'size':random.choice([0,0,round(random.random(),8)])} for j in range(random.randint(1,10))]+
+                       [{'price':mid+j, 'size':0} for j in range(4)]}})
+        return messages
+
+    # 計測中は GC を止める (もう一方の板が持つ大量のリストを GC が辿る時間を含めないため)
+    def replay(board, messages, read=False):
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter()
+        for params in messages:
+            if params['channel'].startswith('lightning_board_snapshot') :
+                board.initialize_dict()
+            message = params['message']
+            board.update_asks(message.get('asks',[]))
+            board.update_bids(message.get('bids',[]))
+            if read :
+                # 板イベントごとに strategy が参照する想定
+                board.best_ask, board.best_bid, board.asks[:5], board.bids[:5]
+                board.get_size_group(splitsize=1, limitnum=5)
+        elapsed = time.perf_counter()-start
+        gc.enable()
+        return elapsed
+
+    messages = load_messages(sys.argv[1]) if len(sys.argv)>1 else generate_messages()
+    print( "{} board messages".format(len(messages)) )
+
+    # 計測のばらつきを抑えるため5回ずつ流して最短の時間で比較する (計測中の板以外は残さない)
+    def best_of(make_board, read, count=5):
+        elapsed = float('inf')
+        for i in range(count):
+            board = make_board()
+            elapsed = min(elapsed, replay(board, messages, read))
+            del board
+        return elapsed
+
+    logger = DummyLogger()
+    for read in (False, True):
+        t1 = best_of(lambda: BoardInfo(logger), read)
+        t2 = best_of(lambda: BoardInfoArray(logger, tick_size=1), read)
+        print( "---- {}".format("update + read (best/asks[:5]/get_size_group)" if read else "update only") )
+        print( "BoardInfo      : {:.3f}sec ({:.1f}us/msg)".format(t1, t1/len(messages)*1e6) )
+        print( "BoardInfoArray : {:.3f}sec ({:.1f}us/msg)".format(t2, t2/len(messages)*1e6) )
+
+    dict_board = BoardInfo(logger)
+    array_board = BoardInfoArray(logger, tick_size=1)
+    replay(dict_board, messages)
+    replay(array_board, messages)
+
+    # 両方の板が一致しているか確認
+    print( "asks match : {}".format(list(dict_board.asks)==list(array_board.asks)) )
+    print( "bids match : {}".format(list(dict_board.bids)==list(array_board.bids)) )
+    print( "best_ask/best_bid : {}/{}  {}/{}".format(dict_board.best_ask, dict_board.best_bid, array_board.best_ask, array_board.best_bid) )
+
+    # 板の参照系の比較 (板イベントごとの呼び出しを想定して、毎回ベスト付近の1価格を更新してから計測する)
+    def query(board, func, count=40, repeat=5):
+        elapsed = float('inf')
+        for r in range(repeat):
+            total = 0
+            for i in range(count):
+                best = board.best_ask
+                board.update_asks([[best, board.asks[0][1]+0.01]])
+                start = time.perf_counter()
+                result = func(board)
+                total += time.perf_counter()-start
+            elapsed = min(elapsed, total)
+        return elapsed/count*1e6, result
+
+    # サイズの合計は足し合わせる順番が異なるので誤差の範囲で比較
+    def same(r1, r2):
+        if isinstance(r1, dict) :
+            return r1.keys()==r2.keys() and all(same(r1[k], r2[k]) for k in r1)
+        if isinstance(r1, list) :
+            return len(r1)==len(r2) and all(same(x, y) for x, y in zip(r1, r2))
+        return abs(r1-r2)<1e-9
+
+    print( "---- query" )
+    for name, func in (("get_size_group(1, limitnum=5)",   lambda b: b.get_size_group(1, limitnum=5)),
+                       ("get_size_group(20, limitnum=10)", lambda b: b.get_size_group(20, limitnum=10)),
+                       ("get_size_group(50, limitnum=20)", lambda b: b.get_size_group(50, limitnum=20)),
+                       ("get_size_groups([1,5,20,50])",    lambda b: b.get_size_groups([1,5,20,50], limitnum=10)),
+                       ("get_price_group(10)",             lambda b: b.get_price_group(10))):
+        t1, r1 = query(dict_board, func)
+        t2, r2 = query(array_board, func)
+        print( "{:32}: BoardInfo {:8.1f}us  BoardInfoArray {:8.1f}us  match : {}".format(name, t1, t2, same(r1, r2)) )
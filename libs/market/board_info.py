@@ -1,44 +1,77 @@
 # coding: utf-8
 #!/usr/bin/python3
 
-import asyncio
 from collections import deque
-from itertools import groupby
+from itertools import chain
+import numpy as np
 from sortedcontainers import SortedDict
 import time
-from threading import Event,Thread
-import traceback
-from libs.utils import LockCounter
+from libs.utils import RWLock, EventDispatcher
+
+# 片側の板の累積サイズのインデックス
+#   SortedDict と同じ並び (ベスト側が先頭) の [price, size] の配列を持ち、参照された時に
+#   前回から更新のあったキーの範囲 (lo～hi) だけを SortedDict から取り出して差し替える
+#   累積サイズは差し替えた位置より手前はそのまま使い、参照された範囲までだけ後ろへ継ぎ足していく
+class _DepthIndex(object):
+    def __init__(self, sd, sign):
+        self.sd = sd
+        self.sign = sign
+        self.lo = float('inf')
+        self.hi = float('-inf')
+        self._levels = np.empty((0,2), dtype=np.float64)
+        self._depth = np.empty(0, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.sd)
+
+    def touch(self, key):
+        if key < self.lo : self.lo = key
+        if key > self.hi : self.hi = key
+
+    @property
+    def best(self):
+        return self.sd.peekitem(0)[1][0]
+
+    # ベスト側が先頭になる [price, size] の配列 (板が更新されるまでは同じ配列を返す)
+    @property
+    def view(self):
+        if self.lo <= self.hi :
+            self._apply()
+        return self._levels
+
+    def _apply(self):
+        sd = self.sd
+        i, j = sd.bisect_left(self.lo), sd.bisect_right(self.hi)
+        # lo より手前と hi より後ろの価格は変わっていないので、後ろ側は末尾からの位置で対応を取る
+        tail = len(self._levels)-(len(sd)-j)
+        levels = np.fromiter(chain.from_iterable(sd.values()[i:j]), dtype=np.float64, count=(j-i)*2).reshape(-1,2)
+        self._levels = np.concatenate((self._levels[:i], levels, self._levels[tail:]))
+        self._levels.flags.writeable = False
+        self._depth = self._depth[:i]
+        self.lo, self.hi = float('inf'), float('-inf')
+
+    # ベスト側からの累積サイズ (先頭 n 価格分)
+    def depth(self, n):
+        view = self.view
+        m = len(self._depth)
+        if m < n :
+            tail = np.cumsum(view[m:n,1])
+            if m!=0 :
+                tail += self._depth[m-1]
+            self._depth = np.concatenate((self._depth, tail))
+        return self._depth[:n]
 
 # 板情報を管理するクラス
 class BoardInfo(object):
     def __init__(self, logger):
         self._logger = logger
         self._clear()
-        self._event_list = []
-        self.event = Event() 
         self._event_time_lag = deque(maxlen=100)
-        self._lock = LockCounter(self._logger, self.__class__.__name__)
+        self._lock = RWLock(self._logger, self.__class__.__name__)
+        self.event = EventDispatcher(self._logger, self.__class__.__name__, on_dispatch=self._on_dispatch)
 
-        event_drive = Thread(target=self._event_drive, args=())
-        event_drive.daemon = True
-        event_drive.start()
-
-    def _event_drive(self):
-        while self._logger.running:
-            self.event.wait()
-            self.event.clear()
-            self._event_time_lag.append((time.time()-self._logger.ws_timestamp)*1000)
-
-            for handler, args in self._event_list:
-                try:
-                   if self._logger.running :
-                        future = asyncio.run_coroutine_threadsafe(handler(*args), self._logger.event_loop)
-                        result = future.result()
-
-                except Exception as e:
-                    self._logger.error( e )
-                    self._logger.info(traceback.format_exc())
+    def _on_dispatch(self):
+        self._event_time_lag.append((time.time()-self._logger.ws_timestamp)*1000)
 
     @property
     def event_time_lag(self):
@@ -47,77 +80,118 @@ class BoardInfo(object):
     def _mean(self,q) : return sum(q) / (len(q) + 1e-7)
 
     def initialize_dict(self):
-        self._lock.wait()
-        self._clear()
+        with self._lock.write():
+            self._clear()
 
     def _clear(self):
         self._asks = SortedDict()
         self._bids = SortedDict()
+        self._asks_index = _DepthIndex(self._asks, 1)
+        self._bids_index = _DepthIndex(self._bids, -1)
+
+    def _index_of(self, sd):
+        return self._asks_index if sd is self._asks else self._bids_index
 
     # ---------------------------------------Type A
     # bitFlyer
     def update_bids(self, d):
-        self._lock.wait()
-        self._update(self._bids, d, -1)
+        with self._lock.write():
+            self._update(self._bids, d, -1)
 
     def update_asks(self, d):
-        self._lock.wait()
-        self._update(self._asks, d, 1)
+        with self._lock.write():
+            self._update(self._asks, d, 1)
 
     def _update(self, sd, d, sign):
+        index = self._index_of(sd)
+        lo, hi = index.lo, index.hi
         for i in d:
             if type(i)==dict :
                 p, s = float(i['price']), float(i['size']) # binance/GMO
             else:
                 p, s = float(i[0]), float(i[1])          # bitflyer/FTX/Coinbase/Kraken/Phemex
+            key = p * sign
+            if s == 0:
+                if sd.pop(key, None) is None:
+                    continue
+            else:
+                sd[key] = [p, s]
+            if key < lo : lo = key
+            if key > hi : hi = key
+        index.lo, index.hi = lo, hi
+
+    # 受信プロセスで数値化済みの価格・サイズ配列
+    def update_bids_array(self, prices, sizes):
+        with self._lock.write():
+            self._update_array(self._bids, prices, sizes, -1)
+
+    def update_asks_array(self, prices, sizes):
+        with self._lock.write():
+            self._update_array(self._asks, prices, sizes, 1)
+
+    def _update_array(self, sd, prices, sizes, sign):
+        index = self._index_of(sd)
+        lo, hi = index.lo, index.hi
+        for p, s in zip(prices, sizes):
+            key = p * sign
             if s == 0:
-                s = sd.pop(p * sign, [0,0])[1]
+                if sd.pop(key, None) is None:
+                    continue
             else:
-                sd[p * sign] = [p, s]
+                sd[key] = [p, s]
+            if key < lo : lo = key
+            if key > hi : hi = key
+        index.lo, index.hi = lo, hi
 
     # ---------------------------------------Type B
     # bitmex / Btcmex / bybit(sign=-1)
     def insert(self, data, sign=1):
-        self._lock.wait()
-        for d in data:
-            sd, key = self._sd_and_key(d)
-            price, size = float(d['price']), d['size']
-            sd[key*sign] = [float(price), float(size)/float(price)]
+        with self._lock.write():
+            for d in data:
+                sd, key = self._sd_and_key(d)
+                price, size = float(d['price']), d['size']
+                sd[key*sign] = [float(price), float(size)/float(price)]
+                self._index_of(sd).touch(key*sign)
 
     def change(self, data, sign=1):
-        self._lock.wait()
-        for d in data:
-            sd, key = self._sd_and_key(d)
-            e = sd.get(key*sign,[0,0])
-            e[1] = float(d['size']) / e[0] if e[0]!=0 else float(d['price'])
+        with self._lock.write():
+            for d in data:
+                sd, key = self._sd_and_key(d)
+                e = sd.get(key*sign,[0,0])
+                e[1] = float(d['size']) / e[0] if e[0]!=0 else float(d['price'])
+                self._index_of(sd).touch(key*sign)
 
     def delete(self, data, sign=1):
-        self._lock.wait()
-        for d in data:
-            sd, key = self._sd_and_key(d)
-            sd.pop(key*sign, None)
+        with self._lock.write():
+            for d in data:
+                sd, key = self._sd_and_key(d)
+                if sd.pop(key*sign, None) is not None:
+                    self._index_of(sd).touch(key*sign)
 
     # ---------------------------------------Type C
     # bybit linear(sign=-1)
     def insert2(self, data, sign=1):
-        self._lock.wait()
-        for d in data:
-            sd, key = self._sd_and_key(d)
-            price, size = float(d['price']), d['size']
-            sd[key*sign] = [float(price), float(size)]
+        with self._lock.write():
+            for d in data:
+                sd, key = self._sd_and_key(d)
+                price, size = float(d['price']), d['size']
+                sd[key*sign] = [float(price), float(size)]
+                self._index_of(sd).touch(key*sign)
 
     def change2(self, data, sign=1):
-        self._lock.wait()
-        for d in data:
-            sd, key = self._sd_and_key(d)
-            e = sd.get(key*sign,[0,0])
-            e[1] = float(d['size'])
+        with self._lock.write():
+            for d in data:
+                sd, key = self._sd_and_key(d)
+                e = sd.get(key*sign,[0,0])
+                e[1] = float(d['size'])
+                self._index_of(sd).touch(key*sign)
 
     def delete2(self, data, sign=1):
-        self._lock.wait()
-        for d in data:
-            sd, key = self._sd_and_key(d)
-            sd.pop(key*sign, None)
+        with self._lock.write():
+            for d in data:
+                sd, key = self._sd_and_key(d)
+                if sd.pop(key*sign, None) is not None:
+                    self._index_of(sd).touch(key*sign)
 
     def _sd_and_key(self, data):
         if data['side'] == 'Buy':
@@ -132,6 +206,15 @@ class BoardInfo(object):
     @property
     def asks(self): return self._asks.values() # askは売り板
 
+    # [price, size] の配列 (ベスト側が先頭)
+    #   BoardInfo では累積サイズのインデックスが持つ書き込み不可の配列で、板が更新されるまでは同じ配列を返す
+    #   BoardInfoArray では板を保持している配列のコピー無しのビュー
+    @property
+    def bids_array(self): return self._bids_index.view
+
+    @property
+    def asks_array(self): return self._asks_index.view
+
     @property
     def best_bid(self):
         with self._lock:
@@ -146,41 +229,25 @@ class BoardInfo(object):
     def mid(self): return (self.best_bid + self.best_ask)/2
 
     def add_handler( self, handler, args=() ):
-        self._event_list.append( (handler, args) )
+        self.event.add_handler(handler, args)
+
+    @property
+    def event_stats(self):
+        return self.event.stats
 
     # splitsizeごとに板を分割して値段リストを算出
-    def get_size_group(self, splitsize, limitprice=1000000, limitnum=5, startprice=0):
+    #   ベスト付近で求まる場合は板をそのまま辿り、深くまで辿る必要がある場合は続きを累積サイズのインデックスから求める
+    _scan_levels = 32           # まず板をそのまま辿る価格数
+    _scan_levels_more = 256     # 続きもこの価格数以内で求まりそうならそのまま辿る
 
+    def get_size_group(self, splitsize, limitprice=1000000, limitnum=5, startprice=0):
         try:
             with self._lock:
-                total = 0
-                asks_pos = []
-                for price, size in self.asks:
-                    if price > startprice or startprice == 0:
-                        if startprice == 0:
-                            startprice = price
-                        total += size
-                        if total > splitsize :
-                            asks_pos.append( price )
-                            if len(asks_pos)>=limitnum :
-                                break
-                            total -= splitsize
-                        if price > startprice+limitprice:
-                            break
-                total = 0
-                bids_pos = []
-                for price, size in self.bids:
-                    if price < startprice or startprice == 0:
-                        if startprice == 0:
-                            startprice = price
-                        total += size
-                        if total > splitsize :
-                            bids_pos.append( price )
-                            if len(bids_pos)>=limitnum :
-                                break
-                            total -= splitsize
-                        if price < startprice-limitprice:
-                            break
+                asks_pos = self._size_group_one(self._asks_index, splitsize, limitprice, limitnum, startprice)
+                # startprice=0 なら asks のベスト価格を bids の基準にも使う
+                if startprice==0 and len(self._asks_index)!=0 :
+                    startprice = float(self._asks_index.best)
+                bids_pos = self._size_group_one(self._bids_index, splitsize, limitprice, limitnum, startprice)
         except :
             return {'ask': [self.mid]*limitnum, 'bid': [self.mid]*limitnum}
 
@@ -189,15 +256,257 @@ class BoardInfo(object):
 
         return {'ask': asks_pos, 'bid': bids_pos}
 
-    # splitsizeごとに板を分割して値段リストを算出
+    def _size_group_one(self, side, splitsize, limitprice, limitnum, startprice):
+        pos, carry, offset = self._scan(side, splitsize, limitprice, limitnum, startprice)
+        if carry is None :
+            return pos
+        return pos + self._size_group(side, [splitsize], limitprice, limitnum-len(pos), startprice, offset=offset, carry=carry)[0]
+
+    # ベスト側から板を辿って splitsize ごとの価格を求める
+    #   _scan_levels 価格を辿った時点で、残りを辿るのに必要な価格数をそれまでに集計した1価格あたりのサイズから見積もり
+    #   多ければ打ち切ってその時点の total と辿った価格数を返す (求まった場合の total は None)
+    def _scan(self, side, splitsize, limitprice, limitnum, startprice):
+        sign = side.sign
+        start = startprice*sign
+        limit = start+limitprice
+        total = 0
+        pos = []
+        skip = 0
+        levels = self._scan_levels
+        for count, (price, size) in enumerate(side.sd.values()):
+            if count==levels :
+                # ここまでに集計したサイズは total+splitsize*len(pos)
+                depth = total+splitsize*len(pos)
+                if depth==0 or (limitnum-len(pos))*splitsize*(count-skip)/depth > self._scan_levels_more :
+                    return pos, total, count
+            key = price*sign
+            if startprice==0 :
+                startprice = price
+                start, limit = key, key+limitprice
+            elif key <= start :
+                skip += 1
+                continue
+            total += size
+            if total > splitsize :
+                pos.append(price)
+                if len(pos)>=limitnum :
+                    return pos, None, 0
+                total -= splitsize
+            if key > limit :
+                return pos, None, 0
+        return pos, None, 0
+
+    # 複数の splitsize をまとめて算出
+    def get_size_groups(self, splitsizes, limitprice=1000000, limitnum=5, startprice=0):
+        try:
+            with self._lock:
+                asks_pos = self._size_group(self._asks_index, splitsizes, limitprice, limitnum, startprice)
+                if startprice==0 and len(self._asks_index)!=0 :
+                    startprice = float(self._asks_index.best)
+                bids_pos = self._size_group(self._bids_index, splitsizes, limitprice, limitnum, startprice)
+        except :
+            return [{'ask': [self.mid]*limitnum, 'bid': [self.mid]*limitnum} for splitsize in splitsizes]
+
+        result = []
+        for a, b in zip(asks_pos, bids_pos):
+            if len(b)==0 : b = [self.mid]*limitnum
+            if len(a)==0 : a = [self.mid]*limitnum
+            result.append({'ask': a, 'bid': b})
+        return result
+
+    # 累積サイズのインデックスから get_size_group と同じ価格を求める
+    #   offset, carry : ベスト側から offset 価格までを辿った後の total から続きを求める場合
+    def _size_group(self, side, splitsizes, limitprice, limitnum, startprice, offset=0, carry=0):
+        n = len(side)
+        if n==0 :
+            return [[] for splitsize in splitsizes]
+        view = side.view
+        key = view[:,0]*side.sign  # ベスト側から昇順
+        if startprice==0 :
+            start = key[0]
+            first = 0
+        else:
+            start = startprice*side.sign
+            first = int(key.searchsorted(start, side='right'))
+        first = max(first, offset)
+
+        # startprice+limitprice を超えた最初の価格までを対象とする
+        last = min(int(key.searchsorted(start+limitprice, side='right'))+1, n)
+        if first>=last :
+            return [[] for splitsize in splitsizes]
+
+        # limitnum 個目が記録されるのは、累積サイズが splitsize*limitnum を超えてから limitnum 価格以内なのでそこまでに絞る
+        #   (累積サイズはその位置が分かるところまでだけ求める)
+        base = (side.depth(first)[first-1] if first>0 else 0)-carry
+        need = base+max(splitsizes)*limitnum
+        end = min(last, first+max(64, limitnum*16))
+        depth = side.depth(end)
+        while end<last and depth[end-1]<=need :
+            end = min(last, end*2)
+            depth = side.depth(end)
+        last = min(last, int(depth.searchsorted(need, side='right'))+limitnum+2)
+        depth = depth[first:last]-base
+        index = np.arange(len(depth), dtype=np.float64)
+        nums = np.arange(1, limitnum+1, dtype=np.float64)
+
+        prices = view[first:last,0]
+        result = []
+        for splitsize in splitsizes:
+            # total から splitsize を1回ずつ引いていく逐次処理と同じ位置を求める
+            #   f : 累積サイズが超えた splitsize の倍数の数
+            #   k : その価格までに記録された数 (1価格で増えるのは1つまで)  k[i] = min(k[i-1]+1, f[i])
+            #   (ちょうど倍数になる場合に浮動小数点の誤差で超えたと判定しないよう僅かに小さくして比較)
+            f = np.ceil(depth*((1-1e-12)/splitsize))-1
+            k = index+np.minimum(np.minimum.accumulate(f-index), 1)
+            #   k は単調増加なので j 個目が記録される価格は k>=j となる最初の位置
+            hit = k.searchsorted(nums)
+            result.append(prices[hit[hit<len(k)]].tolist())
+        return result
+
+    # splitpriceごとに板を分割してサイズのリストを算出 (空の区間は含まない)
     def get_price_group(self, splitprice):
-
         mid = self.mid
         with self._lock:
-            asks_group = [sum([i['size'] for i in items]) for index, items in groupby([{'group':int((b[0]-mid)/splitprice), 'size':b[1]} for b in self.asks], key=lambda x: x['group'])]
-            bids_group = [sum([i['size'] for i in items]) for index, items in groupby([{'group':int((b[0]-mid)/splitprice), 'size':b[1]} for b in self.bids], key=lambda x: x['group'])]
+            asks_group = self._price_group(self._asks_index, mid, splitprice)
+            bids_group = self._price_group(self._bids_index, mid, splitprice)
         if len(asks_group)==0 : asks_group=[0]
         if len(bids_group)==0 : bids_group=[0]
 
         return {'ask': asks_group, 'bid': bids_group}
 
+    # 区間番号が変わる位置で区切って、区間ごとのサイズを合計する
+    def _price_group(self, side, mid, splitprice):
+        view = side.view
+        if len(view)==0 :
+            return []
+        group = np.trunc((view[:,0]-mid)/splitprice).astype(np.int64)
+        start = np.flatnonzero(np.diff(group, prepend=group[0]-1)!=0)
+        return np.add.reduceat(view[:,1], start).tolist()
+
+
+
+
+# テストコード (累積サイズのインデックスを使った参照と、板を先頭から辿る従来の処理との比較)
+#   python3 -m libs.market.board_info
+if __name__ == "__main__":
+    import random
+    from itertools import groupby
+
+    class DummyLogger(object):
+        running = False
+        ws_timestamp = 0
+        def trace(self, str): pass
+        def info(self, str): print(str)
+        def error(self, str): print(str)
+
+    # 従来の get_size_group
+    def size_group_loop(board, splitsize, limitprice=1000000, limitnum=5, startprice=0):
+        with board._lock:
+            return _size_group_loop(board, splitsize, limitprice, limitnum, startprice)
+
+    def _size_group_loop(board, splitsize, limitprice, limitnum, startprice):
+        total = 0
+        asks_pos = []
+        for price, size in board.asks:
+            if price > startprice or startprice == 0:
+                if startprice == 0:
+                    startprice = price
+                total += size
+                if total > splitsize :
+                    asks_pos.append( price )
+                    if len(asks_pos)>=limitnum :
+                        break
+                    total -= splitsize
+                if price > startprice+limitprice:
+                    break
+        total = 0
+        bids_pos = []
+        for price, size in board.bids:
+            if price < startprice or startprice == 0:
+                if startprice == 0:
+                    startprice = price
+                total += size
+                if total > splitsize :
+                    bids_pos.append( price )
+                    if len(bids_pos)>=limitnum :
+                        break
+                    total -= splitsize
+                if price < startprice-limitprice:
+                    break
+        if len(bids_pos)==0 : bids_pos = [board.mid]*limitnum
+        if len(asks_pos)==0 : asks_pos = [board.mid]*limitnum
+        return {'ask': asks_pos, 'bid': bids_pos}
+
+    # 従来の get_price_group
+    def price_group_loop(board, splitprice):
+        mid = board.mid
+        asks_group = [sum([i['size'] for i in items]) for index, items in groupby([{'group':int((b[0]-mid)/splitprice), 'size':b[1]} for b in board.asks], key=lambda x: x['group'])]
+        bids_group = [sum([i['size'] for i in items]) for index, items in groupby([{'group':int((b[0]-mid)/splitprice), 'size':b[1]} for b in board.bids], key=lambda x: x['group'])]
+        if len(asks_group)==0 : asks_group=[0]
+        if len(bids_group)==0 : bids_group=[0]
+        return {'ask': asks_group, 'bid': bids_group}
+
+    # サイズの合計は足し合わせる順番が異なるので誤差の範囲で比較
+    def same(r1, r2):
+        if isinstance(r1, dict) :
+            return r1.keys()==r2.keys() and all(same(r1[k], r2[k]) for k in r1)
+        if isinstance(r1, list) :
+            return len(r1)==len(r2) and all(same(x, y) for x, y in zip(r1, r2))
+        return abs(r1-r2)<1e-9
+
+    random.seed(1)
+    board = BoardInfo(DummyLogger())
+    mid = 5000000
+    board.update_asks([[mid+i, round(random.random(),8)] for i in range(1,3000)])
+    board.update_bids([[mid-i, round(random.random(),8)] for i in range(1,3000)])
+
+    # ベスト付近への差分を流しながら、毎回インデックスを使った処理と従来の処理の両方で求めて比較する
+    def step():
+        global mid
+        mid += random.randint(-3,3)
+        board.update_asks([[mid+random.randint(1,200), random.choice([0,0,round(random.random(),8)])] for j in range(random.randint(1,10))]+
+                          [[mid-j, 0] for j in range(4)])
+        board.update_bids([[mid-random.randint(1,200), random.choice([0,0,round(random.random(),8)])] for j in range(random.randint(1,10))]+
+                          [[mid+j, 0] for j in range(4)])
+
+    print( "---- query (after each board update)" )
+    for name, func, loop in (
+            ("get_size_group(1, limitnum=5)",   lambda b: b.get_size_group(1, limitnum=5),   lambda b: size_group_loop(b, 1, limitnum=5)),
+            ("get_size_group(20, limitnum=10)", lambda b: b.get_size_group(20, limitnum=10), lambda b: size_group_loop(b, 20, limitnum=10)),
+            ("get_size_group(50, limitnum=20)", lambda b: b.get_size_group(50, limitnum=20), lambda b: size_group_loop(b, 50, limitnum=20)),
+            ("get_size_group(5, startprice)",   lambda b: b.get_size_group(5, limitnum=10, startprice=b.mid+30), lambda b: size_group_loop(b, 5, limitnum=10, startprice=b.mid+30)),
+            ("get_size_groups([1,5,20,50])",    lambda b: b.get_size_groups([1,5,20,50], limitnum=10),
+                                                lambda b: [size_group_loop(b, s, limitnum=10) for s in (1,5,20,50)]),
+            ("get_price_group(10)",             lambda b: b.get_price_group(10),             lambda b: price_group_loop(b, 10))):
+        t1 = t2 = float('inf')
+        match = True
+        for r in range(3):
+            e1 = e2 = 0
+            for i in range(100):
+                step()
+                # 先に呼んだ方だけが更新直後のキャッシュミスを負わないように順番を入れ替える
+                for f in ((func, loop) if i%2==0 else (loop, func)):
+                    start = time.perf_counter()
+                    result = f(board)
+                    elapsed = time.perf_counter()-start
+                    if f is func :
+                        r1, e1 = result, e1+elapsed
+                    else:
+                        r2, e2 = result, e2+elapsed
+                match = match and same(r1, r2)
+            t1, t2 = min(t1, e1/100), min(t2, e2/100)
+        print( "{:32}: index {:8.1f}us  loop {:8.1f}us  match : {}".format(name, t1*1e6, t2*1e6, match) )
+
+    print( "asks_array match : {}".format(np.array_equal(board.asks_array, np.array(list(board.asks)))) )
+    print( "bids_array match : {}".format(np.array_equal(board.bids_array, np.array(list(board.bids)))) )
+
+    # id で届く差分 (bybit linear)
+    board = BoardInfo(DummyLogger())
+    board.insert2([{'side':'Sell', 'id':str(1000000+i), 'price':str(100+i*0.5), 'size':1+i} for i in range(1,50)]+
+                  [{'side':'Buy',  'id':str(1000000-i), 'price':str(100-i*0.5), 'size':1+i} for i in range(1,50)], sign=-1)
+    board.get_price_group(1)
+    board.change2([{'side':'Sell', 'id':'1000003', 'size':10}], sign=-1)
+    board.delete2([{'side':'Sell', 'id':'1000001'}, {'side':'Buy', 'id':'999990'}], sign=-1)
+    print( "type C asks_array match : {}".format(np.array_equal(board.asks_array, np.array(list(board.asks)))) )
+    print( "type C bids_array match : {}".format(np.array_equal(board.bids_array, np.array(list(board.bids)))) )
+    print( "type C get_size_group match : {}".format(same(board.get_size_groups([3])[0], size_group_loop(board, 3))) )
@@ -4,9 +4,9 @@
 import asyncio
 from collections import deque
 from libs.utils.time_conv import TimeConv
+from libs.utils.event_dispatcher import EventDispatcher
+from libs.market.execution_ring import ExecutionRing, ExecutionDeque
 import time
-from threading import Event,Thread
-import traceback
 
 # 約定情報を管理するクラス
 class ExecuionInfo(TimeConv):
@@ -19,42 +19,50 @@ class ExecuionInfo(TimeConv):
         self.avg_price_1s = 0             #　直近1秒の約定平均価格
         self.avg_latency_1s = 0           #　直近1秒の平均配信遅延
         self.last = self.best_ask = self.best_bid = 0
-        self._exec_que_list = []
+        self._exec_que_list = []         # dictを格納する従来形式のキュー
+        self.ring = ExecutionRing()       # 約定履歴 (列ごとの配列)
         self._latency = deque(maxlen=1000)
         self._event_time_lag = deque(maxlen=100)
 
         self.event = asyncio.Event() 
-        self._event = Event() 
-        event_drive = Thread(target=self._event_drive, args=())
-        event_drive.daemon = True
-        event_drive.start()
+        self._event = EventDispatcher(self._logger, self.__class__.__name__, on_dispatch=self._on_dispatch)
         self._logger.call_every1sec.append({'name':'update_ltp', 'handler':self._update_ltp, 'interval':1, 'counter':0})
 
-    def _event_drive(self):
-        while self._logger.running:
-            self._event.wait()
-            self._event.clear()
-            self._event_time_lag.append((time.time()-self._logger.ws_timestamp)*1000)
-            self.event.set()
-
-            for exec_que, handler, args in self._exec_que_list :
-                if len(exec_que)!=0 and self._logger.running :
-                    try:
-                        future = asyncio.run_coroutine_threadsafe(handler(*args), self._logger.event_loop)
-                        result = future.result()
-
-                    except Exception as e:
-                        self._logger.error( e )
-                        self._logger.info(traceback.format_exc())
+    def _on_dispatch(self):
+        self._event_time_lag.append((time.time()-self._logger.ws_timestamp)*1000)
+        self.event.set()
 
     @property
     def event_time_lag(self):
         return self._mean(self._event_time_lag)
 
+    # exec_que に collections.deque を渡した場合は従来通り dict を追加していく
+    # ExecutionReader / ExecutionDeque を渡した場合は ring から読み出す
     def add_handler( self, exec_que, handler, args=() ):
-        self._exec_que_list.append( [exec_que, handler, args] )
+        if not hasattr(exec_que, '_ring') and not hasattr(exec_que, '_reader') :
+            self._exec_que_list.append( [exec_que, handler, args] )
+        self._event.add_handler(handler, args, queue=exec_que)
+
+    # ring から列形式で読み出すためのリーダーを作成
+    def reader(self):
+        return self.ring.reader()
+
+    # ring から dict 形式で読み出す従来のキュー互換のアダプタを作成
+    def deque(self, maxlen=10000):
+        return ExecutionDeque(self.ring, maxlen=maxlen)
+
+    @property
+    def event_stats(self):
+        return self._event.stats
 
     def append_execution(self, price, size, side, exec_date, id='NONE'):
+        self._append(price, size, side, int(exec_date.timestamp()*1000000)*1000, id, exec_date)
+
+    # exec_date の代わりにエポックナノ秒を渡す (datetime を生成しない)
+    def append_execution_ns(self, price, size, side, timestamp, id='NONE'):
+        self._append(price, size, side, timestamp, id, None)
+
+    def _append(self, price, size, side, timestamp, id, exec_date):
         self.last = price
         self._executions.append( price )
 
@@ -62,9 +70,14 @@ class ExecuionInfo(TimeConv):
         if side=="BUY" : self.best_ask = price
         else:            self.best_bid = price
 
-        # 登録されているすべてのキューに約定履歴を突っ込む
-        for exec_que, handler, args in self._exec_que_list :
-            exec_que.append({'price':price, 'size':size, 'side':side, 'exec_date':exec_date, 'id':id})
+        self.ring.append(timestamp, price, size, side, id)
+
+        # 従来形式のキューには dict を突っ込む
+        if self._exec_que_list :
+            if exec_date is None :
+                exec_date = self._ns_to_dt(timestamp)
+            for exec_que, handler, args in self._exec_que_list :
+                exec_que.append({'price':price, 'size':size, 'side':side, 'exec_date':exec_date, 'id':id})
 
     def append_latency(self, latency):
         self._latency.append( latency )
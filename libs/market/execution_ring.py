@@ -0,0 +1,224 @@
+# coding: utf-8
+#!/usr/bin/python3
+
+from collections import namedtuple, deque
+from hashlib import blake2b
+import numpy as np
+from libs.utils.time_conv import TimeConv
+
+# 約定IDのハッシュ値 (プロセスをまたいで同じ値になる int64)
+def id_hash(id):
+    return int.from_bytes(blake2b(str(id).encode(), digest_size=8).digest(), 'little', signed=True)
+
+
+# 約定履歴を列ごとの配列に保持するリングバッファ
+#   timestamp : エポックナノ秒 (int64)
+#   price/size: float64
+#   side      : BUY=1 / SELL=-1 / その他(板寄せなど)=0 (int8)
+#   id_hash   : 約定IDのハッシュ値 (int64)  元のIDは dict 形式で取り出す場合のためにリストにも保持
+#               組み込みの hash() はプロセスごとにソルトが変わるので、正規化プロセスとメインプロセスで一致する blake2b を使う
+#   cursor    : これまでに書き込んだ件数 (単調増加)  書き込み位置は cursor % capacity
+class ExecutionRing(object):
+    SIDE = {'BUY':1, 'SELL':-1}
+    SIDE_STR = ('', 'BUY', 'SELL')    # SIDE_STR[side] で文字列に戻す (-1 は末尾の 'SELL')
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.timestamp = np.zeros(capacity, dtype=np.int64)
+        self.price = np.zeros(capacity, dtype=np.float64)
+        self.size = np.zeros(capacity, dtype=np.float64)
+        self.side = np.zeros(capacity, dtype=np.int8)
+        self.id_hash = np.zeros(capacity, dtype=np.int64)
+        self.ids = [None]*capacity
+        self.cursor = 0
+
+    def append(self, timestamp, price, size, side, id):
+        i = self.cursor % self.capacity
+        self.timestamp[i] = timestamp
+        self.price[i] = price
+        self.size[i] = size
+        self.side[i] = self.SIDE.get(side,0)
+        self.id_hash[i] = id_hash(id)
+        self.ids[i] = id
+        self.cursor += 1
+
+    def reader(self):
+        return ExecutionReader(self)
+
+    # start～end (cursor基準) の範囲を返す  バッファ内で連続していればコピー無しのビュー
+    def block(self, start, end):
+        s = start % self.capacity
+        e = s+(end-start)
+        if e <= self.capacity :
+            return ExecutionBlock(self.timestamp[s:e], self.price[s:e], self.size[s:e], self.side[s:e], self.id_hash[s:e], self.ids[s:e])
+        e -= self.capacity
+        return ExecutionBlock(np.concatenate((self.timestamp[s:], self.timestamp[:e])),
+                              np.concatenate((self.price[s:], self.price[:e])),
+                              np.concatenate((self.size[s:], self.size[:e])),
+                              np.concatenate((self.side[s:], self.side[:e])),
+                              np.concatenate((self.id_hash[s:], self.id_hash[:e])),
+                              self.ids[s:]+self.ids[:e])
+
+
+# 読み出した約定履歴 (各列は同じ長さの配列)
+#   ビューの場合は capacity 件の書き込みで上書きされるので、保持する場合はコピーすること
+ExecutionBlock = namedtuple('ExecutionBlock', ['timestamp', 'price', 'size', 'side', 'id_hash', 'id'])
+
+
+# 消費者ごとの読み出し位置
+class ExecutionReader(object):
+    def __init__(self, ring):
+        self._ring = ring
+        self.pos = ring.cursor
+        self.lost = 0       # 読み出しが間に合わず上書きされた件数
+
+    def _catch_up(self):
+        behind = self._ring.cursor-self.pos
+        if behind > self._ring.capacity :
+            self.lost += behind-self._ring.capacity
+            self.pos = self._ring.cursor-self._ring.capacity
+            return self._ring.capacity
+        return behind
+
+    # 未読の件数
+    def __len__(self):
+        return min(self._ring.cursor-self.pos, self._ring.capacity)
+
+    # 未読の約定をまとめて読み出す (limit を指定した場合は古い方から limit 件まで)
+    def read(self, limit=None):
+        count = self._catch_up()
+        if limit is not None :
+            count = min(count, limit)
+        block = self._ring.block(self.pos, self.pos+count)
+        self.pos += count
+        return block
+
+    # 未読の約定を1件ずつ (timestamp, price, size, side, id) で取り出す
+    def popleft(self):
+        if self._catch_up()==0 :
+            raise IndexError('pop from an empty ExecutionReader')
+        ring = self._ring
+        i = self.pos % ring.capacity
+        self.pos += 1
+        return int(ring.timestamp[i]), float(ring.price[i]), float(ring.size[i]), ring.SIDE_STR[ring.side[i]], ring.ids[i]
+
+    def clear(self):
+        self.pos = self._ring.cursor
+
+
+# 従来の ExecutionQueue (dictを格納したdeque) 互換のアダプタ
+#   取り出したときに初めて {'price','size','side','exec_date','id'} の dict を生成する
+#   strategy から append / extend / pop などで書き換えられた場合は、未読分を dict にして _buf に移してから deque として操作する
+#   (並びは _buf の後ろに ring の未読分が続く)
+class ExecutionDeque(TimeConv):
+    def __init__(self, ring, maxlen=10000):
+        self._reader = ExecutionReader(ring)
+        self._buf = deque()
+        self.maxlen = maxlen
+
+    def _skip_old(self):
+        over = len(self._buf)+len(self._reader)-self.maxlen
+        while over>0 and self._buf :
+            self._buf.popleft()
+            over -= 1
+        if over>0 :
+            self._reader.read(over)
+
+    def _to_dict(self, timestamp, price, size, side, id):
+        return {'price':price, 'size':size, 'side':side, 'exec_date':self._ns_to_dt(timestamp), 'id':id}
+
+    def _ring_dicts(self, block):
+        for i in range(len(block.price)):
+            yield self._to_dict(int(block.timestamp[i]), float(block.price[i]), float(block.size[i]),
+                                ExecutionRing.SIDE_STR[block.side[i]], block.id[i])
+
+    # ring の未読分を dict にして _buf の後ろへ移す
+    def _flush(self):
+        self._skip_old()
+        self._buf.extend(self._ring_dicts(self._reader.read()))
+
+    def __len__(self):
+        return min(len(self._buf)+len(self._reader), self.maxlen)
+
+    def __bool__(self):
+        return len(self)!=0
+
+    def popleft(self):
+        self._skip_old()
+        if self._buf :
+            return self._buf.popleft()
+        return self._to_dict(*self._reader.popleft())
+
+    def pop(self):
+        self._flush()
+        return self._buf.pop()
+
+    def append(self, item):
+        self._flush()
+        self._buf.append(item)
+        self._skip_old()
+
+    def extend(self, items):
+        self._flush()
+        self._buf.extend(items)
+        self._skip_old()
+
+    def appendleft(self, item):
+        self._buf.appendleft(item)
+        self._skip_old()
+
+    def clear(self):
+        self._buf.clear()
+        self._reader.clear()
+
+    # 未読の約定を取り出さずに参照
+    def __iter__(self):
+        self._skip_old()
+        yield from list(self._buf)
+        yield from self._ring_dicts(self._reader._ring.block(self._reader.pos, self._reader.pos+len(self._reader)))
+
+    # list(exec_list)[-10:] のようなスライスにも対応
+    def __getitem__(self, index):
+        if isinstance(index, slice) :
+            return list(self)[index]
+        n = len(self)
+        if index<0 : index += n
+        if index<0 or index>=n :
+            raise IndexError('ExecutionDeque index out of range')
+        self._skip_old()
+        if index<len(self._buf) :
+            return self._buf[index]
+        ring = self._reader._ring
+        i = (self._reader.pos+index-len(self._buf)) % ring.capacity
+        return self._to_dict(int(ring.timestamp[i]), float(ring.price[i]), float(ring.size[i]), ring.SIDE_STR[ring.side[i]], ring.ids[i])
+
+
+if __name__ == "__main__":
+    import subprocess
+    import sys
+
+    # 別プロセスでも同じハッシュ値になる
+    other = subprocess.run([sys.executable, '-c', 'from libs.market.execution_ring import id_hash; print(id_hash("JRF20220101-000000-000001"))'],
+                           capture_output=True, text=True).stdout
+    assert int(other)==id_hash("JRF20220101-000000-000001")
+
+    ring = ExecutionRing(capacity=8)
+    que = ExecutionDeque(ring, maxlen=6)
+    for i in range(4):
+        ring.append(1600000000000000000+i, 100.0+i, 0.01, 'BUY' if i%2 else 'SELL', f'id{i}')
+    assert [e['id'] for e in que]==['id0','id1','id2','id3'] and que[-1]['id']=='id3' and [e['id'] for e in que[1:3]]==['id1','id2']
+
+    # deque としての書き換えと、その後に届いた約定の並び
+    que.append({'price':1.0, 'size':1.0, 'side':'BUY', 'exec_date':None, 'id':'mine'})
+    que.appendleft({'price':1.0, 'size':1.0, 'side':'BUY', 'exec_date':None, 'id':'first'})
+    assert [e['id'] for e in que]==['first','id0','id1','id2','id3','mine']
+    for i in range(4, 6):
+        ring.append(1600000000000000000+i, 100.0+i, 0.01, 'BUY', f'id{i}')
+    assert [e['id'] for e in que]==['id1','id2','id3','mine','id4','id5']
+    assert len(que)==6 and que[3]['id']=='mine' and que.pop()['id']=='id5'
+    que.extend([{'id':'x'}, {'id':'y'}])
+    assert [e['id'] for e in que]==['id2','id3','mine','id4','x','y']
+    assert que.popleft()['id']=='id2' and len(que)==5
+    que.clear()
+    assert not que
+    print("ok")
@@ -1,7 +1,9 @@
 # coding: utf-8
 #!/usr/bin/python3
 
-__all__ = ['PositionGraph','ProfitGraph']
+__all__ = ['PositionGraph','ProfitGraph','PlotRenderer','StatsFrame']
 
 from .pos_graph import PositionGraph
 from .prof_graph import ProfitGraph
+from .renderer import PlotRenderer
+from .stats_frame import StatsFrame
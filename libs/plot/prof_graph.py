@@ -2,34 +2,21 @@
 #!/usr/bin/python3
 
 import asyncio
-from ctypes import c_uint, c_float, c_double
 from datetime import datetime, timedelta
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.dates as mdates
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-from multiprocessing import Process, Queue
-from multiprocessing.sharedctypes import RawArray
 import numpy as np
-import os
 import pandas
-import platform
-import psutil
-import queue
-import signal
 from threading import Thread, Lock, Event
 import time
 import traceback
+from libs.plot.stats_frame import StatsFrame
 
 # 日次損益グラフをプロットするクラス
 class ProfitGraph(object):
-    def __init__(self, logger, stats, strategy, lock, terminate=True):
+    def __init__(self, logger, stats, strategy, renderer):
         self._logger = logger
         self._stats = stats
         self._strategy = strategy
-        self._lock = lock
-        self._terminate = terminate
+        self._renderer = renderer
         self._plotting = Lock()
         self._run_plot = Event()
         self._args = {'image_file':'', 'exchange':None, 'days':1, 'fmt':'%H:%M', 'rotate':0}
@@ -64,212 +51,50 @@ class ProfitGraph(object):
                 if days==1 :
                     if self._plotting.locked() :
                         continue
-                    org_stats = self._stats.get_stats()
+                    records = self._stats.get_stats_array()
                 else:
-                    org_stats = self._stats.get_all_stats()
-                if len(org_stats)==0 :
+                    records = self._stats.get_stats_array(all=True)
+                if len(records)==0 :
                     continue
 
                 with self._plotting:
-                    if days==1 :
-                        # 日次モード
-                        t=0
-                        stats=[]
-                        for s in org_stats:
-                            if t+20 < s['timestamp'] and time.time()-s['timestamp']<86400 :
-                                stats.append(s)
-                                t=s['timestamp']
-                        stats.append(org_stats[-1])
-                    else:
-                        # 長期モード
-                        cumsum = 0
-                        t=0
-                        last_day = (datetime.utcfromtimestamp(org_stats[0]['timestamp'])+timedelta(hours=9)).day
-                        last_profit = 0
-                        stats=[]
-                        last = org_stats[-1]['profit']
-                        for s in org_stats:
-                            if (t+600 <= s['timestamp'] or s.get('keep',False)) and time.time()-s['timestamp']<86400*days :
-                                # 日付が変わったら変わる直前の最後の損益までを加算
-                                day = (datetime.utcfromtimestamp(s['timestamp'])+timedelta(hours=9)).day
-                                if last_day != day :
-                                    cumsum += last_profit
-                                last_day = day
-                                last_profit = s['profit']
-                                s['profit'] += cumsum
-                                stats.append(s)
-                                t=s['timestamp']
-                        org_stats[-1]['profit'] = last+cumsum
-                        stats.append(org_stats[-1])
+                    history_timestamp, price_history = self._preprocess(StatsFrame(records), time.time(), days, exchange.units()['unitrate']==1)
 
-                    price_history_raw = [(1 if exchange.units()['unitrate']==1 else float(s['ltp']))*(s['profit']-stats[0]['profit']) for s in stats]
-                    price_history = list(pandas.Series(price_history_raw).rolling(window=20, min_periods=1).mean())
-                    price_history[-1] = price_history_raw[-1]
-
-                    self._lock.wait()
                     self._logger.info("[plot] Start plotting profit graph" )
+                    start = time.time()
 
-                    history_timestamp = RawArray(c_double, len(stats))
-                    np.asarray(history_timestamp)[:] = [float(s['timestamp']) for s in stats]
-                    price_history_array = RawArray(c_double, len(price_history))
-                    np.asarray(price_history_array)[:] = price_history
-
-                    self._lock.wait()
-                    with self._lock :
-                        start = time.time()
-
-                        event_queue = Queue()
-                        pnlplot_proc = MulitiprocessingPnlPlot( event_queue,
-                            history_timestamp = history_timestamp,
-                            price_history = price_history_array,
-                            )
-                        sub_process = Process(target=pnlplot_proc._plot,
-                            args=(image_file,
-                                  rotate,
-                                  fmt,
-                                  exchange.units(round(price_history[-1],4))['title']
-                                  ))
-                        sub_process.daemon = True
-                        sub_process.start()
-
-                        while True:
-                            try:
-                                event = event_queue.get(timeout=180)
-                            except Queue.Empty:
-                                break
-                            if event[0] == 'done' :
-                                break
-                            elif event[0] == 'pid' :
-                                proc = psutil.Process( int(event[1]) )
-                                self._logger.info( "[plot] procid = {}".format(int(event[1])) )
-                                if platform.system() == 'Windows':
-                                    proc.nice( psutil.IDLE_PRIORITY_CLASS )
-                                else:
-                                    proc.nice(19)
-                            elif event[0] == 'logger.info' :
-                                self._logger.info(event[1])
-                            elif event[0] == 'logger.error' :
-                                self._logger.error(event[1])
-
-                        if self._terminate :
-                            sub_process.terminate()
-                            sub_process.join(10)
-
-                        self._logger.info("[plot] Finish plotting profit graph in {:.2f}sec".format(time.time()-start) )
+                    render_time = self._renderer.render('profit' if days==1 else 'profit_all', image_file,
+                                        data={'history_timestamp':history_timestamp, 'price_history':price_history},
+                                        args={'rotate':rotate, 'fmt':fmt, 'title':exchange.units(round(price_history[-1],4))['title']})
+                    if render_time is not None :
+                        self._logger.info("[plot] Finish plotting profit graph in {:.2f}sec (render {:.2f}sec)".format(time.time()-start, render_time) )
 
                     self._discord_message = '{} 損益通知 {} Profit:{:+.0f}'.format((datetime.utcnow()+timedelta(hours=9)).strftime('%H:%M:%S'), self._strategy, price_history[-1])
 
             except Exception:
                 self._logger.error( traceback.format_exc() )
 
-
-class MulitiprocessingPnlPlot():
-
-    def __init__(self, event_queue, **argv ):
-        self._event_queue = event_queue
-        self._argv = argv
-
-    def _plot(self, image_file, rotate, fmt, title):
-        # Ctrl+Cのシグナルを無効にしておく。(メインからのstop()で終了させるので。)
-        signal.signal(signal.SIGINT,  signal.SIG_IGN)
-
-        try:
-            self._event_queue.put( ('pid', os.getpid()) )
-
-            history_timestamp = list(self._argv['history_timestamp'])
-            price_history = list(self._argv['price_history'])
-
-            fig = plt.figure(tight_layout=True)
-            ax = fig.subplots(1,1)
-            fig.autofmt_xdate()
-
-            ax.set_facecolor('#fafafa')
-            ax.spines['top'].set_visible(False)
-            ax.spines['bottom'].set_visible(False)
-            ax.spines['left'].set_visible(False)
-            ax.spines['right'].set_visible(False)
-            ax.grid(which='major', linestyle='-', color='#101010', alpha=0.1, axis='y')
-            if rotate == 0:
-                ax.tick_params(width=0, length=0)
-            else:
-                ax.tick_params(width=1, length=5)
-            ax.tick_params(axis='x', colors='#c0c0c0')
-            ax.tick_params(axis='y', colors='#c0c0c0')
-            if fmt != '':
-                ax.xaxis.set_major_formatter(mdates.DateFormatter(fmt))
-            ax.yaxis.set_major_formatter(ticker.ScalarFormatter())
-            ax.yaxis.get_major_formatter().set_scientific(False)
-            ax.yaxis.get_major_formatter().set_useOffset(False)
-
-            green1 = '#10b285'
-            green2 = '#9cdcd0'
-            red1 = '#e25447'
-            red2 = '#f0b8b8'
-
-            if price_history[-1] >= 0:
-                ax.set_title(title, color=green1, fontsize=28)
-            else:
-                ax.set_title(title, color=red1, fontsize=28)
-
-            last = 0
-            plus_times = []
-            plus_price = []
-            minus_times = []
-            minus_price = []
-            for i in range(0, len(history_timestamp)):
-                if last * price_history[i] >= 0:
-                    if price_history[i] >= 0:
-                        plus_times.append(datetime.fromtimestamp(history_timestamp[i]))
-                        plus_price.append(price_history[i])
-                    if price_history[i] <= 0:
-                        minus_times.append(datetime.fromtimestamp(history_timestamp[i]))
-                        minus_price.append(price_history[i])
-                else:
-                    cross_point = price_history[i-1]/(price_history[i-1]-price_history[i])*(history_timestamp[i]-history_timestamp[i-1])+history_timestamp[i-1]
-                    if price_history[i] < 0:
-                        plus_times.append(datetime.fromtimestamp(cross_point))
-                        plus_price.append(0)
-                        ax.plot(plus_times, plus_price, color=green1, linewidth=0.8)
-                        ax.fill_between(plus_times, plus_price, 0, color=green2, alpha=0.25)
-                        plus_times = []
-                        plus_price = []
-                        minus_times = []
-                        minus_price = []
-                        minus_times.append(datetime.fromtimestamp(cross_point))
-                        minus_price.append(0)
-                        minus_times.append(datetime.fromtimestamp(history_timestamp[i]))
-                        minus_price.append(price_history[i])
-                    else:
-                        minus_times.append(datetime.fromtimestamp(cross_point))
-                        minus_price.append(0)
-                        ax.plot(minus_times, minus_price, color=red1, linewidth=0.8)
-                        ax.fill_between(minus_times, minus_price, 0, color=red2, alpha=0.25)
-                        plus_times = []
-                        plus_price = []
-                        minus_times = []
-                        minus_price = []
-                        plus_times.append(datetime.fromtimestamp(cross_point))
-                        plus_price.append(0)
-                        plus_times.append(datetime.fromtimestamp(history_timestamp[i]))
-                        plus_price.append(price_history[i])
-                last = price_history[i]
-
-            if len(plus_times) > 0:
-                ax.plot(plus_times, plus_price, color=green1, linewidth=0.8)
-                ax.fill_between(plus_times, plus_price, 0, color=green2, alpha=0.25)
-
-            if len(minus_times) > 0:
-                ax.plot(minus_times, minus_price, color=red1, linewidth=0.8)
-                ax.fill_between(minus_times, minus_price, 0, color=red2, alpha=0.25)
-
-            labels = ax.get_xticklabels()
-            plt.setp(labels, rotation=rotate)
-
-            plt.savefig(image_file, facecolor='#fafafa')
-            plt.close()
-
-        except Exception:
-            self._event_queue.put(('logger.error',traceback.format_exc()))
-            self._logger.error( traceback.format_exc() )
-
-        self._event_queue.put(('done',))
+    # 描画データの作成
+    #   日次モード : 1日以内のレコードを20秒間隔に間引く
+    #   長期モード : days日以内のレコードを600秒間隔に間引き (keepのレコードは残す)、日付が変わるごとに前日最後の損益を積み上げる
+    #   最後のレコードは常に追加
+    @staticmethod
+    def _preprocess(frame, now, days, unitrate):
+        last = len(frame)-1
+        profit = frame['profit']
+        if days==1 :
+            index = np.append(frame.thin(20, start=frame.timestamp.searchsorted(now-86400, 'right')), last)
+            profit = profit[index]
+        else:
+            selected = frame.thin(600, start=frame.timestamp.searchsorted(now-86400*days, 'right'), strict=False, keep=frame['keep'])
+            # 日付が変わったら変わる直前の最後の損益までを加算
+            day = StatsFrame.jst_day(frame.timestamp[selected])
+            changed = day != np.concatenate((StatsFrame.jst_day(frame.timestamp[:1]), day[:-1]))
+            cumsum = np.cumsum(np.where(changed, np.concatenate(([0], profit[selected][:-1])), 0))
+            index = np.append(selected, last)
+            profit = np.append(profit[selected]+cumsum, profit[last]+(cumsum[-1] if len(cumsum) else 0))
+
+        price_history_raw = (1 if unitrate else frame['ltp'][index])*(profit-profit[0])
+        price_history = pandas.Series(price_history_raw).rolling(window=20, min_periods=1).mean().to_numpy(copy=True)
+        price_history[-1] = price_history_raw[-1]
+        return frame.timestamp[index], price_history
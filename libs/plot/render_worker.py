@@ -0,0 +1,270 @@
+# coding: utf-8
+#!/usr/bin/python3
+
+from datetime import datetime
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.dates as mdates
+import matplotlib.pyplot as plt
+import matplotlib.ticker as ticker
+from multiprocessing import shared_memory
+import numpy as np
+import os
+import platform
+import signal
+import time
+import traceback
+
+# PlotRenderer から起動される常駐の描画プロセス
+#   matplotlib の読み込みと Figure の作成は起動時の1回だけで、ジョブごとに Figure をクリアして描き直す
+class RenderWorker(object):
+    def __init__(self, event_queue):
+        self._event_queue = event_queue
+        self._segments = {}     # kind : 開いている共有メモリ
+        self._figures = {'position': plt.figure(),
+                         'profit': plt.figure(tight_layout=True),
+                         'profit_all': plt.figure(tight_layout=True)}
+
+    @classmethod
+    def run(cls, job_queue, event_queue):
+        # Ctrl+Cのシグナルを無効にしておく。(メインからのstop()で終了させるので。)
+        signal.signal(signal.SIGINT,  signal.SIG_IGN)
+
+        # トレード側の処理を邪魔しないように優先度を下げる
+        event_queue.put( ('pid', os.getpid()) )
+        try:
+            if platform.system() == 'Windows':
+                import psutil
+                psutil.Process().nice( psutil.IDLE_PRIORITY_CLASS )
+            else:
+                os.nice(19)
+        except Exception:
+            event_queue.put(('logger.error',traceback.format_exc()))
+
+        worker = cls(event_queue)
+        while True:
+            job = job_queue.get()
+            if job is None :
+                break
+            worker._render(*job)
+        worker._close()
+
+    def _render(self, job_id, kind, image_file, shm_name, layout, args):
+        start = time.perf_counter()
+        error = None
+        try:
+            data = self._read(kind, shm_name, layout)
+            fig = self._figures[kind]
+            fig.clf()
+            if kind == 'position' :
+                self._position(fig, image_file, data, **args)
+            else:
+                self._profit(fig, image_file, data, **args)
+        except Exception:
+            error = traceback.format_exc()
+        self._event_queue.put(('done', job_id, time.perf_counter()-start, error))
+
+    # 共有メモリから各列を読み出す (描画中に次のデータで上書きされても良いようにリストへコピー)
+    def _read(self, kind, shm_name, layout):
+        shm = self._segments.get(kind)
+        if shm is None or shm.name != shm_name :
+            if shm is not None :
+                shm.close()
+            shm = self._segments[kind] = shared_memory.SharedMemory(name=shm_name)
+        return {name:np.ndarray(count, dtype=np.float64, buffer=shm.buf, offset=offset).tolist() for name, offset, count in layout}
+
+    def _close(self):
+        for shm in self._segments.values():
+            shm.close()
+        self._segments = {}
+
+    # ポジショングラフ
+    def _position(self, fig, image_file, data, plot_fixed_pnl, plot_commission):
+        timestamp = [datetime.fromtimestamp(t) for t in data['timestamp']]
+        ltp = data['ltp']
+        average = data['average']
+        normal = data['normal']
+        very_busy = data['very_busy']
+        super_busy = data['super_busy']
+        api1 = data['api1']
+        api2 = data['api2']
+        api3 = data['api3']
+        profit = data['profit']
+        commission = data['commission']
+        leverage = data['leverage']
+        current_pos = data['current_pos']
+
+        fig.autofmt_xdate()
+        fig.tight_layout()
+
+        # サブエリアの大きさの比率を変える
+        gs = matplotlib.gridspec.GridSpec(nrows=2, ncols=1, height_ratios=[7, 3])
+        ax1 = fig.add_subplot(gs[0])  # 0行0列目にプロット
+        ax2 = ax1.twinx()
+        ax2.tick_params(labelright=False)
+        bx1 = fig.add_subplot(gs[1])  # 1行0列目にプロット
+        bx1.tick_params(labelbottom=False)
+        bx2 = bx1.twinx()
+
+        # 上側のグラフ
+        ax1.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+        ax2.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+        ax1.set_ylim([min(ltp + average)*0.999 - (max(ltp + average) - min(ltp + average))/5, max(ltp + average)*1.001 + (max(ltp + average) - min(ltp + average))/10])
+
+        ax1.plot(timestamp, ltp, label="market price")
+        ax1.plot(timestamp, average, label="position average")
+
+        ax1.fill_between(timestamp, normal, 100000000, color='green', alpha=0.01)
+        ax1.fill_between(timestamp, very_busy, 100000000, color='red', alpha=0.1)
+        ax1.fill_between(timestamp, super_busy, 100000000, color='red', alpha=0.5)
+
+        if max(api1)!=min(api1) :
+            ax2.plot(timestamp, api1, label="API1", color='red')
+        if max(api2)!=min(api2) :
+            ax2.plot(timestamp, api2, label="API2", color='orange')
+        if max(api3)!=min(api3) :
+            ax2.plot(timestamp, api3, label="API3", color='brown')
+        ax2.axhline(y=0, color='k', linestyle='dashed')
+
+        ax2.set_ylim([-100, 2800])
+        ax2.yaxis.set_minor_locator(matplotlib.ticker.MultipleLocator(500))
+
+        # 損益の推移
+        bx1.yaxis.set_major_formatter(ticker.ScalarFormatter())
+        bx1.yaxis.get_major_formatter().set_scientific(False)
+        bx1.yaxis.get_major_formatter().set_useOffset(False)
+
+        if plot_fixed_pnl :
+            bx1.plot(timestamp, profit, label="fixed profit", color='red')
+        else:
+            bx1.plot(timestamp, profit, label="profit", color='red')
+        if max(commission)!=min(commission) and plot_commission :
+            bx1.plot(timestamp, commission, label="commission", color='blue')
+            bx1.set_ylim([min(profit+commission)*0.99, max(profit+commission)*1.01])
+        else:
+            if min(profit)!=max(profit) :
+                bx1.set_ylim([min(profit)*0.99, max(profit)*1.01])
+
+        bx1.yaxis.get_major_formatter().set_useOffset(False)
+        bx1.yaxis.set_major_locator(ticker.MaxNLocator(nbins=5, integer=True))
+
+        # ポジション推移
+        if max(leverage)!=0 :
+            bx2.set_ylim([-max(leverage) * 1.2, max(leverage) * 1.2])
+        bx2.fill_between(timestamp, current_pos, label="position")
+        bx2.axhline(y=0, color='k', linestyle='dashed')
+
+        bx2.yaxis.set_minor_locator(ticker.MaxNLocator(nbins=5))
+
+        bx1.patch.set_alpha(0)
+        bx1.set_zorder(2)
+        bx2.set_zorder(1)
+
+        # 凡例
+        h1, l1 = ax1.get_legend_handles_labels()
+        h2, l2 = ax2.get_legend_handles_labels()
+        h3, l3 = bx1.get_legend_handles_labels()
+        h4, l4 = bx2.get_legend_handles_labels()
+        ax1.legend(h1, l1, loc='upper left', prop={'size': 8})
+        ax2.legend(h2, l2, loc='lower left', prop={'size': 8})
+        bx1.legend(h3+h4, l3+l4, loc='upper left', prop={'size': 8})
+
+        ax1.grid(linestyle=':')
+        bx1.grid(linestyle=':')
+
+        bx1.tick_params(axis = 'y', colors ='red')
+        bx2.tick_params(axis = 'y', colors ='blue')
+
+        fig.savefig(image_file)
+
+    # 損益グラフ (日次・長期)
+    def _profit(self, fig, image_file, data, rotate, fmt, title):
+        history_timestamp = data['history_timestamp']
+        price_history = data['price_history']
+
+        ax = fig.subplots(1,1)
+        fig.autofmt_xdate()
+
+        ax.set_facecolor('#fafafa')
+        ax.spines['top'].set_visible(False)
+        ax.spines['bottom'].set_visible(False)
+        ax.spines['left'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.grid(which='major', linestyle='-', color='#101010', alpha=0.1, axis='y')
+        if rotate == 0:
+            ax.tick_params(width=0, length=0)
+        else:
+            ax.tick_params(width=1, length=5)
+        ax.tick_params(axis='x', colors='#c0c0c0')
+        ax.tick_params(axis='y', colors='#c0c0c0')
+        if fmt != '':
+            ax.xaxis.set_major_formatter(mdates.DateFormatter(fmt))
+        ax.yaxis.set_major_formatter(ticker.ScalarFormatter())
+        ax.yaxis.get_major_formatter().set_scientific(False)
+        ax.yaxis.get_major_formatter().set_useOffset(False)
+
+        green1 = '#10b285'
+        green2 = '#9cdcd0'
+        red1 = '#e25447'
+        red2 = '#f0b8b8'
+
+        if price_history[-1] >= 0:
+            ax.set_title(title, color=green1, fontsize=28)
+        else:
+            ax.set_title(title, color=red1, fontsize=28)
+
+        last = 0
+        plus_times = []
+        plus_price = []
+        minus_times = []
+        minus_price = []
+        for i in range(0, len(history_timestamp)):
+            if last * price_history[i] >= 0:
+                if price_history[i] >= 0:
+                    plus_times.append(datetime.fromtimestamp(history_timestamp[i]))
+                    plus_price.append(price_history[i])
+                if price_history[i] <= 0:
+                    minus_times.append(datetime.fromtimestamp(history_timestamp[i]))
+                    minus_price.append(price_history[i])
+            else:
+                cross_point = price_history[i-1]/(price_history[i-1]-price_history[i])*(history_timestamp[i]-history_timestamp[i-1])+history_timestamp[i-1]
+                if price_history[i] < 0:
+                    plus_times.append(datetime.fromtimestamp(cross_point))
+                    plus_price.append(0)
+                    ax.plot(plus_times, plus_price, color=green1, linewidth=0.8)
+                    ax.fill_between(plus_times, plus_price, 0, color=green2, alpha=0.25)
+                    plus_times = []
+                    plus_price = []
+                    minus_times = []
+                    minus_price = []
+                    minus_times.append(datetime.fromtimestamp(cross_point))
+                    minus_price.append(0)
+                    minus_times.append(datetime.fromtimestamp(history_timestamp[i]))
+                    minus_price.append(price_history[i])
+                else:
+                    minus_times.append(datetime.fromtimestamp(cross_point))
+                    minus_price.append(0)
+                    ax.plot(minus_times, minus_price, color=red1, linewidth=0.8)
+                    ax.fill_between(minus_times, minus_price, 0, color=red2, alpha=0.25)
+                    plus_times = []
+                    plus_price = []
+                    minus_times = []
+                    minus_price = []
+                    plus_times.append(datetime.fromtimestamp(cross_point))
+                    plus_price.append(0)
+                    plus_times.append(datetime.fromtimestamp(history_timestamp[i]))
+                    plus_price.append(price_history[i])
+            last = price_history[i]
+
+        if len(plus_times) > 0:
+            ax.plot(plus_times, plus_price, color=green1, linewidth=0.8)
+            ax.fill_between(plus_times, plus_price, 0, color=green2, alpha=0.25)
+
+        if len(minus_times) > 0:
+            ax.plot(minus_times, minus_price, color=red1, linewidth=0.8)
+            ax.fill_between(minus_times, minus_price, 0, color=red2, alpha=0.25)
+
+        labels = ax.get_xticklabels()
+        plt.setp(labels, rotation=rotate)
+
+        fig.savefig(image_file, facecolor='#fafafa')
@@ -0,0 +1,194 @@
+# coding: utf-8
+#!/usr/bin/python3
+
+import asyncio
+import itertools
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from threading import Thread, Lock, Event
+
+# 描画プロセスのエントリーポイント (matplotlib はサブプロセス側でだけ読み込む)
+def _run_worker(job_queue, event_queue):
+    from libs.plot.render_worker import RenderWorker
+    RenderWorker.run(job_queue, event_queue)
+
+# グラフ描画用の常駐プロセスを管理するクラス
+#   描画のたびにプロセスを起動せず、matplotlib を読み込み済みの1つのプロセス (RenderWorker) へ描画ジョブを送る
+#   描画するデータはジョブの種類 ('position', 'profit', 'profit_all') ごとの共有メモリに書き込んで渡す
+#   同じ種類のジョブは前のジョブが終わるまで待ち、異なる種類のジョブはワーカー側のキューに積まれて順に描画される
+class PlotRenderer(object):
+    def __init__(self, logger, timeout=180):
+        self._logger = logger
+        self._timeout = timeout
+
+        self._segments = {}          # kind : 共有メモリ
+        self._kind_lock = {}         # kind : 共有メモリを使用中のロック
+        self._waiting = {}           # job_id : [Event, 描画時間, エラー]
+        self._job_id = itertools.count(1)
+        self._process = None
+        self._start_lock = Lock()
+
+        self.render_time = {}        # kind : 直近の描画時間(秒)
+
+        self._start()
+        self._logger.stop_handler.append(self.stop())
+
+    def _start(self):
+        # 共有メモリの管理プロセスをワーカーと共用するように先に起動しておく (ワーカー終了時に使用中の共有メモリが削除されないように)
+        if hasattr(resource_tracker, 'ensure_running') :
+            resource_tracker.ensure_running()
+        self._job_queue = multiprocessing.Queue()
+        self._event_queue = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=_run_worker, args=(self._job_queue, self._event_queue), daemon=True, name='plot_renderer')
+        self._process.start()
+        Thread(target=self._event_loop, args=(self._event_queue,), daemon=True).start()
+
+    # ワーカーからのイベントを受け取るスレッド
+    def _event_loop(self, event_queue):
+        while True:
+            event = event_queue.get()
+            if event is None :
+                break
+            if event[0] == 'done' :
+                waiting = self._waiting.get(event[1])
+                if waiting :
+                    waiting[1], waiting[2] = event[2], event[3]
+                    waiting[0].set()
+            elif event[0] == 'pid' :
+                self._logger.info( "[plot] renderer procid = {}".format(event[1]) )
+            elif event[0] == 'logger.info' :
+                self._logger.info(event[1])
+            elif event[0] == 'logger.error' :
+                self._logger.error(event[1])
+
+    # 種類ごとの共有メモリへデータを書き込んで、各列の (名前, オフセット, 個数) を返す
+    def _write(self, kind, data):
+        columns = {name:np.asarray(values, dtype=np.float64) for name,values in data.items()}
+        size = sum(c.nbytes for c in columns.values())
+
+        shm = self._segments.get(kind)
+        if shm is None or shm.size < size :
+            # 足りなければ倍に広げて作り直す (ワーカーは新しい名前で開き直す)
+            capacity = shm.size if shm is not None else 65536
+            while capacity < size :
+                capacity *= 2
+            if shm is not None :
+                shm.close()
+                shm.unlink()
+            shm = self._segments[kind] = shared_memory.SharedMemory(create=True, size=capacity)
+
+        layout = []
+        offset = 0
+        for name, c in columns.items():
+            np.ndarray(len(c), dtype=np.float64, buffer=shm.buf, offset=offset)[:] = c
+            layout.append((name, offset, len(c)))
+            offset += c.nbytes
+        return shm.name, layout
+
+    # 描画ジョブを送って完了を待つ (描画スレッドから呼び出す)
+    #   戻り値はワーカーでの描画時間(秒)  失敗した場合は None
+    def render(self, kind, image_file, data, args={}):
+        with self._start_lock:
+            if not self._process.is_alive() :
+                self._logger.error( "[plot] renderer process is not alive. restart" )
+                self._event_queue.put(None)
+                self._start()
+
+        lock = self._kind_lock.setdefault(kind, Lock())
+        with lock:
+            job_id = next(self._job_id)
+            waiting = self._waiting[job_id] = [Event(), None, None]
+            try:
+                shm_name, layout = self._write(kind, data)
+                self._job_queue.put((job_id, kind, image_file, shm_name, layout, args))
+                if not waiting[0].wait(self._timeout) :
+                    self._logger.error( "[plot] {} graph render timeout".format(kind) )
+                    return None
+            finally:
+                del self._waiting[job_id]
+
+        if waiting[2] :
+            self._logger.error( waiting[2] )
+            return None
+        self.render_time[kind] = waiting[1]
+        return waiting[1]
+
+    async def stop(self):
+        if self._process is None :
+            return
+        self._job_queue.put(None)
+        timeout = 50
+        while self._process.is_alive() and timeout>0 :
+            await asyncio.sleep(0.1)
+            timeout -= 1
+        if self._process.is_alive() :
+            self._process.terminate()
+        self._event_queue.put(None)
+        for shm in self._segments.values():
+            shm.close()
+            shm.unlink()
+        self._segments = {}
+        self._logger.info( "[plot] renderer process stopped" )
+
+
+# テストコード
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import time
+
+    class Logger(object):
+        def __init__(self):
+            self.stop_handler = []
+        def info(self, *args) : print(*args)
+        def error(self, *args) : print(*args)
+
+    folder = tempfile.mkdtemp()
+    n = 1440
+    now = time.time()
+    t = [now-(n-i)*60 for i in range(n)]
+    price = list(5000000+np.cumsum(np.random.randn(n)*1000))
+    pos_data = {'timestamp':t, 'ltp':price, 'average':price, 'current_pos':np.sin(np.arange(n)/50)*0.01,
+                'leverage':abs(np.sin(np.arange(n)/50))*0.01, 'profit':np.cumsum(np.random.randn(n)), 'commission':[0]*n,
+                'normal':[0]*n, 'very_busy':[100000000]*n, 'super_busy':[100000000]*n, 'api1':[480]*n, 'api2':[300]*n, 'api3':[300]*n}
+    pos_args = {'plot_fixed_pnl':False, 'plot_commission':False}
+    prof_data = {'history_timestamp':t, 'price_history':np.cumsum(np.random.randn(n))}
+    prof_args = {'rotate':0, 'fmt':'%H:%M', 'title':'+123'}
+    jobs = 5
+
+    # 常駐プロセスへのジョブ投入
+    renderer = PlotRenderer(Logger())
+    renderer.render('position', os.path.join(folder, 'warmup.png'), pos_data, pos_args)
+    start = time.perf_counter()
+    for i in range(jobs):
+        assert renderer.render('position', os.path.join(folder, 'position.png'), pos_data, pos_args) is not None
+        assert renderer.render('profit', os.path.join(folder, 'profit.png'), prof_data, prof_args) is not None
+    persistent_time = (time.perf_counter()-start)/jobs/2
+    print( "render time : {}".format({k:round(v,3) for k,v in renderer.render_time.items()}) )
+
+    # 異なる種類のジョブを別スレッドから同時に投入
+    results = []
+    threads = [Thread(target=lambda k,d,a: results.append(renderer.render(k, os.path.join(folder, k+'.png'), d, a)), args=args)
+               for args in (('position',pos_data,pos_args), ('profit',prof_data,prof_args), ('profit_all',prof_data,prof_args))]
+    [th.start() for th in threads]
+    [th.join() for th in threads]
+    assert len(results)==3 and None not in results
+
+    # 従来の方式 (matplotlib を読み込み済みのプロセスからグラフごとにプロセスを起動)
+    import matplotlib.pyplot
+    start = time.perf_counter()
+    for i in range(jobs):
+        for kind, data, args in (('position',pos_data,pos_args), ('profit',prof_data,prof_args)):
+            job_queue, event_queue = multiprocessing.Queue(), multiprocessing.Queue()
+            shm_name, layout = renderer._write(kind, data)
+            job_queue.put((0, kind, os.path.join(folder, kind+'_old.png'), shm_name, layout, args))
+            job_queue.put(None)
+            proc = multiprocessing.Process(target=_run_worker, args=(job_queue, event_queue), daemon=True)
+            proc.start()
+            while event_queue.get()[0]!='done' : pass
+            proc.join()
+    spawn_time = (time.perf_counter()-start)/jobs/2
+    print( "per graph : process per plot {:.3f}sec  persistent renderer {:.3f}sec".format(spawn_time, persistent_time) )
+
+    asyncio.run(renderer._logger.stop_handler[0])
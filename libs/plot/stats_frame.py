@@ -0,0 +1,199 @@
+# coding: utf-8
+#!/usr/bin/python3
+
+import numpy as np
+
+# 統計データ (StatsStore の構造化配列) からグラフ用のデータを作るための numpy の前処理
+#   列ごとの配列のまま 間引き(thin) → 区間ごとの集約(segment_max) → しきい値のマスク(mask) の順に処理する
+class StatsFrame(object):
+    def __init__(self, records):
+        self.records = records
+        # 構造化配列の列は飛び飛びの配列なので、繰り返し searchsorted する時刻は連続した配列にしておく
+        self.timestamp = np.ascontiguousarray(records['timestamp'])
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, name):
+        return self.records[name]
+
+    # 0 の値を直前の 0 以外の値で埋める (先頭から続く 0 は 0 のまま)
+    @staticmethod
+    def ffill_nonzero(values):
+        index = np.where(values!=0, np.arange(len(values)), 0)
+        np.maximum.accumulate(index, out=index)
+        return values[index]
+
+    # start 以降のレコードを step 秒以上の間隔に間引いたインデックス
+    #   前回選んだレコードから step 秒を超えた (strict=False の場合は step 秒以上の) 最初のレコードを順に選ぶ
+    #   keep に True のレコードは間隔に関係なく選ぶ
+    def thin(self, step, start=0, strict=True, keep=None):
+        ts = self.timestamp
+        n = len(ts)
+        if start >= n :
+            return np.zeros(0, dtype=np.int64)
+
+        # 全てのレコードの間隔が step より広ければ間引かない
+        diff = np.diff(ts[start:])
+        if np.all(diff>step if strict else diff>=step) :
+            return np.arange(start, n)
+
+        # 各レコードの次に選ぶレコードをまとめて求めてから、start から順にたどる
+        ts = ts[start:]
+        following = ts.searchsorted(ts+step, 'right' if strict else 'left')
+        if keep is not None :
+            keep_index = np.flatnonzero(keep[start:])
+            next_keep = keep_index.searchsorted(np.arange(len(ts)), 'right')
+            following = np.minimum(following, np.append(keep_index, len(ts))[next_keep])
+        following = following.tolist()
+        selected = []
+        i = 0
+        while i < len(ts) :
+            selected.append(i)
+            i = following[i]
+        return np.array(selected, dtype=np.int64)+start
+
+    # 選んだレコードごとに、前回選んだレコードの次 (最初は first) からの最大値
+    @staticmethod
+    def segment_max(values, selected, first=0):
+        if len(selected)==0 :
+            return values[:0]
+        starts = np.concatenate(([first], selected[:-1]+1))
+        return np.maximum.reduceat(values[:selected[-1]+1], starts)
+
+    # 条件に当てはまるところを 0、それ以外を 100000000 にした配列 (fill_between で塗りつぶす範囲)
+    @staticmethod
+    def mask(condition):
+        return np.where(condition, 0, 100000000)
+
+    # 日本時間の日 (1～31)
+    @staticmethod
+    def jst_day(timestamp):
+        date = (np.asarray(timestamp)+32400).astype('datetime64[s]').astype('datetime64[D]')
+        return (date-date.astype('datetime64[M]')).astype(np.int64)+1
+
+
+# テストコード
+if __name__ == "__main__":
+    from copy import deepcopy
+    from datetime import datetime, timedelta
+    import pandas
+    import time
+    from libs.utils.stats_store import StatsStore
+    from libs.plot.pos_graph import PositionGraph
+    from libs.plot.prof_graph import ProfitGraph
+
+    # 従来の前処理 (dictのリストをループで処理)
+    def old_position(org_stats, now, period, unitrate, fixed_pnl):
+        t=0
+        stats=[]
+        l=0
+        p=0
+        for s in org_stats:
+            p=round(float(s['ltp']),8) if round(float(s['ltp']),8)!=0 else p
+            if p == 0 :
+                continue
+            s['ltp']=p
+            if s['timestamp']-t>20 and now-s['timestamp']<period :
+                s['lantency']=max(l,s['lantency'])
+                stats.append(s)
+                t=s['timestamp']
+                l=0
+            else:
+                l=max(l,s['lantency'])
+        stats.append(org_stats[-1])
+        lantency_np = np.array([s['lantency'] for s in org_stats])
+        lantency_std = lantency_np.std()
+        lantency_mean = lantency_np.mean()
+        return {
+            'timestamp': [float(s['timestamp']) for s in stats],
+            'ltp': [round(float(s['ltp']),8) for s in stats],
+            'average': [(round(s['average'],8) if s['average']!=0 else float(s['ltp'])) for s in stats],
+            'current_pos': [s['current_pos'] for s in stats],
+            'leverage': [abs(s['current_pos']) for s in stats],
+            'profit': [(1 if unitrate else float(s['ltp']))*s['fixed_profit' if fixed_pnl else 'profit'] for s in stats],
+            'commission': [(1 if unitrate else float(s['ltp']))*s['commission'] for s in stats],
+            'normal': [0 if s['lantency'] < lantency_mean-lantency_std*0.3 else 100000000 for s in stats],
+            'very_busy': [0 if s['lantency'] > lantency_mean+lantency_std*3 else 100000000 for s in stats],
+            'super_busy': [0 if s['lantency'] > lantency_mean+lantency_std*10 else 100000000 for s in stats],
+            'api1': [s['api1'] for s in stats],
+            'api2': [s.get('api2',0) for s in stats],
+            'api3': [s.get('api3',0) for s in stats],
+        }
+
+    def old_profit(org_stats, now, days, unitrate):
+        if days==1 :
+            t=0
+            stats=[]
+            for s in org_stats:
+                if t+20 < s['timestamp'] and now-s['timestamp']<86400 :
+                    stats.append(s)
+                    t=s['timestamp']
+            stats.append(org_stats[-1])
+        else:
+            cumsum = 0
+            t=0
+            last_day = (datetime.utcfromtimestamp(org_stats[0]['timestamp'])+timedelta(hours=9)).day
+            last_profit = 0
+            stats=[]
+            last = org_stats[-1]['profit']
+            for s in org_stats:
+                if (t+600 <= s['timestamp'] or s.get('keep',False)) and now-s['timestamp']<86400*days :
+                    day = (datetime.utcfromtimestamp(s['timestamp'])+timedelta(hours=9)).day
+                    if last_day != day :
+                        cumsum += last_profit
+                    last_day = day
+                    last_profit = s['profit']
+                    s['profit'] += cumsum
+                    stats.append(s)
+                    t=s['timestamp']
+            org_stats[-1]['profit'] = last+cumsum
+            stats.append(org_stats[-1])
+        price_history_raw = [(1 if unitrate else float(s['ltp']))*(s['profit']-stats[0]['profit']) for s in stats]
+        price_history = list(pandas.Series(price_history_raw).rolling(window=20, min_periods=1).mean())
+        price_history[-1] = price_history_raw[-1]
+        return [float(s['timestamp']) for s in stats], price_history
+
+    def make_stats(n, interval, now, seed):
+        rng = np.random.default_rng(seed)
+        t = now-n*interval+np.cumsum(rng.uniform(0.2, 1.8, n))*interval
+        ltp = np.round(5000000+np.cumsum(rng.normal(0, 1000, n)), 1)
+        ltp[rng.random(n)<0.05] = 0
+        ltp[:3] = 0
+        return [{'timestamp':float(t[i]), 'ltp':float(ltp[i]), 'current_pos':float(rng.normal()), 'average':float(ltp[i] if rng.random()<0.7 else 0),
+                 'realized':0.0, 'commission':float(rng.normal()), 'unreal':0.0, 'profit':float(rng.normal()*100), 'fixed_profit':float(rng.normal()*100),
+                 'lantency':float(abs(rng.normal(20, 30))), 'api1':float(rng.integers(0,500)), 'api2':300.0, 'api3':300.0,
+                 'exec_vol':0.0, 'exec_vol_day':0.0, 'keep':bool(rng.random()<0.01)} for i in range(n)]
+
+    def same(a, b):
+        return len(a)==len(b) and np.allclose(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64), rtol=1e-12, atol=1e-9)
+
+    # 従来の前処理との比較
+    now = time.time()
+    for seed in range(20):
+        stats = make_stats(3000, 15 if seed%2 else 60, now, seed)
+        records = StatsStore.to_records(stats)
+        for period, unitrate, fixed_pnl in ((3600, True, False), (86400*2, False, True)):
+            expected = old_position(deepcopy(stats), now, period, unitrate, fixed_pnl)
+            result = PositionGraph._preprocess(StatsFrame(records), now, period, unitrate, fixed_pnl)
+            for name in expected:
+                assert same(result[name], expected[name]), (seed, period, name)
+        for days, unitrate in ((1, True), (1, False), (2, False), (90, True)):
+            expected = old_profit(deepcopy(stats), now, days, unitrate)
+            result = ProfitGraph._preprocess(StatsFrame(records), now, days, unitrate)
+            assert same(result[0], expected[0]) and same(result[1], expected[1]), (seed, days)
+
+    # 90日分(plot_termの既定値)の1分ごとの統計データでの比較
+    stats = make_stats(86400*90//60, 60, now, 100)
+    records = StatsStore.to_records(stats)
+    for name, old, new in (('position (period 90days)', lambda s: old_position(s, now, 86400*90, False, False), lambda r: PositionGraph._preprocess(StatsFrame(r), now, 86400*90, False, False)),
+                           ('profit (days=1)', lambda s: old_profit(s, now, 1, False), lambda r: ProfitGraph._preprocess(StatsFrame(r), now, 1, False)),
+                           ('profit (days=90)', lambda s: old_profit(s, now, 90, False), lambda r: ProfitGraph._preprocess(StatsFrame(r), now, 90, False))):
+        copied = deepcopy(stats)
+        start = time.perf_counter()
+        old(copied)
+        old_time = time.perf_counter()-start
+        start = time.perf_counter()
+        new(records)
+        new_time = time.perf_counter()-start
+        print( "{:25} {} records : loop {:.1f}ms  numpy {:.1f}ms".format(name, len(stats), old_time*1000, new_time*1000) )
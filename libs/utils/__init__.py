@@ -8,11 +8,16 @@ __all__ = ['TimeConv',
            'NotifyDiscord',
            'JsonFile',
            'Stats',
+           'StatsStore',
            'CandleCollector',
            'CandleGenerator',
            'NoTradeCheck',
            'PositionClient',
-           'LockCounter']
+           'LockCounter',
+           'RWLock',
+           'EventDispatcher',
+           'KlineStore',
+           'RollingCounter']
 
 from .time_conv import TimeConv
 from .mylogger import MyLogger
@@ -21,8 +26,11 @@ from .scheduler import Scheduler
 from .discord import NotifyDiscord
 from .jsonfile import JsonFile
 from .stats import Stats
-from .min_candle import CandleCollector
+from .stats_store import StatsStore
+from .min_candle import CandleCollector, KlineStore
 from .sec_candle import CandleGenerator
 from .notrade import NoTradeCheck
 from .posclient import PositionClient
-from .lock_counter import LockCounter
+from .lock_counter import LockCounter, RWLock
+from .event_dispatcher import EventDispatcher
+from .rolling_counter import RollingCounter
@@ -0,0 +1,97 @@
+# coding: utf-8
+#!/usr/bin/python3
+
+from collections import deque
+import time
+import traceback
+
+# 板・約定・注文イベントをイベントループ上でハンドラに配信するクラス
+#   set() はどのスレッドからでも呼び出し可能 (threading.Event の代わりに exchange から event.set() される)
+#   ハンドラの実行中に届いたイベントはまとめて、実行が終わったら最新の状態で1回だけ呼び出す
+class EventDispatcher(object):
+    def __init__(self, logger, name='', on_dispatch=None):
+        self._logger = logger
+        self._name = name
+        self._on_dispatch = on_dispatch   # ディスパッチ時にイベントループ上で呼び出す関数
+        self._handlers = []
+        self._scheduled = False
+        self._set_count = 0
+        self._dispatched_count = 0
+
+    # ハンドラの登録 (queue を指定した場合は queue が空の間は呼び出さない)
+    def add_handler(self, handler, args=(), queue=None):
+        self._handlers.append({'handler':handler, 'args':args, 'queue':queue,
+                               'running':False, 'pending':False, 'pending_since':0,
+                               'invocations':0, 'coalesced':0,
+                               'run_time':deque(maxlen=100), 'delay':deque(maxlen=100)})
+
+    # イベントの通知
+    def set(self):
+        self._set_count += 1
+        if self._scheduled :
+            return
+        self._scheduled = True
+        try:
+            self._logger.event_loop.call_soon_threadsafe(self._dispatch)
+        except RuntimeError:
+            # イベントループ終了後
+            self._scheduled = False
+
+    def _dispatch(self):
+        # 先にフラグを戻すことで、ここから後に set() されたイベントは次回のディスパッチで拾われる
+        self._scheduled = False
+        count = self._set_count-self._dispatched_count
+        self._dispatched_count += count
+        if not self._logger.running :
+            return
+
+        if self._on_dispatch :
+            self._on_dispatch()
+
+        now = time.time()
+        for h in self._handlers:
+            if h['queue'] is not None and len(h['queue'])==0 :
+                continue
+            if h['running'] :
+                # 実行中のハンドラは終了後に1回だけ再実行
+                if h['pending'] :
+                    h['coalesced'] += count
+                else:
+                    h['coalesced'] += count-1
+                    h['pending'] = True
+                    h['pending_since'] = now
+            else:
+                h['coalesced'] += count-1
+                h['running'] = True
+                h['pending_since'] = now
+                self._logger.event_loop.create_task(self._run(h), name=f"dispatch_{self._name}")
+
+    async def _run(self, h):
+        try:
+            while self._logger.running:
+                h['pending'] = False
+                start = time.time()
+                h['delay'].append((start-h['pending_since'])*1000)
+                h['invocations'] += 1
+                try:
+                    await h['handler'](*h['args'])
+                except Exception as e:
+                    self._logger.error( e )
+                    self._logger.info(traceback.format_exc())
+                h['run_time'].append((time.time()-start)*1000)
+
+                if not h['pending'] :
+                    break
+        finally:
+            h['running'] = False
+
+    def _mean(self,q) : return sum(q) / (len(q) + 1e-7)
+
+    # ハンドラごとの統計 (呼び出し回数・まとめたイベント数・平均実行時間[ms]・平均待ち時間[ms])
+    @property
+    def stats(self):
+        return [{'name':getattr(h['handler'],'__name__',str(h['handler'])),
+                 'invocations':h['invocations'],
+                 'coalesced':h['coalesced'],
+                 'run_time':self._mean(h['run_time']),
+                 'delay':self._mean(h['delay'])} for h in self._handlers]
@@ -1,17 +1,122 @@
 # coding: utf-8
 #!/usr/bin/python3
 
+import atexit
 import json
 import os
+import threading
+import time
+
+# JsonFile の書き込みをまとめて行うバックグラウンドスレッド (プロセスで1つ)
+#   add_data() / renew_file() はメモリ上のバッファに積むだけで、ファイルへの書き込みはこのスレッドがまとめて行う (グループコミット)
+class _JournalWriter(threading.Thread):
+    _COMMIT_DELAY = 0.005     # 最初の書き込み要求から、まとめて書き込むまでの待ち時間(秒)
+    _SYNC_INTERVAL = 1.0      # fsync:'interval' の場合の fsync 間隔(秒)
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None :
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        super().__init__(name='journal_writer', daemon=True)
+        self._cond = threading.Condition()
+        self._dirty = {}          # 書き込み待ちのある JsonFile (dictを順序付きsetとして使用)
+        self._unsynced = {}       # fsync 待ちの JsonFile
+        self._running = True
+        self.start()
+        atexit.register(self.close)
+
+    def notify(self, journal):
+        with self._cond:
+            self._dirty[journal] = True
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                if not self._dirty and self._running :
+                    self._cond.wait(timeout=self._SYNC_INTERVAL)
+                if not self._dirty :
+                    if not self._running :
+                        break
+                    # 書き込みが途切れたら fsync 待ちのファイルを同期
+                    self._sync_all()
+                    continue
+
+            time.sleep(self._COMMIT_DELAY)
+            self._commit_all()
+
+    def _commit_all(self):
+        with self._cond:
+            dirty, self._dirty = self._dirty, {}
+        for journal in dirty:
+            if journal._commit() :
+                self._unsynced[journal] = True
+
+    def _sync_all(self):
+        unsynced, self._unsynced = self._unsynced, {}
+        for journal in unsynced:
+            journal._sync()
+
+    # プロセス終了時に残りを書き出す
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self.join(timeout=5)
+        if self.is_alive() :
+            return
+        self._commit_all()
+        self._sync_all()
+
 
 # json形式でログフォルダに保存・レストアを行うクラス
+#   1行1レコードの追記型ジャーナル  renew_file() で全体を書き換える (一時ファイルに書いてから置き換えるのでクラッシュしても壊れない)
+#   fsync のタイミングは logger.journal_fsync で指定 ('always':まとめて書き込むたび / 'interval':1秒ごと / 'none':OSに任せる)
 class JsonFile(object):
     def __init__(self, logger):
         self._logger = logger
         self.filename = ''
 
+        self._lock = threading.Lock()
+        self._ops = []           # 書き込み待ち [(filename, 追記する行 or None, 置き換える内容 or None), ...]
+        self._enqueued = 0       # バッファに積んだ件数
+        self._committed = 0      # ファイルへ書き込んだ件数
+        self._committed_cond = threading.Condition(self._lock)
+        self._fp = None          # 追記用に開いたままにしているファイル
+        self._fp_name = ''
+        self._last_sync = 0
+
+    def _enqueue(self, op):
+        with self._lock:
+            self._ops.append(op)
+            self._enqueued += 1
+            first = len(self._ops)==1
+        # 前回の書き込み後の最初の要求のときだけ書き込みスレッドを起こす
+        if first :
+            _JournalWriter.get().notify(self)
+
+    # バッファの内容がファイルに書き込まれるまで待つ
+    def flush(self, timeout=10):
+        with self._lock:
+            target = self._enqueued
+            if self._committed >= target :
+                return True
+        _JournalWriter.get().notify(self)
+        with self._committed_cond:
+            return self._committed_cond.wait_for(lambda: self._committed>=target, timeout=timeout)
+
     def reload_file(self, filename=None):
         self.filename = filename or self.filename
+        self.flush()
+        self._recover()
+
         datas = []
         if os.path.isfile(self.filename) :
             with open(self.filename, 'r') as fp:
@@ -25,13 +130,171 @@ class JsonFile(object):
                         self._logger.error("JSON file error : {}[{}]  : {}".format(self.filename,p,e))
         return datas
 
+    # クラッシュ後の復旧
+    #   置き換え途中の一時ファイルを削除 (置き換えは os.replace で行うので元のファイルは壊れていない)
+    #   追記途中で切れた最後の行を削除
+    def _recover(self):
+        if self.filename == '' : return
+        tmp = self.filename+'.tmp'
+        if os.path.isfile(tmp) :
+            self._logger.info("JSON file : remove incomplete snapshot {}".format(tmp))
+            os.remove(tmp)
+
+        if os.path.isfile(self.filename) and os.path.getsize(self.filename)!=0 :
+            with open(self.filename, 'rb+') as fp:
+                fp.seek(-1, os.SEEK_END)
+                if fp.read(1)==b'\n' :
+                    return
+                fp.seek(0)
+                data = fp.read()
+                self._logger.info("JSON file : discard incomplete last line {}[{}]".format(self.filename, data[data.rfind(b'\n')+1:]))
+                fp.truncate(data.rfind(b'\n')+1)
+
     def add_data(self, data):
         if self.filename != '' :
-            with open(self.filename, 'a') as fp:
-                fp.write(json.dumps(data)+'\n')
+            self._enqueue((self.filename, json.dumps(data)+'\n', None))
 
     def renew_file(self, datas):
-        dumped = [json.dumps(p) for p in datas]
-        with open(self.filename, 'w') as fp:
-            fp.write('\n'.join(dumped))
-            fp.write('\n\n')
+        if self.filename != '' :
+            dumped = [json.dumps(p) for p in datas]
+            self._enqueue((self.filename, None, '\n'.join(dumped)+'\n\n'))
+
+    # interval秒ごとに snapshot() の返すリストでファイルを置き換えて、追記で伸びたファイルを圧縮する
+    def set_snapshot(self, snapshot, interval=3600):
+        async def _snapshot():
+            if self.filename != '' :
+                self.renew_file(snapshot())
+        self._logger.call_every1sec.append({'name':'journal_snapshot', 'handler':_snapshot, 'interval':interval, 'counter':0})
+
+    # 以下はバックグラウンドスレッドから呼び出される
+    def _commit(self):
+        with self._lock:
+            ops, self._ops = self._ops, []
+        if not ops :
+            return False
+
+        written = False
+        try:
+            i = 0
+            while i<len(ops):
+                filename, line, snapshot = ops[i]
+                if snapshot is None :
+                    # 同じファイルへの連続した追記はまとめて1回で書き込む
+                    lines = [line]
+                    while i+1<len(ops) and ops[i+1][0]==filename and ops[i+1][2] is None :
+                        i += 1
+                        lines.append(ops[i][1])
+                    self._open(filename).write(''.join(lines))
+                else:
+                    self._replace(filename, snapshot)
+                written = True
+                i += 1
+            if self._fp :
+                self._fp.flush()
+        except Exception as e:
+            self._logger.error("JSON file write error : {} : {}".format(self.filename, e))
+
+        with self._committed_cond:
+            self._committed += len(ops)
+            self._committed_cond.notify_all()
+
+        policy = getattr(self._logger, 'journal_fsync', 'interval')
+        if written and (policy=='always' or (policy=='interval' and time.time()-self._last_sync>=_JournalWriter._SYNC_INTERVAL)) :
+            self._sync()
+            return False
+        return written and policy=='interval'
+
+    def _open(self, filename):
+        if self._fp is not None and self._fp_name==filename :
+            return self._fp
+        self._close()
+        fp = open(filename, 'a')
+        # 最後の行が途中で切れていたら改行してから追記する
+        if fp.tell()!=0 :
+            with open(filename, 'rb') as r:
+                r.seek(-1, os.SEEK_END)
+                if r.read(1)!=b'\n' :
+                    fp.write('\n')
+        self._fp, self._fp_name = fp, filename
+        return fp
+
+    def _close(self):
+        if self._fp is not None :
+            self._fp.close()
+            self._fp = None
+
+    def _replace(self, filename, snapshot):
+        self._close()
+        tmp = filename+'.tmp'
+        with open(tmp, 'w') as fp:
+            fp.write(snapshot)
+            fp.flush()
+            if getattr(self._logger, 'journal_fsync', 'interval')!='none' :
+                os.fsync(fp.fileno())
+        os.replace(tmp, filename)
+
+    def _sync(self):
+        try:
+            if self._fp is not None :
+                self._fp.flush()
+                os.fsync(self._fp.fileno())
+        except Exception as e:
+            self._logger.error("JSON file sync error : {} : {}".format(self._fp_name, e))
+        self._last_sync = time.time()
+
+
+# テストコード
+if __name__ == "__main__":
+    import tempfile
+
+    class Logger(object):
+        def __init__(self):
+            self.call_every1sec = []
+        def info(self, *args) : print(*args)
+        def error(self, *args) : print(*args)
+
+    folder = tempfile.mkdtemp()
+    logger = Logger()
+
+    # 追記・置き換え・追記の順序が保たれること
+    file = JsonFile(logger)
+    assert file.reload_file(os.path.join(folder, 'order.json'))==[]
+    for i in range(100):
+        file.add_data({'i':i})
+    file.renew_file([{'i':-1}])
+    file.add_data({'i':100})
+    assert [d['i'] for d in file.reload_file()]==[-1, 100]
+
+    # 書き込み途中で終了した最後の行と置き換え途中の一時ファイルからの復旧
+    filename = os.path.join(folder, 'crash.json')
+    with open(filename, 'w') as fp:
+        fp.write('{"i": 0}\n{"i": 1}\n{"i": 2')
+    with open(filename+'.tmp', 'w') as fp:
+        fp.write('{"i": 9}\n')
+    file = JsonFile(logger)
+    assert [d['i'] for d in file.reload_file(filename)]==[0, 1]
+    assert not os.path.isfile(filename+'.tmp')
+    file.add_data({'i':3})
+    assert [d['i'] for d in file.reload_file()]==[0, 1, 3]
+
+    # 書き込み呼び出し側の所要時間 (従来の1件ごとに open/append/close する方式との比較)
+    record = {'timestamp':time.time(), 'realized':12345.0, 'commission':-12.0, 'unreal':-345}
+    for policy in ('none', 'interval', 'always'):
+        logger.journal_fsync = policy
+        file = JsonFile(logger)
+        file.reload_file(os.path.join(folder, f'profit_{policy}.json'))
+        start = time.perf_counter()
+        for i in range(10000):
+            file.add_data(record)
+        enqueue_time = time.perf_counter()-start
+        file.flush()
+        total_time = time.perf_counter()-start
+        assert len(file.reload_file())==10000
+        print( "journal (fsync:{:8}) : add_data {:.2f}us  (until written {:.2f}us/record)".format(policy, enqueue_time/10000*1000000, total_time/10000*1000000) )
+
+    filename = os.path.join(folder, 'profit_old.json')
+    start = time.perf_counter()
+    for i in range(10000):
+        with open(filename, 'a') as fp:
+            fp.write(json.dumps(record)+'\n')
+    print( "open/append/close per record : {:.2f}us".format((time.perf_counter()-start)/10000*1000000) )
@@ -1,37 +1,229 @@
 # coding: utf-8
 #!/usr/bin/python3
 
-# ロックされている数を管理するクラス
 import asyncio
+import threading
+import time
+
+# 読み出し中の数を管理して、書き込み側を待たせるロック (Reader/Writer lock)
+#   読み出し側 : with lock: / async with lock:  (ロジック側のイベントループで、await をまたいで保持しても良い)
+#   書き込み側 : with lock.write():  読み出しが全て終わるのを待ってから排他的に書き込む (websocketの受信スレッドなど)
+#                lock.wait()          読み出しが全て終わるのを待つだけ (従来の LockCounter.wait() と同じ)
+#   待ちはポーリングせずに Condition / Future で起こす
+#   書き込み中に読み出しを待たせるのは with lock.write(): の間だけ (await をまたいで保持している読み出し側がいても新しい読み出しは止めない)
+#   待ちの回数・合計時間・最大時間をロックの名前ごとに集計する
+class RWLock(object):
+    _stats = {}      # name : {'count', 'total', 'max'}
 
-class LockCounter(object):
     def __init__(self, logger, name=''):
         self._logger = logger
         self._name = name
-        self._counter = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None           # 書き込み中のスレッドID
+        self._async_waiters = []      # 書き込みの終了を待っている async with の Future
+        self._write_section = _WriteSection(self)
+        self.stats = self._stats.setdefault(name, {'count':0, 'total':0.0, 'max':0.0})
+
+    def _record(self, wait_time):
+        self.stats['count'] += 1
+        self.stats['total'] += wait_time
+        if wait_time > self.stats['max'] :
+            self.stats['max'] = wait_time
 
+    # イベントループを実行しているスレッドでは待てない (読み出し側が await 中のまま進まなくなる)
+    def _in_event_loop(self):
+        try:
+            asyncio.get_running_loop()
+            return True
+        except RuntimeError:
+            return False
+
+    # ---------------------------------------読み出し側
     def __enter__( self ) :
-        self._counter += 1
+        with self._cond:
+            if self._writer is not None and self._writer != threading.get_ident() :
+                start = time.perf_counter()
+                while self._writer is not None :
+                    self._cond.wait()
+                self._record(time.perf_counter()-start)
+            self._readers += 1
         return self
 
     def __exit__(self, ex_type, ex_value, trace):
-        self._counter -= 1
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0 :
+                self._cond.notify_all()
 
-    def wait(self):
-        if self._counter>0 :
-            asyncio.run_coroutine_threadsafe(self._wait_until_zero(), self._logger.event_loop).result()
+    async def __aenter__(self):
+        start = None
+        while True:
+            with self._cond:
+                if self._writer is None or self._writer == threading.get_ident() :
+                    self._readers += 1
+                    break
+                future = asyncio.get_running_loop().create_future()
+                self._async_waiters.append(future)
+            start = start or time.perf_counter()
+            await future
+        if start is not None :
+            self._record(time.perf_counter()-start)
+        return self
+
+    async def __aexit__(self, ex_type, ex_value, trace):
+        self.__exit__(ex_type, ex_value, trace)
+
+    # ---------------------------------------書き込み側
+    def write(self):
+        return self._write_section
+
+    def _wait_readers(self):
+        start = time.perf_counter()
+        while self._readers > 0 :
+            if not self._cond.wait(timeout=1) :
+                self._logger.info( "Lock counter[{}] : {}".format(self._name, self._readers))
+        self._record(time.perf_counter()-start)
 
-    async def _wait_until_zero(self):
-        if self._counter==0:
+    # 読み出しが全て終わるのを待つ
+    def wait(self):
+        if self._readers == 0 or self._in_event_loop() :
             return
+        with self._cond:
+            if self._readers > 0 :
+                self._logger.trace( "Lock counter[{}] : {}".format(self._name, self._readers))
+                self._wait_readers()
 
-        self._logger.trace( "Lock counter[{}] : {}".format(self._name, self._counter))
-        await asyncio.sleep(0.01)
+    def _acquire_write(self):
+        with self._cond:
+            if self._readers > 0 and not self._in_event_loop() :
+                self._wait_readers()
+            self._writer = threading.get_ident()
+
+    def _release_write(self):
+        with self._cond:
+            self._writer = None
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for future in waiters:
+            future.get_loop().call_soon_threadsafe(_set_result, future)
+
+    # ロックの名前ごとの待ちの統計
+    @classmethod
+    def disp_stats(cls, logger):
+        logger.info( "---------------------Lock wait" )
+        for name, s in cls._stats.items():
+            logger.info( "    {:<20} count:{:>8}  total:{:9.1f}ms  max:{:8.2f}ms".format(name, s['count'], s['total']*1000, s['max']*1000) )
+
+
+def _set_result(future):
+    if not future.done() :
+        future.set_result(None)
+
+
+class _WriteSection(object):
+    __slots__ = ('_lock',)
 
-        i = 0
-        while self._counter>0:
+    def __init__(self, lock):
+        self._lock = lock
+
+    def __enter__(self):
+        self._lock._acquire_write()
+        return self._lock
+
+    def __exit__(self, ex_type, ex_value, trace):
+        self._lock._release_write()
+
+
+# 従来の名前
+LockCounter = RWLock
+
+
+# テストコード
+if __name__ == "__main__":
+    import statistics
+
+    class Logger(object):
+        def info(self, *args) : print(*args)
+        def trace(self, *args) : pass
+
+    # 従来の LockCounter (10msごとのポーリング)
+    class OldLockCounter(object):
+        def __init__(self, logger, name=''):
+            self._logger = logger
+            self._counter = 0
+        def __enter__( self ) :
+            self._counter += 1
+            return self
+        def __exit__(self, ex_type, ex_value, trace):
+            self._counter -= 1
+        def wait(self):
+            if self._counter>0 :
+                asyncio.run_coroutine_threadsafe(self._wait_until_zero(), self._logger.event_loop).result()
+        async def _wait_until_zero(self):
+            if self._counter==0:
+                return
             await asyncio.sleep(0.01)
-            i += 1
-            if i%100 == 0:
-                self._logger.info( "Lock counter[{}] : {}".format(self._name, self._counter))
+            while self._counter>0:
+                await asyncio.sleep(0.01)
+
+    async def main():
+        logger = Logger()
+        logger.event_loop = asyncio.get_running_loop()
+
+        # 読み出し中に届いた更新の待ち時間 (読み出し終了から更新の開始まで)
+        for cls in (OldLockCounter, RWLock):
+            lock = cls(logger, cls.__name__)
+            delays = []
+            for i in range(50):
+                released = []
+                def writer():
+                    lock.wait()
+                    delays.append(time.perf_counter()-released[0])
+                with lock:
+                    th = threading.Thread(target=writer)
+                    th.start()
+                    await asyncio.sleep(0.002)
+                    released.append(time.perf_counter())
+                while th.is_alive() :
+                    await asyncio.sleep(0)
+                th.join()
+            print( "{:15} delay after release : median {:.3f}ms  max {:.3f}ms".format(cls.__name__, statistics.median(delays)*1000, max(delays)*1000) )
+
+        # 書き込み中は読み出しを待たせる (同期・非同期)
+        lock = RWLock(logger, 'board')
+        board = {'bid':1, 'ask':2}
+        stop = False
+        def writer():
+            i = 0
+            while not stop :
+                with lock.write():
+                    board['bid'] = i
+                    board['ask'] = i+1
+                i += 1
+        th = threading.Thread(target=writer)
+        th.start()
+        for i in range(20000):
+            with lock:
+                assert board['ask']-board['bid']==1
+            if i%100==0 :
+                async with lock:
+                    assert board['ask']-board['bid']==1
+                    await asyncio.sleep(0)
+                    assert board['ask']-board['bid']==1
+        stop = True
+        th.join()
+
+        # await をまたいで読み出しを保持していても、同じスレッドの別の読み出しは止まらない
+        async def holder():
+            with lock:
+                await asyncio.sleep(0.05)
+        task = asyncio.create_task(holder())
+        await asyncio.sleep(0.01)
+        with lock:
+            pass
+        await task
+
+        RWLock.disp_stats(logger)
 
+    asyncio.run(main())
@@ -36,7 +36,12 @@ class CandleCollector(object):
                        'pool':[],                         # 生成した足を一時的に入れるリスト
                        'current_candle':0,                # 生成した足の最新足時刻
                        'last_candle':0,                   # 前回ハンドラを呼び出した際の最新足時刻
-                       'limit_time':0,                    # 生成後でも残しておく足の時刻（この足以前は変換済みなので削除してOK）
+                       'last_minute':0,                   # 積み上げ済みの最後の分足の時刻 (これ以前の分足は削除してOK)
+                       'open_bar':None,                   # 未確定足の時刻
+                       'open_values':{},                  # 未確定足の値
+                       'minutes':{},                      # 未確定足に含まれる分足
+                       'columns':[],                      # 生成する足のカラム (取引所の分足に含まれているもの)
+                       'skip_first':0,                    # 途中からの分足しか無い最初の足の時刻
                        'target_candle':exchange._stores.get(id), # 変換後のデータを入れるデータストア
                        'callback':callback,               # イベント発生時に呼び出すコールバック関数
                        'args':args,}
@@ -78,7 +83,7 @@ class CandleCollector(object):
     # 各exchangeクラスから呼び出されて１分足のDataStoreが登録される (引数candle: 1分足のDatastore)
     def set_min_candle(self, exchange_symbol, candle):
         if exchange_symbol not in self._min_candles :
-            self._min_candles[exchange_symbol] = {'datastore':candle, 'limit_time':0, 'last_time':0}
+            self._min_candles[exchange_symbol] = {'datastore':candle, 'last_time':0}
 
     # 最終１分足の時刻を取得
     def get_last_min_candle(self, exchange_symbol):
@@ -88,12 +93,29 @@ class CandleCollector(object):
     def set_last_min_candle(self, exchange_symbol, value):
         self._min_candles[exchange_symbol]['last_time'] = value
 
-    # 指定されたシンボルの分足からリサンプルしてリストに登録されたターゲット足を作る
+    # 分足の共通カラムと集計方法 (取引所の分足に含まれているカラムだけを使用する)
+    _FIELDS = ['open', 'high', 'low', 'close', 'volume', 'turnover', 'ask_volume', 'bid_volume', 'sell_volume', 'buy_volume']
+    _AGG = {'open':'first', 'high':'max', 'low':'min', 'close':'last', 'volume':'sum', 'turnover':'sum',
+            'ask_volume':'last', 'bid_volume':'last', 'sell_volume':'sum', 'buy_volume':'sum'}
+
+    # DataStoreの1分足を (時刻[秒], 共通カラムの値の辞書) に変換
+    def _normalize_min_candle(self, d):
+        if 'open' in d :
+            if 'timestamp' in d : t = d['timestamp']      # bitflyer/GMO/phemex (Klineクラス)
+            elif 'start' in d :   t = d['start']          # bybit
+            else:                 t = int(d['ts'])/1000   # bitget
+            return int(t), {k:float(d[k]) for k in self._FIELDS if k in d}
+
+        # bitget の candlesticks は [instId, interval, ts, open, high, low, close, volume] の並び
+        v = list(d.values())
+        return int(int(v[2])/1000), dict(zip(self._FIELDS[:5], map(float, v[3:8])))
+
+    # 指定されたシンボルの分足から、リストに登録されたターゲット足の未確定足へ新しく届いた分足だけを積み上げる
     def resample(self, symbol=None):
         if not self._target_candle_list : return
 
-        # 分足格納用辞書
-        df_min={}
+        # 分足格納用辞書 (時刻順の [(時刻, 値), ...])
+        min_candles={}
 
         for candle_store in self._target_candle_list:
             # 生成するように登録されたシンボル以外はスキップ
@@ -101,88 +123,104 @@ class CandleCollector(object):
 
             # 対象の取引所&シンボルを表すキー
             exchange_symbol = candle_store['exchange_symbol']
-            exchange_name = candle_store['exchange'].exchange_name
+            if exchange_symbol not in self._min_candles : continue
 
-            # まだ分足取得していなかったら分足のDataStoreから取得してpandas形式で df_min へ保存
-            if exchange_symbol not in df_min:
-
-                # 分足を取得生成（各取引所クラスで生成された分足ローソクデータが self._min_candles[xxx]]['candle'] に保存されている）
-                if exchange_symbol not in self._min_candles : continue
-
-                if exchange_name!='bitget':
-                    symbol_key = 'symbol'
-                else:
-                    symbol_key = 'instId'
+            # まだ分足取得していなかったら分足のDataStoreから取得 (変換済みの分足は削除しているので新しい分足だけ)
+            if exchange_symbol not in min_candles:
+                symbol_key = 'symbol' if candle_store['exchange'].exchange_name!='bitget' else 'instId'
                 data = self._min_candles[exchange_symbol]['datastore'].find({symbol_key:candle_store['symbol']})
-                if not data : continue
-
-                # DataStoreから取得したデータをもとにpandasを生成
-                df_min[exchange_symbol] = pd.DataFrame(data)
-
-                # 時刻の変換
-                if exchange_name=='bybit':
-                    df_min[exchange_symbol]['timestamp'] = pd.to_datetime(df_min[exchange_symbol]['start'], unit='s', utc=True)
-
-                elif exchange_name=='bitget':
-                    df_min[exchange_symbol]['timestamp'] = pd.to_datetime(df_min[exchange_symbol]['ts'], unit='ms', utc=True)
-                    df_min[exchange_symbol].columns=['symbol','interval','ts','open','high','low','close','volume','timestamp']
-
-                else:
-                    df_min[exchange_symbol]['timestamp'] = pd.to_datetime(df_min[exchange_symbol]['timestamp'], unit='s', utc=True)
-
-                df_min[exchange_symbol] = df_min[exchange_symbol].set_index('timestamp').sort_index().groupby(level=0).last()
-
-                self._min_candles[exchange_symbol]['limit_time'] = df_min[exchange_symbol].index[-1].to_pydatetime().timestamp()
+                rows = dict(self._normalize_min_candle(d) for d in data)
+                min_candles[exchange_symbol] = sorted(rows.items())
+                self._min_candles[exchange_symbol]['symbol_key'] = symbol_key
                 self._min_candles[exchange_symbol]['symbol'] = candle_store['symbol']
 
-            # カラムの指定 (取引所ごとの違い)
-            if exchange_name=='bitflyer' :
-                agg_param= {'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'sum', 'ask_volume': 'last', 'bid_volume': 'last', 'sell_volume': 'sum', 'buy_volume': 'sum' }
-                columns = ['timestamp','open','high','low','close','volume','ask_volume','bid_volume','sell_volume','buy_volume']
-
-            elif exchange_name=='phemex' or exchange_name=='bybit':
-                agg_param = {'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'sum', 'turnover': 'sum'}
-                columns = ['timestamp','open','high','low','close','volume','turnover']
-
-            else:
-                self._logger.error( "Unknown exchange : {}".format(exchange_name) )
-                continue
-            df_min[exchange_symbol] = df_min[exchange_symbol].astype(dict([(c,'float') for c in columns if c!='timestamp']))
-
-            # ターゲットの長さのデータを生成してpoolに入れる (DataStoreへの登録はまだ行わない）
-            interval = candle_store['timeframe']
-            df = df_min[exchange_symbol].resample(f'{interval}S').agg(agg_param)
-
-            if len(df)!=0:
-                df['close'] = df['close'].fillna(method='ffill')
-                df['open'] = df['open'].fillna(df['close'])
-                df['high'] = df['high'].fillna(df['close'])
-                df['low'] = df['low'].fillna(df['close'])
-                df['volume'] = df['volume'].fillna(0)
-                df=df.dropna()
-                if len(df)!=0:
-                    df['timestamp'] = df.index.values.astype(np.int64)
-                    df['timestamp'] = df['timestamp']/1000000
-                    candle_store['pool'].append({'symbol': candle_store['symbol'], 'interval': interval, 'kline': df[columns].values.tolist()[1:]})
-                    candle_store['limit_time'] = df.index[max(-2,-len(df))].to_pydatetime().timestamp()
-                    candle_store['current_candle'] = df.index[-1].to_pydatetime().timestamp()
-                    self._min_candles[exchange_symbol]['limit_time'] = min(self._min_candles[exchange_symbol]['limit_time'],candle_store['limit_time'])
-            del df
-
-        # 不要になったDataStoreの1分足を削除
-        for exchange_symbol,value in self._min_candles.items():
-            if 'symbol' in self._min_candles[exchange_symbol]:
-                symbol = self._min_candles[exchange_symbol]['symbol']
-                limit_time = self._min_candles[exchange_symbol]['limit_time']
-                all_data = self._min_candles[exchange_symbol]['datastore'].find({'symbol':symbol})
-                filtered = [d for d in all_data if ('start' in d and d['start']<limit_time)or('timestamp' in d and d['timestamp']<limit_time)]
-                self._min_candles[exchange_symbol]['datastore']._delete(filtered)
-
-        # 一時的に作成した1分足のDataFrameを削除
-        for d in df_min.values():
-            del d
+            rows = [r for r in min_candles[exchange_symbol] if r[0]>=candle_store['last_minute']]
+            if not rows : continue
+
+            kline = []
+            for t, values in rows:
+                kline += self._fold(candle_store, t, values)
+            candle_store['last_minute'] = rows[-1][0]
+
+            # 未確定足も含めてDataStoreへ登録するようにpoolに入れる (DataStoreへの登録はまだ行わない）
+            kline.append(self._bar_row(candle_store['open_bar'], candle_store['open_values'], candle_store['columns']))
+            if candle_store['skip_first'] :
+                # 最初の足は途中からの分足しか無いので使わない
+                kline = [k for k in kline if k[0]!=candle_store['skip_first']*1000]
+            candle_store['pool'].append({'symbol': candle_store['symbol'], 'interval': candle_store['timeframe'], 'kline': kline})
+            candle_store['current_candle'] = candle_store['open_bar']
+
+        # 全てのターゲット足に積み上げ済みの分足をDataStoreから削除 (最後の分足は更新される可能性があるので残す)
+        for exchange_symbol in min_candles:
+            limit_time = min([c['last_minute'] for c in self._target_candle_list if c['exchange_symbol']==exchange_symbol])
+            store = self._min_candles[exchange_symbol]
+            filtered = [d for d in store['datastore'].find({store['symbol_key']:store['symbol']}) if self._normalize_min_candle(d)[0]<limit_time]
+            store['datastore']._delete(filtered)
+
+    # 1本の分足をターゲット足に積み上げて、確定した足のリストを返す
+    def _fold(self, candle_store, t, values):
+        interval = candle_store['timeframe']
+        bar = t-t%interval
+        closed = []
+
+        if candle_store['open_bar'] is None :
+            candle_store['columns'] = [k for k in self._FIELDS if k in values]
+            candle_store['skip_first'] = bar
+
+        elif bar > candle_store['open_bar'] :
+            # 未確定足を確定させ、分足の無かった足は直前の終値で埋める
+            last = candle_store['open_values']
+            closed.append(self._bar_row(candle_store['open_bar'], last, candle_store['columns']))
+            empty = {k:(last['close'] if k in ('open','high','low','close') else last[k] if self._AGG[k]=='last' else 0.0) for k in last}
+            for b in range(candle_store['open_bar']+interval, bar, interval):
+                closed.append(self._bar_row(b, empty, candle_store['columns']))
+            candle_store['minutes'] = {}
+
+        elif bar < candle_store['open_bar'] :
+            # 確定済みの足に含まれる分足は無視
+            return closed
+
+        candle_store['open_bar'] = bar
+        minutes = candle_store['minutes']
+        if minutes and t > max(minutes) :
+            # 新しい分足は未確定足にそのまま積み上げる
+            agg = candle_store['open_values']
+            for k, v in values.items():
+                rule = self._AGG[k]
+                if k not in agg or rule=='last' : agg[k] = v
+                elif rule=='max' : agg[k] = max(agg[k], v)
+                elif rule=='min' : agg[k] = min(agg[k], v)
+                elif rule=='sum' : agg[k] += v
+            minutes[t] = values
+            return closed
+
+        # 最初の分足や、更新された分足の場合は未確定足に含まれる分足 (最大 timeframe/60本) から集計し直す
+        minutes[t] = values
+        rows = [minutes[k] for k in sorted(minutes)]
+        agg = {}
+        for k in rows[0]:
+            rule = self._AGG[k]
+            col = [m[k] for m in rows if k in m]
+            agg[k] = col[0] if rule=='first' else col[-1] if rule=='last' else max(col) if rule=='max' else min(col) if rule=='min' else sum(col)
+        candle_store['open_values'] = agg
+        return closed
+
+    def _bar_row(self, bar, values, columns):
+        return [bar*1000]+[values.get(k,0.0) for k in columns]
+
+
+# 各取引所のターゲット足 (Kline) 用のDataStore  更新のたびに version を進める
+class KlineStore(DataStore):
+    version = 0
+
+    def _set(self, *args, **kwargs):
+        self.version += 1
+        super()._set(*args, **kwargs)
+
 
 # ターゲット足のデータストアからpandas形式で取り出すためのクラス
+#   作成したDataFrameはデータストアの version が変わるまで使い回し、新しい足は末尾の数行だけ変換して追加する
+#   (返したDataFrameはキャッシュそのものなので、書き換える場合は .copy() してから使うこと)
 class Candle_Access(DataStore):
     def __init__(self, logger, kline, exchange, symbol, timeframe, num_of_candle, callback):
         self._logger = logger
@@ -193,6 +231,12 @@ class Candle_Access(DataStore):
         self._num_of_candle = num_of_candle
         self._callback = callback
 
+        self._candle = None        # 作成済みのDataFrame
+        self._version = None       # DataFrame作成時のデータストアの version
+        self._length = 0           # DataFrame作成時のデータストアの件数
+        self._last_time = None     # DataFrameの最終行の時刻 (データストアの値のまま[秒])
+        self._index = None         # 時刻のカラム名
+
     def __len__(self):
         return len(self._kline)
 
@@ -206,18 +250,136 @@ class Candle_Access(DataStore):
     @property
     def candle(self):
         if len(self._kline)==0 : return pd.DataFrame()
-        data = self._kline.find()
+
+        version = getattr(self._kline, 'version', None)
+        if self._candle is not None and version is not None :
+            # 前回から更新が無ければそのまま返す
+            if version==self._version :
+                return self._candle
+            result = self._append_tail()
+        else:
+            result = None
+
+        # 末尾への追加で済まない場合 (初回や途中の足が更新された場合) は全て作り直す
+        if result is None :
+            result = self._rebuild()
+
+        # 不要になった足を削除
+        self._trim(result)
+        self._candle = result
+        self._version = getattr(self._kline, 'version', None)
+        self._length = len(self._kline)
+        return result
+
+    def _to_frame(self, data):
         df = pd.DataFrame(data)
-        if 'start' in df.columns: index='start'     # bybit
-        else:                     index='timestamp' # phemex/bitflyer/GMO
-        df[index] = pd.to_datetime(df[index], unit='s', utc=True)
-        result = df.set_index(index).sort_index().groupby(level=0).last().tz_convert(timezone(timedelta(hours=9), 'JST')).tail(self._num_of_candle)
+        if 'start' in df.columns: self._index='start'     # bybit
+        else:                     self._index='timestamp' # phemex/bitflyer/GMO
+        df[self._index] = pd.to_datetime(df[self._index], unit='s', utc=True)
+        df = df.set_index(self._index).sort_index()
+        if not df.index.is_unique :
+            df = df.groupby(level=0).last()
+        return df.tz_convert(timezone(timedelta(hours=9), 'JST'))
+
+    def _rebuild(self):
+        data = self._kline.find()
+        result = self._to_frame(data).tail(self._num_of_candle)
 #        self._logger.info( "fetch {}datas to {}candles".format(len(data),len(result)))
+        self._last_time = max(d[self._index] for d in data)
+        return result
+
+    # 前回の最終足以降に追加・更新された足だけを変換して末尾に接合
+    def _append_tail(self):
+        tail = []
+        new_rows = 0
+        # ターゲット足は時刻順に追加される (更新は同じ位置で置き換わる) ので後ろから前回の最終足まで遡る
+        for d in reversed(self._kline):
+            t = d.get(self._index)
+            if t is None or t < self._last_time : break
+            tail.append(d)
+            if t > self._last_time : new_rows += 1
+
+        # 件数が合わなければ途中の足が追加・削除されている
+        if not tail or len(self._kline)!=self._length+new_rows :
+            return None
+
+        df = self._to_frame(tail[::-1])
+        if list(df.columns)!=list(self._candle.columns) :
+            return None
+        pos = self._candle.index.searchsorted(df.index[0])
+        self._last_time = max(self._last_time, max(d[self._index] for d in tail))
+        return pd.concat([self._candle.iloc[:pos], df]).tail(self._num_of_candle)
+
+    # DataFrameに含まれない古い足をデータストアから削除
+    def _trim(self, result):
+        old = len(self._kline)-len(result)
+        if old<=0 : return
 
-        # 不要になった分足を削除
         limit_time = result.index[0].to_pydatetime().timestamp()
-        filtered = [d for d in data if ('start' in d and d['start']<limit_time)or('timestamp' in d and d['timestamp']<limit_time)]
+        filtered = []
+        for d in self._kline:
+            if (d.get(self._index) or 0)<limit_time :
+                filtered.append(d)
+                if len(filtered)==old : break
 #        self._logger.info( [d['timestamp'] for d in filtered] )
         self._kline._delete(filtered)
 
-        return result
+
+# テストコード
+if __name__ == "__main__":
+    import time
+
+    class Kline(KlineStore):
+        _KEYS = ['symbol', 'interval', 'timestamp']
+        _MAXLEN = 5000000
+
+        def _onmessage(self, message):
+            self._insert([{'symbol':message['symbol'], 'interval':message['interval'],
+                           'timestamp':int(item[0]/1000), 'open':item[1], 'high':item[2], 'low':item[3], 'close':item[4], 'volume':item[5]}
+                           for item in message['kline']])
+
+    class Logger(object):
+        def info(self, *args) : print(*args)
+
+    # 従来の作り方 (毎回全件から作成)
+    def full_rebuild(kline, num_of_candle):
+        df = pd.DataFrame(kline.find())
+        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s', utc=True)
+        return df.set_index('timestamp').sort_index().groupby(level=0).last().tz_convert(timezone(timedelta(hours=9), 'JST')).tail(num_of_candle)
+
+    def row(t, v):
+        return [t*1000, v, v+1, v-1, v+0.5, 1.0]
+
+    bars = 200
+    for num in (500, 5000, 50000):
+        store = Kline()
+        access = Candle_Access(logger=Logger(), kline=store, exchange=None, symbol='FX_BTC_JPY', timeframe=1, num_of_candle=num, callback=None)
+        start = 1700000000//60*60
+        store._onmessage({'symbol':'FX_BTC_JPY', 'interval':60, 'kline':[row(start+i*60, float(i)) for i in range(num)]})
+        access.candle
+
+        old_time = new_time = read_time = 0
+        for b in range(bars):
+            # 未確定足の更新と新しい足の追加 (resample から渡されるのと同じ形)
+            t = start+(num+b)*60
+            store._onmessage({'symbol':'FX_BTC_JPY', 'interval':60, 'kline':[row(t-60, float(b)), row(t, float(b)+0.1)]})
+
+            s = time.perf_counter()
+            expected = full_rebuild(store, num)
+            old_time += time.perf_counter()-s
+
+            s = time.perf_counter()
+            result = access.candle
+            new_time += time.perf_counter()-s
+
+            # 同じ足の中での再読み出し
+            s = time.perf_counter()
+            for i in range(10):
+                access.candle
+            read_time += (time.perf_counter()-s)/10
+
+            assert result.equals(expected), (num, b)
+        assert len(store)==num
+
+        print( "{:>6} candles : full rebuild {:8.3f}ms/bar  incremental {:8.3f}ms/bar  cached read {:8.4f}ms".format(
+               num, old_time/bars*1000, new_time/bars*1000, read_time/bars*1000) )
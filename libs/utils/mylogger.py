@@ -7,7 +7,7 @@ import os
 import time
 import zipfile
 from libs.utils.discord import NotifyDiscord
-from libs.utils.scheduler import Scheduler
+from libs.utils.scheduler import EverySecList
 
 # 日付ごとにロールバックして圧縮するロガークラス
 class MyLogger(object):
@@ -33,9 +33,8 @@ class MyLogger(object):
 
         self.discord = NotifyDiscord(self)
 
-        # 1秒ごとに実行されるコルーチンの登録
-        self.call_every1sec = [{'name':'logupdate', 'handler':self._keep_update, 'interval':1, 'counter':0}]
-        self._every1sec = Scheduler(self, interval=1, callback=self._run_every_1sec)
+        # interval秒ごとに実行されるコルーチンの登録 (append() で TimerWheel のジョブとして登録される)
+        self.call_every1sec = EverySecList(self, [{'name':'logupdate', 'handler':self._keep_update, 'interval':1, 'counter':0}])
 
         # 別プロセスを停止させるコルーチン
         self.stop_handler = []
@@ -93,12 +92,6 @@ class MyLogger(object):
         self._logger.exception(str)
 
     # 1秒ごとに実行されるコルーチン
-    async def _run_every_1sec(self):
-        for h in self.call_every1sec:
-            h['counter'] +=1
-            if h['counter'] % h['interval'] == 0 :
-                await h['handler']()
-
     # 1秒ごとに日付などの変更チェック
     async def _keep_update(self):
         self._update_filehandler(log_folder=self._log_folder, console_output=self._current_console_output_flag,
@@ -0,0 +1,94 @@
+# coding: utf-8
+#!/usr/bin/python3
+
+# 1秒ごとのカウンタを maxlen 秒分保持して、直近 sec 秒の合計を O(1) で返すクラス
+#   各秒の開始時点の累積値をリングバッファに保持し、合計は (現在の累積値 - sec秒前の開始時点の累積値) で求める
+#   名前ごとに複数のカウンタを持ち、add_counter() で後から追加できる
+class RollingCounter(object):
+    def __init__(self, names=(), maxlen=86400):
+        self.maxlen = maxlen
+        self._slot = 0            # 現在の秒 (shift()のたびに進む)
+        self._total = {}          # name : これまでの累積値
+        self._base = {}           # name : 各秒の開始時点の累積値のリングバッファ
+        for name in names:
+            self.add_counter(name)
+
+    def __contains__(self, name):
+        return name in self._total
+
+    @property
+    def names(self):
+        return list(self._total)
+
+    # カウンタの追加 (追加前の期間は0として扱う)
+    def add_counter(self, name):
+        if name in self._total :
+            return
+        self._total[name] = 0
+        self._base[name] = [0]*self.maxlen
+
+    def add(self, name, value=1):
+        self._total[name] += value
+
+    # 次の秒へ進める
+    def shift(self):
+        self._slot += 1
+        i = self._slot % self.maxlen
+        for name, total in self._total.items():
+            self._base[name][i] = total
+
+    # 直近 sec 秒 (現在の秒を含む) の合計  sec<=0 や maxlen 以上の場合は保持している全期間
+    def sum(self, name, sec):
+        available = min(self._slot+1, self.maxlen)
+        if sec<=0 or sec>available :
+            sec = available
+        return self._total[name]-self._base[name][(self._slot-sec+1) % self.maxlen]
+
+    # 全カウンタの直近 sec 秒の合計
+    def window(self, sec):
+        return {name:self.sum(name, sec) for name in self._total}
+
+
+# テストコード
+if __name__ == "__main__":
+    from collections import deque
+    import random
+    import time
+
+    # 従来の deque の合計と比較
+    random.seed(0)
+    maxlen = 600
+    counter = RollingCounter(names=('ordered','size'), maxlen=maxlen)
+    ref = {'ordered':deque([0],maxlen=maxlen), 'size':deque([0],maxlen=maxlen)}
+    for t in range(3000):
+        if t==1000 :
+            counter.add_counter('rejected')
+            ref['rejected'] = deque([0]*len(ref['ordered']),maxlen=maxlen)
+        for i in range(random.randint(0,5)):
+            for name in ref:
+                v = random.choice((1, 0.01, 0.003)) if name=='size' else 1
+                counter.add(name, v)
+                ref[name][-1] += v
+        for sec in (0, 1, 2, 10, 60, 599, 600, 601, 5000):
+            for name in ref:
+                assert round(counter.sum(name, sec)-sum(list(ref[name])[-sec:]),8)==0, (t, name, sec)
+        counter.shift()
+        for name in ref:
+            ref[name].append(0)
+
+    counter = RollingCounter(names=('ordered','filled','partially_filled','canceled','size'))
+    ref = {name:deque([0],maxlen=86400) for name in counter.names}
+    for t in range(86400):
+        counter.shift()
+        for name in ref:
+            ref[name].append(0)
+
+    start = time.perf_counter()
+    for i in range(100):
+        {name:sum(list(ref[name])[-3600:]) for name in ref}
+    deque_time = (time.perf_counter()-start)/100
+    start = time.perf_counter()
+    for i in range(100):
+        counter.window(3600)
+    rolling_time = (time.perf_counter()-start)/100
+    print( "historical_counter(3600) : deque {:.1f}us  rolling {:.1f}us".format(deque_time*1000000, rolling_time*1000000) )
@@ -2,51 +2,337 @@
 #!/usr/bin/python3
 
 import asyncio
+import math
 import time
 import traceback
 
-# 定期的なイベントの呼び出しを行うクラス
-class Scheduler(object):
-    def __init__(self, logger, interval=1, basetime=None, callback=None, args=()):
+# 定期実行するジョブ
+#   phase + interval*n (n は整数) の時刻に呼び出す
+#   policy : 前回の呼び出しが終わっていない場合の動作
+#       'skip'     : 今回の呼び出しを行わない
+#       'queue'    : 前回の呼び出しが終わってから続けて呼び出す
+#       'parallel' : 前回の終了を待たずに呼び出す
+class _Job(object):
+    __slots__ = ('name', 'handler', 'args', 'interval', 'phase', 'policy', 'expires', 'due', 'cancelled', 'running', 'queued',
+                 'runs', 'skipped', 'overruns', 'total_time', 'max_time', 'last_time', 'max_delay', 'last_overrun_log', 'counter')
+
+    def __init__(self, name, handler, args, interval, phase, policy):
+        if policy not in ('skip', 'queue', 'parallel') :
+            raise ValueError(f"Unknown scheduler policy : {policy}")
+        self.name = name
+        self.handler = handler
+        self.args = args
+        self.interval = interval
+        self.phase = phase
+        self.policy = policy
+        self.expires = 0          # 呼び出す tick
+        self.due = 0              # 呼び出す時刻
+        self.cancelled = False
+        self.running = 0          # 実行中の数
+        self.queued = 0           # policy='queue' で実行待ちの数
+
+        # 統計
+        self.runs = 0
+        self.skipped = 0          # 前回が終わっていなかったので呼び出さなかった(あるいは待たせた)回数
+        self.overruns = 0         # 実行時間が interval を超えた回数
+        self.total_time = 0
+        self.max_time = 0
+        self.last_time = 0
+        self.max_delay = 0        # 予定時刻からの呼び出しの遅れの最大
+        self.last_overrun_log = 0
+        self.counter = None       # call_every1sec の登録内容 (呼び出すたびに 'counter' を進める)
+
+    # after より後の最初の呼び出し時刻
+    def next_due(self, after):
+        return self.phase + (math.floor((after-self.phase)/self.interval)+1)*self.interval
+
+    def stats(self):
+        return {'name':self.name, 'interval':self.interval, 'policy':self.policy, 'runs':self.runs, 'skipped':self.skipped,
+                'overruns':self.overruns, 'running':self.running, 'avg_time':self.total_time/self.runs if self.runs else 0,
+                'max_time':self.max_time, 'last_time':self.last_time, 'max_delay':self.max_delay}
+
+
+# 全ての定期ジョブを1つで管理する階層型タイマーホイール
+#   1tick=10ms  レベル0 : 256スロット(2.56秒)  レベル1～3 : 64スロットずつ (レベル3で約7.7日)
+#   遠いジョブは上のレベルに置き、上のレベルのスロットが回ってきたら下のレベルへ移す
+#   待ち時間は次にジョブのある tick まで loop.call_later で眠る (ジョブの数だけタスクを持たない)
+#   Scheduler と logger.call_every1sec への登録はどちらもここで実行される
+class TimerWheel(object):
+    TICK = 0.01
+    _BITS = (8, 6, 6, 6)
+    _MAX_QUEUE = 10       # policy='queue' で溜める呼び出しの上限
+
+    def __init__(self, logger):
         self._logger = logger
-        self._callback = callback
-        self._interval = interval
-        self._args = args
-        self._basetime = time.time()+9*3600 if basetime==None else basetime
-        self._event = asyncio.Event()
-
-        asyncio.create_task(self._main_loop(), name=f"scheduler{callback.__name__}")
-
-    async def _main_loop(self):
-        while self._logger.running:
-            next_time = (self._basetime-time.time()-9*3600) % self._interval
-
-            # asyncio.wait_for(timeout) よりは時間が正確なので、10秒以下は asyncio.sleepを使う
-            if next_time<10 :
-                await asyncio.sleep(next_time)
-            else:
-                complete=False
-                self._event.clear()
-                try:
-                    await asyncio.wait_for(self._event.wait(), timeout=next_time)
-                except asyncio.TimeoutError:
-                    complete=True
-                if not complete:
+        self._shift = [sum(self._BITS[:i]) for i in range(len(self._BITS))]
+        self._mask = [(1<<b)-1 for b in self._BITS]
+        self._limit = 1<<sum(self._BITS)
+        self._wheels = [[[] for i in range(1<<b)] for b in self._BITS]
+        self._current = self._tick_of(time.time())-1    # 処理済みの tick
+        self._handle = None
+        self._armed = None                                # call_later で起きる予定の tick
+        self.jobs = []
+
+    # logger に登録されている TimerWheel (無ければ作成して登録)
+    @classmethod
+    def get(cls, logger):
+        wheel = getattr(logger, 'timer_wheel', None)
+        if wheel is None :
+            wheel = logger.timer_wheel = cls(logger)
+        return wheel
+
+    def _tick_of(self, t):
+        return math.ceil(t/self.TICK)
+
+    # ジョブの登録  最初の呼び出しは start 以降で phase + interval*n の時刻
+    def add(self, name, handler, interval, args=(), phase=None, policy='skip', start=None):
+        now = time.time()
+        job = _Job(name, handler, args, interval, now if phase is None else phase, policy)
+        job.due = job.next_due(now if start is None else start)
+        self.jobs.append(job)
+        self._insert(job)
+        self._arm()
+        return job
+
+    def cancel(self, job):
+        job.cancelled = True
+        if job in self.jobs :
+            self.jobs.remove(job)
+
+    # interval の変更 (次の呼び出し時刻を計算し直す)
+    def reschedule(self, job, interval):
+        self.cancel(job)
+        new_job = self.add(job.name, job.handler, interval, job.args, job.phase, job.policy)
+        for key in ('runs', 'skipped', 'overruns', 'total_time', 'max_time', 'last_time', 'max_delay', 'counter'):
+            setattr(new_job, key, getattr(job, key))
+        return new_job
+
+    def _insert(self, job):
+        job.expires = max(self._tick_of(job.due), self._current+1)
+        delta = min(job.expires-self._current, self._limit-1)
+        for level in range(len(self._BITS)):
+            if delta < 1<<(self._shift[level]+self._BITS[level]) or level==len(self._BITS)-1 :
+                slot = ((self._current+delta)>>self._shift[level]) & self._mask[level]
+                self._wheels[level][slot].append(job)
+                return
+
+    # 上のレベルのスロットのジョブを下のレベルへ移す
+    def _cascade(self):
+        for level in range(1, len(self._BITS)):
+            index = (self._current>>self._shift[level]) & self._mask[level]
+            jobs, self._wheels[level][index] = self._wheels[level][index], []
+            for job in jobs:
+                if not job.cancelled :
+                    self._insert(job)
+            if index != 0 :
+                break
+
+    def _arm(self):
+        # 次にジョブのある tick (レベル0に無ければレベル0が一周して上のレベルから移すとき)
+        target = (self._current | self._mask[0])+1
+        for tick in range(self._current+1, target):
+            if self._wheels[0][tick & self._mask[0]] :
+                target = tick
+                break
+        if self._armed is not None and self._armed <= target and self._handle is not None :
+            return
+        if self._handle is not None :
+            self._handle.cancel()
+        self._armed = target
+        self._handle = asyncio.get_running_loop().call_later(max(target*self.TICK-time.time(), 0), self._on_timer)
+
+    def _on_timer(self):
+        self._handle = None
+        self._armed = None
+        now = time.time()
+        now_tick = math.floor(now/self.TICK)
+
+        if now_tick-self._current > self._mask[0] :
+            # レベル0の一周以上止まっていた (スリープ復帰など) 場合は全て入れ直す
+            jobs = [job for wheel in self._wheels for slot in wheel for job in slot if not job.cancelled]
+            self._wheels = [[[] for i in range(1<<b)] for b in self._BITS]
+            self._current = now_tick-1
+            for job in jobs:
+                self._insert(job)
+
+        while self._current < now_tick :
+            self._current += 1
+            index = self._current & self._mask[0]
+            if index == 0 :
+                self._cascade()
+            jobs, self._wheels[0][index] = self._wheels[0][index], []
+            for job in jobs:
+                if job.cancelled :
                     continue
+                if job.expires > self._current :
+                    self._insert(job)
+                else:
+                    self._fire(job, now)
+
+        self._arm()
+
+    def _fire(self, job, now):
+        due = job.due
+        # 次の呼び出し時刻 (遅れて呼び出された間の分は飛ばす)
+        job.due = job.next_due(max(due, now))
+        self._insert(job)
+        if not self._logger.running :
+            return
+
+        if job.running and job.policy != 'parallel' :
+            job.skipped += 1
+            if job.policy == 'queue' and job.queued < self._MAX_QUEUE :
+                job.queued += 1
+            if now-job.last_overrun_log > 60 :
+                job.last_overrun_log = now
+                self._logger.info( "[scheduler] {} is still running (interval:{}sec, skipped:{}, policy:{})".format(job.name, job.interval, job.skipped, job.policy) )
+            return
+        asyncio.create_task(self._run(job, due), name=f"scheduler_{job.name}")
+
+    async def _run(self, job, due):
+        job.running += 1
+        try:
+            while True:
+                start = time.time()
+                job.max_delay = max(job.max_delay, start-due)
+                try:
+                    if self._logger.running :
+                        if job.counter is not None :
+                            job.counter['counter'] += job.counter['interval']
+                        await job.handler(*job.args)
+                except Exception as e:
+                    self._logger.error( "Function("+job.name + ") : error in scheduled job" )
+                    self._logger.error( e )
+                    self._logger.info(traceback.format_exc())
 
-            try:
-                if self._logger.running :
-                    await self._callback(*self._args)
-            except Exception as e:
-                self._logger.error( "Function("+self._callback.__name__ + ") : error in scheduled job" )
-                self._logger.error( e )
-                self._logger.info(traceback.format_exc())
+                elapsed = time.time()-start
+                job.runs += 1
+                job.total_time += elapsed
+                job.max_time = max(job.max_time, elapsed)
+                job.last_time = elapsed
+                if elapsed > job.interval :
+                    job.overruns += 1
+
+                if job.queued == 0 or job.cancelled :
+                    break
+                job.queued -= 1
+                due = time.time()
+        finally:
+            job.running -= 1
+
+    def stats(self):
+        return [job.stats() for job in self.jobs]
+
+    # ジョブごとの実行時間の表示
+    def disp_stats(self):
+        self._logger.info( "---------------------Scheduled jobs" )
+        for s in sorted(self.stats(), key=lambda s:-s['max_time']):
+            self._logger.info( "    {:<28} interval:{:>7}s runs:{:>6} avg:{:7.1f}ms max:{:8.1f}ms delay:{:6.1f}ms skipped:{} overrun:{}".format(
+                               s['name'][:28], s['interval'], s['runs'], s['avg_time']*1000, s['max_time']*1000, s['max_delay']*1000, s['skipped'], s['overruns']) )
+
+
+# logger.call_every1sec 用のリスト
+#   従来どおり {'name', 'handler', 'interval', 'counter'} を append() すると TimerWheel のジョブとして登録する
+#   'policy' を指定しなければ前回の呼び出しが終わっていない場合はスキップ
+class EverySecList(list):
+    def __init__(self, logger, handlers=()):
+        super().__init__()
+        self._logger = logger
+        for h in handlers:
+            self.append(h)
+
+    def append(self, h):
+        super().append(h)
+        job = TimerWheel.get(self._logger).add(h.get('name', h['handler'].__name__), h['handler'], h['interval'], policy=h.get('policy','skip'))
+        job.counter = h
+
+
+# 定期的なイベントの呼び出しを行うクラス
+#   basetime (日本時間の秒) を起点に interval 秒ごとに callback を呼び出す
+class Scheduler(object):
+    def __init__(self, logger, interval=1, basetime=None, callback=None, args=(), policy='skip'):
+        self._logger = logger
+        self._wheel = TimerWheel.get(logger)
+        basetime = time.time()+9*3600 if basetime==None else basetime
+        self._job = self._wheel.add(callback.__name__, callback, interval, args=args, phase=basetime-9*3600, policy=policy)
 
     @property
     def interval(self):
-        return self._interval
+        return self._job.interval
 
     @interval.setter
     def interval(self, value):
-        self._interval = value
-        self._event.set()
+        self._job = self._wheel.reschedule(self._job, value)
+
+    @property
+    def stats(self):
+        return self._job.stats()
+
+    def cancel(self):
+        self._wheel.cancel(self._job)
+
+
+# テストコード
+if __name__ == "__main__":
+    import random
+
+    class Logger(object):
+        def __init__(self):
+            self.running = True
+        def info(self, *args) : print(*args)
+        def error(self, *args) : print(*args)
+
+    async def main():
+        logger = Logger()
+        logger.call_every1sec = EverySecList(logger)
+
+        # 呼び出し時刻の確認
+        called = {}
+        def recorder(name):
+            async def handler():
+                called.setdefault(name, []).append(time.time())
+            handler.__name__ = name
+            return handler
+        for interval in (0.05, 0.1, 0.3, 1, 2.5):
+            Scheduler(logger, interval=interval, basetime=0, callback=recorder(f'every{interval}'))
+
+        # 遅いジョブがほかのジョブを遅らせないこと・ポリシーごとの動作
+        async def slow():
+            await asyncio.sleep(0.35)
+        logger.call_every1sec.append({'name':'slow_skip', 'handler':slow, 'interval':0.1, 'counter':0})
+        logger.call_every1sec.append({'name':'slow_queue', 'handler':slow, 'interval':0.1, 'counter':0, 'policy':'queue'})
+        logger.call_every1sec.append({'name':'slow_parallel', 'handler':slow, 'interval':0.1, 'counter':0, 'policy':'parallel'})
+        timer = Scheduler(logger, interval=10, basetime=0, callback=recorder('changed'))
+        timer.interval = 0.2
+
+        await asyncio.sleep(3.05)
+        logger.running = False
+        await asyncio.sleep(0.5)
+
+        wheel = logger.timer_wheel
+        wheel.disp_stats()
+        for interval in (0.05, 0.1, 0.3, 1, 2.5):
+            times = called[f'every{interval}']
+            assert abs(len(times)-3.05/interval) <= 1, (interval, len(times))
+            # basetime=0 を起点にした時刻に呼び出されていること
+            assert max(abs(t/interval-round(t/interval))*interval for t in times) < 0.02, interval
+        assert abs(len(called['changed'])-3.05/0.2) <= 1
+        stats = {s['name']:s for s in wheel.stats()}
+        assert stats['slow_skip']['runs'] <= 9 and stats['slow_skip']['skipped'] > 0
+        assert stats['slow_parallel']['runs'] >= 28
+        assert stats['slow_queue']['overruns'] > 0
+        assert logger.call_every1sec[0]['counter'] > 0
+
+        # 多数のジョブの登録 (従来のジョブごとのタスクとの比較)
+        logger.running = True
+        count = [0]
+        async def job():
+            count[0] += 1
+        wheel = TimerWheel(logger)
+        jobs = [wheel.add('job', job, random.choice((1, 5, 60, 3600, 86400))) for i in range(10000)]
+        for j in jobs[:5000]:
+            wheel.cancel(j)
+        await asyncio.sleep(2)
+        print( "10000 jobs registered : {} calls in 2sec".format(count[0]) )
+
+    asyncio.run(main())
@@ -3,9 +3,7 @@
 
 import asyncio
 import time
-from collections import deque
-from threading import Thread, Event
-from datetime import datetime, timedelta, timezone
+from datetime import timedelta, timezone
 import pandas as pd
 import traceback
 import numpy as np
@@ -15,6 +13,10 @@ from libs.database import auth_db, candle_db
 
 class CandleGenerator(object):
 
+    _COLUMNS = ['open', 'high', 'low', 'close', 'volume', 'buy_volume', 'sell_volume',
+                'count', 'buy_count', 'sell_count', 'value', 'buy_value', 'sell_value']
+    _JST = timezone(timedelta(hours=9), 'JST')
+
     def __init__( self,logger, exchange, timescale, num_of_candle=500, update_current=False, callback=None, args=(), server=('',)  ):
         self._logger = logger
         self._exchange = exchange
@@ -25,18 +27,21 @@ class CandleGenerator(object):
         self._update_current = update_current
         self._server = server
 
-        # 約定をためるキュー
-        self._execution_buffer = deque(maxlen=timescale*10000)
-        self._executions = deque(maxlen=timescale*10000)
+        # 確定足のリングバッファ (足の開始時刻[ns] と _COLUMNS の順の値)
+        self._scale = int(timescale*1000000000)
+        self._allocate(num_of_candle)
+
+        # 現在足 (open==0 の間はまだ約定が無い)
+        self._current_time = None
+        self._current = [0.0]*len(self._COLUMNS)
 
-        # ローソク足データ
-        self._candle = pd.DataFrame(index=[], columns=['date', 'open', 'high', 'low', 'close', 'volume', 'buy_volume', 'sell_volume',
-                                                      'count', 'buy_count', 'sell_count', 'value', 'buy_value', 'sell_value']).set_index('date')
-        self._current_ohlc = {'date':0, 'open': 0, 'high': 0, 'low': 0, 'close': 0, 'volume': 0, 'buy_volume': 0, 'sell_volume': 0,
-                              'count': 0, 'buy_count': 0, 'sell_count': 0, 'value': 0, 'buy_value': 0, 'sell_value': 0}
+        # .candle で参照されたときに作成する DataFrame (次の足が確定するまで使い回す)
+        self._candle = pd.DataFrame(index=[], columns=['date']+self._COLUMNS).set_index('date')
+        self._candle_version = None
 
         # ローソク足サーバーが指定されていれば取得を試みる
         self._db_candle = []
+        self._db_prefix = None
         if self.use_server :
             self._connected = False
             # 初回の取得タイミングはローソク足が3本溜まってからになるように調整
@@ -44,45 +49,75 @@ class CandleGenerator(object):
         else:
             self._connected = True
 
-        self._lastcandle = datetime.now(timezone(timedelta(hours=9), 'JST'))-timedelta(minutes=10)
-        self._last_conveted = 0
+        self._lastcandle = None
 
         self._candle_generate = asyncio.Event()
 
         asyncio.create_task(self._loop(), name=f"sec_candle_generator_{exchange.exchange_name}")
 
-        # 10秒ごとに実行
-        self._logger.call_every1sec.append({'name':'reduce_execution_buffer', 'handler':self.reduce_execution_buffer, 'interval':10, 'counter':0})
+        # 約定履歴は列形式のまま受け取る
+        self._reader = self._exchange.execution_info.reader()
+        self._exchange.execution_info.add_handler( exec_que=self._reader, handler=self._on_execution )
 
-        self._exchange.execution_info.add_handler( exec_que=self._execution_buffer, handler=self._on_execution )
+    def _allocate(self, num_of_candle):
+        self._capacity = max(num_of_candle, 1)
+        self._bar_time = np.zeros(self._capacity, dtype=np.int64)
+        self._bar_value = np.zeros((self._capacity, len(self._COLUMNS)), dtype=np.float64)
+        self._closed = 0       # これまでに確定した足の数 (単調増加)
 
     @property
     def use_server(self) :
         return self._server[0] and self._server[0]!=''
 
-    def _update_current_candle( self, i ):
+    # 約定時刻(エポックナノ秒)が属する足の開始時刻  (pandas.resample と同じくJSTの0時を起点に区切る)
+    def _bar_start(self, timestamp):
+        jst = timestamp+32400000000000
+        day = jst-jst%86400000000000
+        return day+(jst-day)//self._scale*self._scale-32400000000000
+
+    # 現在足を確定してリングバッファへ
+    def _close_bar(self, bar_time, values):
+        i = self._closed % self._capacity
+        self._bar_time[i] = bar_time
+        self._bar_value[i] = values
+        self._closed += 1
+
+    def _update_current_candle( self, timestamp, price, size, side ):
+        bar_time = self._bar_start(timestamp)
+        c = self._current
+
+        if self._current_time is None :
+            self._current_time = bar_time
+
+        elif bar_time > self._current_time :
+            # 現在足を確定し、約定の無かった足は直前の終値で埋める
+            close = c[3]
+            self._close_bar(self._current_time, c)
+            empty = (bar_time-self._current_time)//self._scale-1
+            for t in range(max(empty-self._capacity,0)+1, empty+1):
+                self._close_bar(self._current_time+t*self._scale, [close]*4+[0.0]*(len(self._COLUMNS)-4))
+            self._current_time = bar_time
+            c = self._current = [0.0]*len(self._COLUMNS)
 
         # 現在足のデータ生成
-        price = float(i['price'])
-        size = i['size']
-        c = self._current_ohlc
-        if c['open'] == 0:
-            c['open'] = c['high'] = c['low'] = price
-        c['high'] = max(price, c['high'])
-        c['low'] = min(price, c['low'])
-        c['close'] = price
-        c['volume'] += size
-        c['count'] += 1
-        c['value'] += price * size
-
-        if i['side'] == 'BUY':
-            c['buy_volume'] += size
-            c['buy_count'] += 1
-            c['buy_value'] += price * size
-        else:
-            c['sell_volume'] += size
-            c['sell_count'] += 1
-            c['sell_value'] += price * size
+        if c[0] == 0:
+            c[0] = c[1] = c[2] = price
+        if price > c[1] : c[1] = price
+        if price < c[2] : c[2] = price
+        c[3] = price
+        c[4] += size
+        c[7] += 1 if size != 0 else 0
+        c[10] += price * size
+
+        # 確定足は従来の resample と同じく SELL だけを売りとして集計 (板寄せなど side が空の約定はどちらにも入れない)
+        if side == 1:
+            c[5] += size
+            c[8] += 1
+            c[11] += price * size
+        elif side == -1:
+            c[6] += size
+            c[9] += 1
+            c[12] += price * size
 
     async def _loop(self):
         while self._logger.running:
@@ -91,107 +126,77 @@ class CandleGenerator(object):
             await self._updatecandle()
 
     async def _on_execution( self ):
-        while len(self._execution_buffer)>0:
-            i = self._execution_buffer.popleft()
-
-            self._executions.append(i)
-            if self._update_current :
-                self._update_current_candle(i)
+        block = self._reader.read()
+        for timestamp, price, size, side in zip(block.timestamp.tolist(), block.price.tolist(), block.size.tolist(), block.side.tolist()):
+            self._update_current_candle(timestamp, price, size, side)
 
-        # 送られてきたexecutionの時間��前回ローソク足更新時の最後の足よりもtimescale進んでいればローソク足の更新作業を行う
-        if self._executions[-1]['exec_date'].timestamp() - self._lastcandle.timestamp() >= self._timescale:
+        # 現在足が前回ローソク足更新時の足から進んでいればローソク足の更新作業を行う
+        if self._current_time is not None and self._current_time != self._lastcandle :
             self._candle_generate.set()
 
-    # executionリストをもとに指定秒足のローソクを生成
+    # 足が確定したときに呼び出されるロジックを実行
     async def _updatecandle(self):
         try:
-            tmpExecutions = list(self._executions)
-            self.raw = pd.DataFrame([[
-                    tick['exec_date'], tick['price'],
-                    tick['size'],
-                    tick['size']if tick['side'] == 'BUY'else 0,
-                    tick['size']if tick['side'] == 'SELL'else 0,
-                    1 if tick['size'] != 0 else 0,
-                    1 if tick['side'] == 'BUY' else 0,
-                    1 if tick['side'] == 'SELL' else 0,
-                    tick['price'] * tick['size'],
-                    tick['price'] * tick['size'] if tick['side'] == 'BUY' else 0,
-                    tick['price'] * tick['size'] if tick['side'] == 'SELL' else 0
-                    ] for tick in tmpExecutions],
-                    columns=['date', 'price', 'volume', 'buy_volume', 'sell_volume', 'count', 'buy_count', 'sell_count',
-                             'value', 'buy_value', 'sell_value'])
-            tmpcandle = self.raw.set_index('date').resample(str(self._timescale)+'s').agg({
-                    'price': 'ohlc', 'volume': 'sum', 'buy_volume': 'sum', 'sell_volume': 'sum',
-                     'count': 'sum', 'buy_count': 'sum', 'sell_count': 'sum',
-                    'value': 'sum', 'buy_value': 'sum', 'sell_value': 'sum'})
-            tmpcandle.columns = tmpcandle.columns.droplevel()
-            self._logger.debug( "tmpcandle\n{}".format(tmpcandle) )
-
-            if len(self._candle)<2 :
-                self._candle = tmpcandle
-            else:
-                # 前回変換済みのところを検索
-                last_index = np.where(tmpcandle.index.values>=self._last_conveted)[0][0]-len(tmpcandle) if self._last_conveted!=0 else -len(tmpcandle)
-                self._candle = pd.concat([self._candle[:-1], tmpcandle[last_index:]]).sort_index().groupby(level=0).last()
-            self._last_conveted = self._candle.tail(2).index.values[0]
-            self._logger.debug( "self._last_conveted : {}".format(self._last_conveted) )
-
-            self._candle['close'] = self._candle['close'].ffill()
-            self._candle['open'] = self._candle['open'].fillna(self._candle['close'])
-            self._candle['high'] = self._candle['high'].fillna(self._candle['close'])
-            self._candle['low'] = self._candle['low'].fillna(self._candle['close'])
-
-            # 必要な本数だけにカット
-            self._candle = self._candle.tail(self._num_of_candle+1)
-
-            # 現在足データの更新
-            if self._update_current :
-                self._current_ohlc = {'date':self._candle.index[-1],
-                                      'open': self._candle['open'][-1],
-                                      'high': self._candle['high'][-1],
-                                      'low': self._candle['low'][-1],
-                                      'close': self._candle['close'][-1],
-                                      'volume': self._candle['volume'][-1],
-                                      'buy_volume': self._candle['buy_volume'][-1],
-                                      'sell_volume': self._candle['sell_volume'][-1],
-                                      'count': self._candle['count'][-1],
-                                      'buy_count': self._candle['buy_count'][-1],
-                                      'sell_count': self._candle['sell_count'][-1],
-                                      'value': self._candle['value'][-1],
-                                      'buy_value': self._candle['buy_value'][-1],
-                                      'sell_value': self._candle['sell_value'][-1] }
-
             if self.use_server and not self._connected :
                 self._logger.info( "{} {} candles : {}, {}".format(self._exchange.exchange_name, self._exchange.symbol, len(self.candle),len(self._candle)) )
 
-            if self._lastcandle!=self._candle.index[-1] and self._callback!=None and self._connected and self._logger.running:
+            current_time = self._current_time
+            if self._lastcandle!=current_time and self._callback!=None and self._connected and self._logger.running:
+                self._lastcandle = current_time
                 # ローソク足更新時のロジックを呼び出す
                 await self._callback(*self._args)
 
-            self._lastcandle = self._candle.index[-1]
+            self._lastcandle = current_time
 
         except Exception as e:
             self._logger.error("Error occured at _updatecandle: {}".format(e))
             self._logger.info(traceback.format_exc())
 
-    # 負荷軽減のため、ローソク足に変換済みの約定履歴を破棄
-    async def reduce_execution_buffer(self):
-        if len(self._executions) == 0: return
-        if self._last_conveted == 0:  return
+    # 確定足と現在足の DataFrame を作成
+    def _materialize(self):
+        n = min(self._closed, self._capacity)
+        order = np.arange(self._closed-n, self._closed) % self._capacity
+        times = self._bar_time[order]
+        values = self._bar_value[order]
+        if self._current_time is not None :
+            times = np.append(times, self._current_time)
+            values = np.vstack((values, self._current))
+
+        candle = pd.DataFrame(values, columns=self._COLUMNS,
+                              index=pd.DatetimeIndex(pd.to_datetime(times, unit='ns', utc=True).tz_convert(self._JST), name='date'))
+        candle[['count', 'buy_count', 'sell_count']] = candle[['count', 'buy_count', 'sell_count']].astype(np.int64)
+
+        # ローソク足サーバーから取得した足の後ろに接合
+        if self._db_prefix is not None and len(candle)!=0 :
+            candle = pd.concat([self._db_prefix[self._db_prefix.index<candle.index[0]], candle])
 
-        while len(self._executions)>0:
-            i = self._executions.popleft()
-            if int(self._last_conveted)/1000000000 <= i['exec_date'].timestamp():
-                self._executions.appendleft(i)
-                break
+        # 必要な本数だけにカット
+        return candle.tail(self._num_of_candle+1)
 
-    # 確定��ーソク足の時刻
+    # 確定ローソク足の時刻
     @property
     def date(self):
-        return self._candle.index[-2] if len(self._candle)>1 else 0
+        candle = self._cached_candle()
+        return candle.index[-2] if len(candle)>1 else 0
+
+    def _cached_candle(self):
+        if self._candle_version != (self._closed, self._current_time) :
+            self._candle = self._materialize()
+            self._candle_version = (self._closed, self._current_time)
+        return self._candle
+
+    @property
+    def _current_ohlc(self):
+        return dict({'date':self._current_time_dt}, **dict(zip(self._COLUMNS, self._current)))
+
+    @property
+    def _current_time_dt(self):
+        return pd.Timestamp(self._current_time, unit='ns', tz='UTC').tz_convert(self._JST)
 
     @property
     def candle(self):
+        candle = self._cached_candle()
+
         if self.use_server :
             if not self._connected :
 
@@ -205,24 +210,26 @@ class CandleGenerator(object):
                     self._last_fetch_time = time.time()
 
                 # ローソク足が溜まるまではなにもしない
-                if len(self._candle)<3 or len(self._db_candle)==0 :
+                if len(candle)<3 or len(self._db_candle)==0 :
                     return self._db_candle
 
-                hit = np.where(self._db_candle.index.values[-1]>=self._candle.index.values)
+                hit = np.where(self._db_candle.index.values[-1]>=candle.index.values)
 
                 # まだ接合できない
                 if len(hit[0])==0 :
                     return self._db_candle
 
-                self._candle = pd.concat([self._db_candle[:-1],self._candle[hit[0][-1]:]]).groupby(level=0).last()
+                self._db_prefix = self._db_candle[:-1]
+                self._candle_version = None
+                candle = self._cached_candle()
                 self._connected = True
 
-        if not self._update_current :
-            return self._candle
+        if not self._update_current or self._current_time is None :
+            return candle
 
         # 最後に未確定ローソクを追加
         current_candle = pd.DataFrame.from_dict(self._current_ohlc, orient='index').T.set_index('date')
-        candle = pd.concat([self._candle[:-1],current_candle])
+        candle = pd.concat([candle[:-1],current_candle])
         candle[['open','high','low','close']] = candle[['open','high','low','close']].applymap("{:.1f}".format)
         return candle
 
@@ -232,6 +239,16 @@ class CandleGenerator(object):
 
     @num_of_candle.setter
     def num_of_candle(self, value):
+        if value > self._capacity :
+            # 確定足を保持したまま領域を広げる
+            n = min(self._closed, self._capacity)
+            order = np.arange(self._closed-n, self._closed) % self._capacity
+            times, values = self._bar_time[order], self._bar_value[order]
+            self._allocate(value)
+            self._bar_time[:n] = times
+            self._bar_value[:n] = values
+            self._closed = n
+            self._candle_version = None
         self._num_of_candle = value
 
     def fetch_from_candle_server( self, timescale, num_of_candle ):
@@ -1,12 +1,14 @@
 # coding: utf-8
 #!/usr/bin/python3
 
-from copy import deepcopy
 import time
 from libs.utils.jsonfile import JsonFile
 from libs.utils.scheduler import Scheduler
+from libs.utils.stats_store import StatsStore
 
 # 様々な統計データを集計するクラス
+#   統計データは StatsStore (メモリマップした列形式のファイル) に保存
+#   従来のJSONファイル (stats_xxx.json) は初回だけ取り込む
 class Stats(object):
     def __init__(self, logger, exchange):
         self._logger = logger
@@ -17,52 +19,69 @@ class Stats(object):
 
         self.file = JsonFile(self._logger)
         self._filename = ''
-        self._stats_list=[]
+        self._store = None
+        self._pending = []      # ストアを開く前に集計したデータ
+        self._since = 0         # 当日分の開始時刻
 
         Scheduler(self._logger, interval=60, basetime=0, callback=self._add_stats)
         Scheduler(self._logger, interval=86400, basetime=1, callback=self._daily_reset)
 
     async def _add_stats(self):
         stat = self._exchange.add_stats()
-        self._stats_list.append(stat)
-        self.file.add_data(stat)
+        if self._store is None :
+            self._pending.append(stat)
+        else:
+            self._store.append([stat])
 
     async def _daily_reset(self):
         self._logger.info( "daily reset")
         self._exchange.add_stats(keep=True) # 日次の最後を保存
         self._exchange.daily_reset() # wsに登録されているリセット関数を呼び出す（基本はこのクラスのself.daily_resetだが、pos_server稼働時にはオーバーライドされたdaily_resetになる)
-        self._stats_list=[]
+        self._since = time.time()
 
     def reload_statsfile(self, filename=None):
         self._filename = filename or self._filename
-        tmp_stats = self.file.reload_file(self._filename)
+
+        if self._store is None :
+            basename = self._filename[:-5] if self._filename.endswith('.json') else self._filename
+            self._store = StatsStore(self._logger, basename)
+            if not self._store.created :
+                # 従来のJSONファイルからの取り込み (初回のみ)
+                tmp_stats = self.file.reload_file(self._filename)
+                self._logger.info( "import {} stats from {}".format(len(tmp_stats), self._filename) )
+                self._store.append(tmp_stats)
+            self._store.append(self._pending)
+            self._pending = []
 
         # 本日の0:00:05
         jst_zero = (time.time()+32400) // 86400 * 86400 - 32395
 
-        # 昨日以前のデータは１時間に１個に間引く
-        ts=0
-        past_stats = []
-        for s in tmp_stats:
-            if (ts+3600 <= s['timestamp'] or s.get('keep',False)) and s['timestamp']<jst_zero :
-                past_stats.append(s)
-                ts = s['timestamp']
-            
-        # 本日分 (0:00:05以降)
-        self._stats_list = [s for s in tmp_stats if s['timestamp']>=jst_zero]
-
-        # 過去のデータを上書き
-        self.file.renew_file( past_stats+self._stats_list )
+        # 昨日以前のデータは１時間に１個に間引いたものだけを残す
+        self._store.roll(jst_zero)
+        self._since = jst_zero
 
-        if len(self._stats_list)!=0 :
-            self._exchange.my.order.executed_size = self._stats_list[-1].get('exec_vol',0)
-            self._exchange.my.daily_exec_size = self._stats_list[-1].get('exec_vol_day',0)
+        today = self._store.today(self._since)
+        if len(today)!=0 :
+            self._exchange.my.order.executed_size = float(today['exec_vol'][-1])
+            self._exchange.my.daily_exec_size = float(today['exec_vol_day'][-1])
 
+    # 当日分の統計データ (プロットなどで書き換えても良いように毎回新しい dict のリストを作成)
     def get_stats(self):
-        return deepcopy(self._stats_list)
+        if self._store is None :
+            return [dict(s) for s in self._pending]
+        return StatsStore.to_dicts(self._store.today(self._since))
 
+    # 過去分は1時間ごとに間引いた統計データ
     def get_all_stats(self):
-        return self.file.reload_file(self._filename)
+        if self._store is None :
+            return [dict(s) for s in self._pending]
+        return StatsStore.to_dicts(self._store.all(self._since))
+
+    # 列形式のまま参照する場合 (numpy の構造化配列)
+    def get_stats_array(self, all=False):
+        if self._store is None :
+            return StatsStore.to_records(self._pending)
+        return self._store.all(self._since) if all else self._store.today(self._since)
 
     # 以下の関数はpos_serverの時には置き換え
     def add_stats(self, keep=False):
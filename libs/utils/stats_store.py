@@ -0,0 +1,169 @@
+# coding: utf-8
+#!/usr/bin/python3
+
+import os
+import time
+import numpy as np
+
+# 統計データを固定長のレコードとしてメモリマップしたファイルに保持する列形式の時系列ストア
+#   minute : add_stats() で追加されたすべてのレコード (日次リセットで当日分だけ残す)
+#   hour   : 1時間に1レコードに間引いた履歴 (keep=True のレコードは必ず残す)  追加のたびに逐次作成する
+class StatsStore(object):
+    FIELDS = ('timestamp', 'ltp', 'current_pos', 'average', 'realized', 'commission', 'unreal', 'profit', 'fixed_profit',
+              'lantency', 'api1', 'api2', 'api3', 'exec_vol', 'exec_vol_day', 'keep')
+    DTYPE = np.dtype([(f, np.bool_ if f=='keep' else np.float64) for f in FIELDS])
+
+    def __init__(self, logger, basename):
+        self._logger = logger
+        self.minute = _Tier(basename+'.minute.npy', self.DTYPE)
+        self.hour = _Tier(basename+'.hour.npy', self.DTYPE)
+        hour = self.hour.view()
+        self._last_hour = float(hour['timestamp'][-1]) if len(hour) else 0
+
+    # ストアのファイルが既に存在していれば True (存在しなければ従来のJSONファイルからの取り込みが必要)
+    @property
+    def created(self):
+        return self.minute.created and self.hour.created
+
+    @classmethod
+    def to_records(cls, stats):
+        records = np.zeros(len(stats), dtype=cls.DTYPE)
+        for f in cls.FIELDS:
+            records[f] = [s.get(f,0) or 0 for s in stats]
+        return records
+
+    @classmethod
+    def to_dicts(cls, records):
+        return [dict(zip(cls.FIELDS, r)) for r in records.tolist()]
+
+    def append(self, stats):
+        records = self.to_records(stats)
+        self.minute.append(records)
+
+        # 1時間に1レコード (+keep) に間引いて履歴へ
+        hour = []
+        for i, (t, keep) in enumerate(zip(records['timestamp'].tolist(), records['keep'].tolist())):
+            if self._last_hour+3600 <= t or keep :
+                hour.append(i)
+                self._last_hour = t
+        if hour :
+            self.hour.append(records[hour])
+
+    # 当日分 (since以降) のレコード
+    def today(self, since):
+        data = self.minute.view()
+        return data[data['timestamp'].searchsorted(since):]
+
+    # 過去分は1時間ごとの履歴、since以降は全てのレコード
+    def all(self, since):
+        hour = self.hour.view()
+        return np.concatenate((hour[:hour['timestamp'].searchsorted(since)], self.today(since)))
+
+    # 日次リセット : since より前のレコードを minute から削除
+    def roll(self, since):
+        self.minute.truncate(since)
+        self.hour.flush()
+
+
+# 1つの階層のファイル
+#   レコードは時刻順に先頭から詰めて書き込み、timestamp==0 の行が未使用領域
+class _Tier(object):
+    def __init__(self, filename, dtype, capacity=4096):
+        self.filename = filename
+        self._dtype = dtype
+        self.created = os.path.isfile(filename)
+        if self.created :
+            self._data = np.load(filename, mmap_mode='r+')
+            unused = np.flatnonzero(self._data['timestamp']==0)
+            self.count = int(unused[0]) if len(unused) else len(self._data)
+        else:
+            self._data = self._create(filename, capacity)
+            self.count = 0
+
+    def _create(self, filename, capacity, records=None):
+        # 一時ファイルに作ってから置き換える (作成途中で終了しても元のファイルは壊れない)
+        tmp = filename+'.tmp'
+        data = np.lib.format.open_memmap(tmp, mode='w+', dtype=self._dtype, shape=(capacity,))
+        if records is not None :
+            data[:len(records)] = records
+        data.flush()
+        del data
+        os.replace(tmp, filename)
+        return np.load(filename, mmap_mode='r+')
+
+    def view(self):
+        return self._data[:self.count]
+
+    def append(self, records):
+        n = self.count+len(records)
+        if n > len(self._data) :
+            # 容量が足りなければ倍に広げたファイルへ移す
+            capacity = len(self._data)
+            while capacity < n :
+                capacity *= 2
+            self._data = self._create(self.filename, capacity, self.view())
+        self._data[self.count:n] = records
+        self.count = n
+
+    def truncate(self, since):
+        keep = self.view()[self.view()['timestamp'].searchsorted(since):]
+        self._data = self._create(self.filename, len(self._data), np.array(keep))
+        self.count = len(keep)
+
+    def flush(self):
+        self._data.flush()
+
+
+# テストコード
+if __name__ == "__main__":
+    import tempfile
+    from copy import deepcopy
+
+    class Logger(object):
+        def info(self, *args) : print(*args)
+
+    def stat(t, keep=False):
+        return {'timestamp':t, 'ltp':5000000.0, 'current_pos':0.01, 'average':4990000.0, 'realized':100.0, 'commission':-1.0,
+                'unreal':-5, 'profit':95.0, 'fixed_profit':99.0, 'lantency':12.5, 'api1':480, 'api2':300, 'api3':300,
+                'exec_vol':0.1, 'exec_vol_day':1.2, 'keep':keep}
+
+    # 従来の reload_statsfile の間引きとの比較
+    folder = tempfile.mkdtemp()
+    store = StatsStore(Logger(), os.path.join(folder, 'stats_test'))
+    start = 1700000000-1700000000%86400-32400+5
+    stats = [stat(start+i*60+(i%7), keep=(i%1440==1439)) for i in range(1440*30)]
+    store.append(stats[:1000])
+    for s in stats[1000:]:
+        store.append([s])
+    jst_zero = stats[-1]['timestamp']//86400*86400-32395
+    ts = 0
+    past = []
+    for s in stats:
+        if (ts+3600 <= s['timestamp'] or s['keep']) and s['timestamp']<jst_zero :
+            past.append(s)
+            ts = s['timestamp']
+    expected = past+[s for s in stats if s['timestamp']>=jst_zero]
+    assert StatsStore.to_dicts(store.all(jst_zero))==expected
+    assert StatsStore.to_dicts(store.today(jst_zero))==[s for s in stats if s['timestamp']>=jst_zero]
+
+    # 日次リセット後に開き直しても同じ内容
+    store.roll(jst_zero)
+    store = StatsStore(Logger(), os.path.join(folder, 'stats_test'))
+    assert store.created and StatsStore.to_dicts(store.all(jst_zero))==expected
+    print( "records : minute {}  hour {}".format(store.minute.count, store.hour.count) )
+
+    # プロット用の取り出し (従来は deepcopy)
+    today = [s for s in stats if s['timestamp']>=jst_zero]
+    begin = time.perf_counter()
+    for i in range(100):
+        deepcopy(today)
+    copy_time = (time.perf_counter()-begin)/100
+    begin = time.perf_counter()
+    for i in range(100):
+        StatsStore.to_dicts(store.today(jst_zero))
+    dict_time = (time.perf_counter()-begin)/100
+    begin = time.perf_counter()
+    for i in range(100):
+        store.today(jst_zero)
+    slice_time = (time.perf_counter()-begin)/100
+    print( "get_stats ({} records) : deepcopy {:.2f}ms  dicts {:.2f}ms  array slice {:.4f}ms".format(len(today), copy_time*1000, dict_time*1000, slice_time*1000) )
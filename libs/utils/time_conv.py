@@ -3,6 +3,78 @@
 
 from datetime import datetime,timedelta,timezone
 from dateutil import parser
+import numpy as np
+
+# 1970/1/1 からの日数 (proleptic gregorian)
+def _days_from_civil(y, m, d):
+    y -= m <= 2
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+# 日付と時:分までの部分のエポックナノ秒のキャッシュ (同じ分の約定が続くので毎回の日付計算を省く)
+_minute_cache = {}
+
+# 小数部の桁数ごとのナノ秒への倍率
+_FRAC_SCALE = tuple(10**(9-i) if i<=9 else 0 for i in range(20))
+
+def _minute_ns(prefix):
+    ns = _minute_cache.get(prefix)
+    if ns is None :
+        if len(_minute_cache)>4096 :
+            _minute_cache.clear()
+        ns = (_days_from_civil(int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10]))*86400 +
+              int(prefix[11:13])*3600 + int(prefix[14:16])*60)*1000000000
+        _minute_cache[prefix] = ns
+    return ns
+
+# ISO8601形式のUTC文字列 (例 "2021-02-26T07:04:19.0558047Z") をエポックナノ秒に変換
+#   datetime を生成しないのでwebsocket受信プロセスでの前処理にも使用する
+def utcstr_to_ns(date_line):
+    ns = _minute_ns(date_line[:16]) + int(date_line[17:19])*1000000000
+
+    # よくある "....ss.fffffffZ" の形式
+    if date_line[-1]=='Z' and len(date_line)>21 and date_line[19]=='.' :
+        frac = date_line[20:-1]
+        if len(frac)<=9 :
+            return ns + int(frac)*_FRAC_SCALE[len(frac)]
+
+    n = len(date_line)
+    i = 19
+    if i<n and date_line[i]=='.' :
+        i += 1
+        j = i
+        while j<n and date_line[j].isdigit() :
+            j += 1
+        ns += int((date_line[i:j]+'000000000')[:9])
+        i = j
+    if i<n and date_line[i] in '+-' :
+        offset = (int(date_line[i+1:i+3])*60 + int(date_line[i+4:i+6]))*60000000000
+        ns += -offset if date_line[i]=='+' else offset
+    return ns
+
+# エポックミリ秒 (数値または文字列) をエポックナノ秒に変換
+def epoch_ms_to_ns(ms):
+    return int(ms)*1000000
+
+# 複数のISO8601形式のUTC文字列をまとめてエポックナノ秒(int64)の配列に変換
+def utcstr_array_to_ns(date_lines):
+    a = np.asarray(date_lines)
+    if len(a)==0 :
+        return np.zeros(0, dtype=np.int64)
+    # タイムゾーンが "Z" 以外のものは1つずつ変換
+    if not np.char.endswith(a, 'Z').all() :
+        return np.fromiter((utcstr_to_ns(d) for d in date_lines), dtype=np.int64, count=len(a))
+    return np.char.rstrip(a, 'Z').astype('datetime64[ns]').astype(np.int64)
+
+# 複数のエポックミリ秒をまとめてエポックナノ秒(int64)の配列に変換
+def epoch_ms_array_to_ns(values):
+    return np.asarray(values).astype(np.int64)*1000000
+
+_JST = timezone(timedelta(hours=9),'JST')
+_EPOCH_JST = datetime(1970, 1, 1, 9, tzinfo=_JST)
 
 # 時刻関連変換のクラス
 class TimeConv(object):
@@ -11,16 +83,21 @@ class TimeConv(object):
 
     def _utcstr_to_dt(self, date_line):
         try:
-            exec_date = date_line.replace('T', ' ')[:-1]
-            exec_date = exec_date + '00000000'
-            d = datetime(int(exec_date[0:4]), int(exec_date[5:7]), int(exec_date[8:10]),
-                        int(exec_date[11:13]), int(exec_date[14:16]), int(exec_date[17:19]), int(exec_date[20:26]),
-                         tzinfo=timezone(timedelta(hours=9), 'JST')) + timedelta(hours=9)
+            d = self._ns_to_dt(utcstr_to_ns(date_line))
         except Exception as e:
-            self._logger.error("Error while parsing date str : exec_date:{}  {}".format(exec_date, e))
+            self._logger.error("Error while parsing date str : exec_date:{}  {}".format(date_line, e))
             d = (parser.parse(date_line) + timedelta(hours=9)).replace(tzinfo=timezone(timedelta(hours=9),'JST'))
         return d
 
+    # エポックナノ秒からJSTのdatetimeを生成 (必要になったときにだけ呼び出す)
+    def _ns_to_dt(self, ns):
+        return _EPOCH_JST + timedelta(microseconds=int(ns)//1000)
+
+    _utcstr_to_ns = staticmethod(utcstr_to_ns)
+    _epoch_ms_to_ns = staticmethod(epoch_ms_to_ns)
+    _utcstr_array_to_ns = staticmethod(utcstr_array_to_ns)
+    _epoch_ms_array_to_ns = staticmethod(epoch_ms_array_to_ns)
+
     # 稼働サーバーのタイムゾーンが何になっていてもJSTの時刻を生成
     def _jst_now_dt(self):
         return (datetime.utcnow() + timedelta(hours=9)).replace(tzinfo=timezone(timedelta(hours=9),'JST'))
@@ -29,13 +106,54 @@ class TimeConv(object):
 
 
 
-# テストコード
+# テストコード (python3 -m libs.utils.time_conv)
+#   従来の実装 (文字列の置換と datetime の生成) と比較したベンチマーク
 if __name__ == "__main__":
+    import random
+    import time
 
     timeconv = TimeConv()
     print( timeconv._epoc_to_dt(1613695833.307) )
     print( timeconv._utcstr_to_dt("2021-02-19T00:50:33.324Z") )
     print( timeconv._utcstr_to_dt("2021-02-19T00:50:32.388204+00:00") )
+    print( timeconv._ns_to_dt(timeconv._utcstr_to_ns("2021-02-26T07:04:19.0558047Z")) )
     print( timeconv._jst_now_dt() )
 
+    def old_utcstr_to_dt(date_line):
+        exec_date = date_line.replace('T', ' ')[:-1]
+        exec_date = exec_date + '00000000'
+        return datetime(int(exec_date[0:4]), int(exec_date[5:7]), int(exec_date[8:10]),
+                        int(exec_date[11:13]), int(exec_date[14:16]), int(exec_date[17:19]), int(exec_date[20:26]),
+                        tzinfo=timezone(timedelta(hours=9), 'JST')) + timedelta(hours=9)
+
+    # 各取引所の約定メッセージに含まれる時刻の形式
+    #   bitFlyer : exec_date "2021-02-26T07:04:19.0558047Z" (100ns単位, 末尾の0は省略される)
+    #   GMO      : timestamp "2021-02-19T00:50:33.324Z" (ミリ秒)
+    #   bitget   : ts "1613695833307" (エポックミリ秒の文字列)
+    base = 1613695833.0
+    stamps = sorted(base+random.random()*60 for i in range(100000))
+    bitflyer = [datetime.utcfromtimestamp(t).strftime('%Y-%m-%dT%H:%M:%S.%f')+str(random.randint(0,9))+'Z' for t in stamps]
+    bitflyer = [d[:20]+d[20:-1].rstrip('0')+'Z' if d[20:-1].rstrip('0') else d[:19]+'Z' for d in bitflyer]
+    gmo = [datetime.utcfromtimestamp(t).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]+'Z' for t in stamps]
+    bitget = [str(int(t*1000)) for t in stamps]
+
+    def bench(name, func, data):
+        start = time.perf_counter()
+        result = func(data)
+        t = time.perf_counter()-start
+        print( "{:40}: {:8.3f}us/item".format(name, t/len(data)*1e6) )
+        return result
+
+    for name, data in (("bitFlyer", bitflyer), ("GMO", gmo)):
+        print( "---- {}".format(name) )
+        r1 = bench("TimeConv._utcstr_to_dt (old)", lambda d: [old_utcstr_to_dt(s) for s in d], data)
+        r2 = bench("utcstr_to_ns", lambda d: [utcstr_to_ns(s) for s in d], data)
+        r3 = bench("utcstr_array_to_ns (batch)", utcstr_array_to_ns, data)
+        bench("utcstr_to_ns + _ns_to_dt", lambda d: [timeconv._ns_to_dt(utcstr_to_ns(s)) for s in d], data)
+        print( "match : {} {}".format(all(int(d.timestamp()*1000000)==n//1000 for d,n in zip(r1,r2)), r3.tolist()==r2) )
 
+    print( "---- bitget" )
+    r1 = bench("TimeConv._epoc_to_dt (old)", lambda d: [timeconv._epoc_to_dt(int(s)/1000) for s in d], bitget)
+    r2 = bench("epoch_ms_to_ns", lambda d: [epoch_ms_to_ns(s) for s in d], bitget)
+    r3 = bench("epoch_ms_array_to_ns (batch)", epoch_ms_array_to_ns, bitget)
+    print( "match : {} {}".format(all(int(d.timestamp()*1000)==n//1000000 for d,n in zip(r1,r2)), r3.tolist()==r2) )
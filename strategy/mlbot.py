@@ -111,10 +111,22 @@ class MyStrategy(Strategy):
 
         price = self.exchange.round_order_price( price )
 
-        # 発注済みのリストから同一方向のオーダーを抜き出してキャンセル
-        ids = [{'id':o['id'],'price':o['price'],'size':o['size']} for o in self.ordered_list if o['side']==side]
-        for id in ids:
-            await self.cancelorder( id['id'] )
+        # 発注済みのリストから同一方向のオーダーを抜き出す
+        orders = [o for o in self.ordered_list if o['side']==side]
+
+        # 同一方向のオーダーが1つだけなら価格と数量を変更する (キャンセルと新規発注の2往復をせずに済む)
+        #   変更が無い場合もそのまま残し、出し直した場合と同じように自動キャンセルまでの時間を延長する
+        if len(orders)==1 and size >= self.minimum_order_size :
+            o = orders[0]
+            if o['price']!=price or o['remain']!=round(size,8) :
+                await self.amend_order( o['id'], price=price, size=size+o['size']-o['remain'] )
+            else:
+                self.refresh_expire( o['id'] )
+            return
+
+        # 同一方向のオーダーをまとめてキャンセル
+        if orders :
+            await self.cancelorders( [o['id'] for o in orders] )
 
         # 最低発注数に満たない場合には発注しない（発注済みのオーダーキャンセルだけ実施）
         if size < self.minimum_order_size :